@@ -0,0 +1,114 @@
+import asyncio, sqlite3, threading, time
+from contextlib import asynccontextmanager
+from queue import SimpleQueue, Empty
+from flask import g
+from db import DEFAULT_STATEMENT_CACHE
+
+try:
+    import aiosqlite
+except ImportError:  # optional: only needed with ASYNC_READS (pip install aiosqlite asgiref)
+    aiosqlite = None
+
+READ_PRAGMAS = (
+    ('query_only', 1),
+    ('mmap_size', 268435456),
+    ('cache_size', -16000),
+    ('busy_timeout', 5000),
+    ('temp_store', 'MEMORY'),
+)
+
+
+class ReadPoolBusy(Exception):
+    # every async read connection stayed checked out for the whole timeout
+    pass
+
+
+class AsyncReader:
+    # an aiosqlite connection whose statements are reported to the request's
+    # metrics observer, like db.InstrumentedCursor does for the threaded path
+    __slots__ = ('conn',)
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def execute_fetchall(self, sql, params=()):
+        observer = g.get('sql_stats')
+        started = time.perf_counter()
+        rows = await self.conn.execute_fetchall(sql, params)
+        if observer is not None:
+            record = observer.statement(sql, params, time.perf_counter() - started)
+            if record is not None:
+                observer.fetched(record, 0.0, len(rows))
+        return rows
+
+    async def fetchone(self, sql, params=()):
+        rows = await self.execute_fetchall(sql, params)
+        return rows[0] if rows else None
+
+
+class AsyncReadPool:
+    # Bounded set of read-only aiosqlite connections for the async views.
+    # Flask runs each async view on an event loop of its own, so the bound is a
+    # thread semaphore rather than an asyncio one; aiosqlite hands results back
+    # to whichever loop awaited them, so connections can move between requests.
+
+    def __init__(self, path, size=4, timeout=5.0, statement_cache=DEFAULT_STATEMENT_CACHE):
+        if aiosqlite is None:
+            raise RuntimeError('ASYNC_READS needs the aiosqlite package (and asgiref for async views)')
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.statement_cache = statement_cache
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = SimpleQueue()
+        self.opened = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        # aiosqlite's worker threads are not daemons: stop them before the
+        # interpreter waits for non-daemon threads at exit
+        threading._register_atexit(self.close)
+
+    async def _open(self):
+        conn = await aiosqlite.connect(self.path, check_same_thread=False, cached_statements=self.statement_cache)
+        conn.row_factory = sqlite3.Row
+        for name, value in READ_PRAGMAS:
+            await conn.execute('PRAGMA %s = %s' % (name, value))
+        self.opened += 1
+        return conn
+
+    @asynccontextmanager
+    async def connection(self):
+        if not self._slots.acquire(blocking=False):
+            self.waits += 1
+            if not await asyncio.to_thread(self._slots.acquire, True, self.timeout):
+                self.timeouts += 1
+                raise ReadPoolBusy()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except Empty:
+                conn = await self._open()
+            self.checkouts += 1
+            try:
+                yield AsyncReader(conn)
+            except sqlite3.Error:
+                conn.stop()
+                raise
+            except BaseException:
+                self._idle.put(conn)
+                raise
+            self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except Empty:
+                break
+
+    def snapshot(self):
+        return {'size': self.size, 'opened': self.opened, 'idle': self._idle.qsize(), 'checkouts': self.checkouts,
+                'waits': self.waits, 'timeouts': self.timeouts}
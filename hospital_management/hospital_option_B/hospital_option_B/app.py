@@ -1,15 +1,80 @@
-from flask import Flask, render_template, request, redirect, url_for, session, g, jsonify, flash
+from flask import Flask, Response, render_template, request, redirect, url_for, session, g, jsonify, flash, abort
 import sqlite3, os, json, re
 from functools import wraps
-from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import date as Date, datetime, timedelta
 from flask_login import LoginManager, UserMixin, login_user, logout_user, current_user, login_required as flask_login_required
+from db import ConnectionManager, PoolExhausted, immediate, is_busy
+from availability import DATE_FMT, build_availability, earliest_slots, horizon
+from pagination import decode_cursor, fetch_page, page_size
+from identity import IdentityCache, UserRecord
+from search import search_history, SEARCH_LIMIT, MAX_SEARCH_LIMIT
+from passwords import DEFAULT_METHOD, HasherBusy, PasswordHasher
+from metrics import Metrics
+from streaming import negotiated, stream_format, stream_rows
+from versions import version, version_async, patient, appointment, DOCTORS, BLACKLIST
+from reference import ReferenceCache
+from fragments import FragmentCache, Deferred
+from aioreads import AsyncReadPool, ReadPoolBusy
+from writer import GroupCommitWriter, WriterBusy
+from repository import Users, Appointments, History, Relations, Slots, id_list
+from slots import SlotGenerator, materialize, parse_template
 
 BASE_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(BASE_DIR, 'database', 'hms.db')
+DB_PATH = os.environ.get('HMS_DB_PATH') or os.path.join(BASE_DIR, 'database', 'hms.db')
 
 app = Flask(__name__)
-app.secret_key = 'change-me-please'
+# set HMS_SECRET_KEY in production (main.py requires it to be shared by all workers)
+app.secret_key = os.environ.get('HMS_SECRET_KEY') or 'change-me-please'
+app.config['DB_PATH'] = DB_PATH
+app.config['AVAILABILITY_DAYS'] = 7
+app.config['IDENTITY_CACHE_SIZE'] = 1024
+app.config['IDENTITY_CACHE_TTL'] = 60
+# how often the cached doctor directory/blacklist checks for changes made by other processes
+app.config['REFERENCE_CHECK_INTERVAL'] = 1.0
+app.config['PASSWORD_HASH_METHOD'] = DEFAULT_METHOD
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_QUEUE'] = 32
+# most patients one /api/patient-summary call may ask for
+app.config['PATIENT_SUMMARY_MAX'] = 100
+# statements slower than this are logged with their query plan
+app.config['SLOW_QUERY_MS'] = 100
+# keep the parameter values of slow statements in the log (only their types otherwise)
+app.config['SLOW_QUERY_PARAMS'] = False
+# add Server-Timing headers (db/render/app) for the browser devtools
+app.config['SERVER_TIMING'] = False
+# serve the read-only JSON APIs from async views over aiosqlite (needs aiosqlite and asgiref)
+app.config['ASYNC_READS'] = False
+app.config['ASYNC_READ_CONNECTIONS'] = 4
+# run the booking/cancel/reschedule/history writes through one writer thread that
+# commits concurrent requests together (see writer.py); False: each request commits itself
+app.config['GROUP_COMMIT'] = True
+app.config['GROUP_COMMIT_BATCH'] = 64
+app.config['GROUP_COMMIT_QUEUE'] = 256
+# days ahead that bookable slots are materialized for (see slots.py), and how
+# often the generator checks whether the date has rolled over, in seconds
+app.config['SLOT_HORIZON_DAYS'] = 120
+app.config['SLOT_CHECK_INTERVAL'] = 300
+# /api/availability/earliest: slots returned by default and at most
+app.config['EARLIEST_SLOTS_LIMIT'] = 10
+app.config['EARLIEST_SLOTS_MAX'] = 100
+
+# pooled, pre-tuned connections (one per request, returned on teardown)
+db = ConnectionManager(app)
+
+# per-endpoint request/SQL/render histograms, served at /admin/metrics
+metrics = Metrics(app, db)
+
+# rendered template fragments: {% call fragment(name, *tags, version=...) %} (see fragments.py)
+fragments = FragmentCache(app)
+metrics.register(fragments.expose)
+
+# single writer with group commit, used by write()
+writer = GroupCommitWriter(lambda: db.connect(pooled=False), app.config['GROUP_COMMIT_BATCH'],
+                           app.config['GROUP_COMMIT_QUEUE'])
+
+# materializes the doctors' slot templates into `slots`, started by the first request
+slot_generator = SlotGenerator(lambda: db.connect(pooled=False), app.config['SLOT_HORIZON_DAYS'],
+                               app.config['SLOT_CHECK_INTERVAL'])
 
 # Flask-Login setup
 login_manager = LoginManager()
@@ -17,12 +82,29 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 
+# identity of logged-in users, so the loader does not hit the DB on every request
+identity_cache = IdentityCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+
+# doctor directory, specializations and blacklist (see reference.py)
+reference = ReferenceCache(app.config['REFERENCE_CHECK_INTERVAL'])
+
+
+def reference_changed(*tags):
+    # doctors or the blacklist were written in this process
+    reference.invalidate()
+    fragments.invalidate(*tags)
+
+# password hashing/verification runs on a bounded pool (see passwords.py)
+hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                        app.config['PASSWORD_HASH_QUEUE'])
+
+
 class DBUser(UserMixin):
-    def __init__(self, row):
-        self.id = row['id']
-        self.username = row['username'] if 'username' in row.keys() else None
-        self.role = row['role'] if 'role' in row.keys() else None
-        self._row = row
+    def __init__(self, record):
+        self.id = record.id
+        self.username = record.username
+        self.role = record.role
+        self.name = record.name
 
     def get_role(self):
         return getattr(self, 'role', None)
@@ -31,21 +113,75 @@ class DBUser(UserMixin):
 @login_manager.user_loader
 def load_user_from_id(user_id):
     try:
+        uid = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    # a full connection pool (PoolExhausted) is a 503, not a logged-out user
+    record = identity_cache.get(uid)
+    if record is None:
         conn = get_db()
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM users WHERE id=?', (int(user_id),))
-        row = cur.fetchone()
+        row = Users.identity(conn, uid)
         conn.close()
         if not row:
             return None
-        return DBUser(row)
-    except Exception:
-        return None
+        record = UserRecord.from_row(row)
+        identity_cache.put(record)
+    return DBUser(record)
+
+def write(conn, fn):
+    # run fn(cursor) in a write transaction and return its result: batched with
+    # concurrent writes on the writer thread (GROUP_COMMIT), or committed on the
+    # request's own connection. fn must only touch the database through the cursor.
+    if app.config['GROUP_COMMIT']:
+        return writer.run(fn)
+    return immediate(conn, fn)
+
+def refresh_slots(conn, doctor_id):
+    # regenerate one doctor's slots after their template or their row changed
+    write(conn, lambda c: materialize(c, Date.today(), app.config['SLOT_HORIZON_DAYS'], [doctor_id]))
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return db.get()
+
+def parse_slot(date, time):
+    try:
+        return datetime.strptime('%s %s' % (date, time), DATE_FMT + ' %H:%M')
+    except (TypeError, ValueError):
+        return None
+
+@app.template_filter('dmy')
+def format_dmy(value):
+    # display ISO dates the way the UI always showed them (DD/MM/YYYY)
+    try:
+        return datetime.strptime(value, DATE_FMT).strftime('%d/%m/%Y')
+    except (TypeError, ValueError):
+        return value or ''
+
+def list_page(fetch, *args):
+    # one keyset page for the current request's ?cursor= / ?limit=
+    try:
+        return fetch(get_db(), *args, cursor=request.args.get('cursor'), limit=page_size(request.args.get('limit')))
+    except ValueError:
+        abort(400, 'Invalid cursor')
+
+def page_json(rows, next_cursor, rows_template, **context):
+    # JSON page for the "Load more" buttons: raw items plus the same row markup the page renders
+    return jsonify({'success': True, 'items': [dict(r) for r in rows], 'next_cursor': next_cursor,
+                    'html': render_template(rows_template, rows=rows, **context)})
+
+@app.errorhandler(ReadPoolBusy)
+def read_pool_busy(exc):
+    return jsonify({'success': False, 'message': 'Server busy, please try again'}), 503, {'Retry-After': '1'}
+
+@app.errorhandler(HasherBusy)
+@app.errorhandler(WriterBusy)
+@app.errorhandler(PoolExhausted)
+def server_busy(exc):
+    # the password hashing pool, the write queue or the connection pool is full (burst): fail fast
+    if request.is_json:
+        return jsonify({'success': False, 'message': 'Server busy, please try again'}), 503, {'Retry-After': '2'}
+    flash('The system is busy, please try again')
+    return redirect(request.referrer or url_for('index'))
 
 def role_required(role):
     def decorator(f):
@@ -55,7 +191,8 @@ def role_required(role):
             if getattr(current_user, 'role', None) != role:
                 flash('Access denied.')
                 return redirect(url_for('index'))
-            return f(*args, **kwargs)
+            # async views (ASYNC_READS) are run on an event loop by Flask
+            return app.ensure_sync(f)(*args, **kwargs)
         return wrapped
     return decorator
 
@@ -64,13 +201,18 @@ def load_user():
     # expose a simple g.user for templates (keeps existing code compatible)
     if current_user and getattr(current_user, 'is_authenticated', False):
         g.user = {'id': int(current_user.get_id()), 'role': getattr(current_user, 'role', None), 'username': getattr(current_user, 'username', None)}
-        # keep session values for backward compatibility
-        session['user_id'] = int(current_user.get_id())
-        session['username'] = getattr(current_user, 'username', None)
-        session['role'] = getattr(current_user, 'role', None)
+        # keep session values for backward compatibility; only touch the session when
+        # something changed, otherwise every response would carry a new cookie
+        for key, value in (('user_id', g.user['id']), ('username', g.user['username']), ('role', g.user['role'])):
+            if session.get(key) != value:
+                session[key] = value
     else:
         g.user = None
 
+@app.before_request
+def start_slot_generator():
+    slot_generator.ensure_started()
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -87,12 +229,24 @@ def login():
             return render_template('login.html')
 
         conn = get_db()
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM users WHERE username=?', (username,))
-        user = cur.fetchone()
+        user = Users.for_login(conn, username)
+        try:
+            ok = user is not None and hasher.verify(user['password'], password)
+        except HasherBusy:
+            conn.close()
+            flash('Too many sign-ins right now, please try again in a moment')
+            return render_template('login.html'), 503, {'Retry-After': '2'}
+        if ok and hasher.needs_rehash(user['password']):
+            # upgrade hashes made with old parameters while we have the plain password
+            try:
+                Users.rehash(conn, user['id'], user['password'], hasher.hash(password))
+                conn.commit()
+                hasher.rehashed()
+            except (HasherBusy, sqlite3.OperationalError):
+                pass  # keep the old hash, try again next login
         conn.close()
-        if user and check_password_hash(user['password'], password):
-            user_obj = DBUser(user)
+        if ok:
+            user_obj = DBUser(UserRecord.from_row(user))
             login_user(user_obj)
             # maintain session compatibility
             session['user_id'] = user['id']
@@ -132,9 +286,8 @@ def register():
             flash('Username must be >=3 chars and password >=4 chars')
             return redirect(url_for('register'))
         conn = get_db()
-        cur = conn.cursor()
         try:
-            cur.execute('INSERT INTO users (name, username, password, role) VALUES (?,?,?,?)', (name, username, generate_password_hash(password), 'patient'))
+            Users.create(conn, name, username, hasher.hash(password), 'patient')
             conn.commit()
         except sqlite3.IntegrityError:
             flash('Username already exists')
@@ -150,59 +303,72 @@ def register():
 def admin_dashboard():
     conn = get_db()
     cur = conn.cursor()
-    cur.execute('SELECT COUNT(*) as cnt FROM users WHERE role="doctor"')
-    doctors = cur.fetchone()['cnt']
-    cur.execute('SELECT COUNT(*) as cnt FROM users WHERE role="patient"')
-    patients = cur.fetchone()['cnt']
-    cur.execute('SELECT COUNT(*) as cnt FROM appointments')
-    appts = cur.fetchone()['cnt']
+    # counters maintained by triggers (see stats_counters in create_db.py)
+    cur.execute('''SELECT kind, key, cnt FROM stats_counters
+                   WHERE kind='appointments' OR (kind='role' AND key IN ('doctor', 'patient'))''')
+    counts = {(row['kind'], row['key']): row['cnt'] for row in cur.fetchall()}
     conn.close()
+    doctors = counts.get(('role', 'doctor'), 0)
+    patients = counts.get(('role', 'patient'), 0)
+    appts = counts.get(('appointments', ''), 0)
     return render_template('admin/dashboard.html', doctors=doctors, patients=patients, appts=appts)
 
 @app.route('/admin/doctors')
 @role_required('admin')
 def admin_doctors():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM users WHERE role="doctor"')
-    docs = cur.fetchall()
-    cur.execute('SELECT name, username, specialization FROM blacklisted_doctors')
-    bl = cur.fetchall()
-    conn.close()
-    bl_list = [dict(x) for x in bl]
-    return render_template('admin/doctors.html', doctors=docs, blacklist=bl_list)
+    ref = reference.get(get_db())
+    return render_template('admin/doctors.html', doctors=ref.doctors, blacklist=ref.blacklist, ref_version=ref.stamp)
+
+@app.route('/admin/api/db-stats')
+@role_required('admin')
+def api_db_stats():
+    return jsonify({'success': True, 'connections': db.snapshot(), 'identity_cache': identity_cache.snapshot(),
+                    'reference_cache': reference.snapshot(), 'fragment_cache': fragments.snapshot(),
+                    'async_reads': read_pool.snapshot() if read_pool else None, 'password_hasher': hasher.snapshot(),
+                    'writer': writer.snapshot(), 'slots': slot_generator.snapshot()})
+
+@app.route('/admin/metrics')
+@role_required('admin')
+def admin_metrics():
+    return Response(metrics.expose(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/api/slow-queries')
+@role_required('admin')
+def api_slow_queries():
+    return jsonify({'success': True, 'threshold_ms': app.config['SLOW_QUERY_MS'], 'queries': metrics.slow()})
 
 @app.route('/admin/stats')
 @role_required('admin')
 def stats():
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT specialization, COUNT(*) as cnt FROM users WHERE role="doctor" GROUP BY specialization')
-    spec_data = cur.fetchall()
-    conn.close()
-    
-    labels = [row['specialization'] or 'General' for row in spec_data]
-    values = [row['cnt'] for row in spec_data]
-    
-    return render_template('admin/stats.html', labels=labels, values=values)
+    # (label, count) pairs; only queried when the cached chart fragment is stale
+    specs = Deferred(lambda: [(row['specialization'] or 'General', row['cnt']) for row in conn.execute(
+        "SELECT key as specialization, cnt FROM stats_counters WHERE kind='specialization' AND cnt > 0 ORDER BY key")])
+    # the specialization counters only change along with doctor rows
+    return render_template('admin/stats.html', specs=specs, ref_version=reference.get(conn).stamp)
 
 
-@app.route('/admin/appointments')
-@role_required('admin')
-def admin_appointments():
-    conn = get_db()
-    cur = conn.cursor()
-    # Fetch appointments with doctor and patient names, ordered by date desc
-    cur.execute('''SELECT a.id, a.date, a.time, a.status, a.diagnosis, a.prescription,
+def admin_appointments_page(conn, cursor=None, limit=None):
+    # appointments with doctor and patient names, newest first
+    return fetch_page(conn, '''SELECT a.id, a.date, a.time, a.status, a.diagnosis, a.prescription,
                    d.id as doctor_id, d.name as doctor_name,
                    p.id as patient_id, p.name as patient_name
                    FROM appointments a
                    LEFT JOIN users d ON a.doctor_id = d.id
-                   LEFT JOIN users p ON a.patient_id = p.id
-                   ORDER BY a.date DESC, a.time DESC''')
-    rows = cur.fetchall()
-    conn.close()
-    return render_template('admin/appointments.html', appointments=rows)
+                   LEFT JOIN users p ON a.patient_id = p.id''',
+                   ('a.date', 'a.time', 'a.id'), cursor=cursor, limit=limit)
+
+@app.route('/admin/appointments')
+@role_required('admin')
+def admin_appointments():
+    rows, next_cursor = list_page(admin_appointments_page)
+    return render_template('admin/appointments.html', appointments=rows, next_cursor=next_cursor)
+
+@app.route('/admin/api/appointments')
+@role_required('admin')
+def api_admin_appointments():
+    rows, next_cursor = list_page(admin_appointments_page)
+    return page_json(rows, next_cursor, 'admin/_appointment_rows.html')
 
 @app.route('/admin/add-doctor', methods=['GET','POST'])
 @role_required('admin')
@@ -214,10 +380,7 @@ def admin_add_doctor():
         specialization = request.form.get('specialization','General')
         experience = request.form.get('experience','')
         conn = get_db()
-        cur = conn.cursor()
-        # check blacklist in DB
-        cur.execute('SELECT * FROM blacklisted_doctors WHERE username=? AND name=? AND (specialization=? OR (specialization IS NULL AND ?="General"))', (username, name, specialization, specialization))
-        if cur.fetchone():
+        if reference.get(conn).is_blacklisted(username, name, specialization):
             conn.close()
             flash('This doctor is blacklisted and cannot be added.')
             return redirect(url_for('admin_doctors'))
@@ -227,40 +390,46 @@ def admin_add_doctor():
                 flash('Name, username and password required')
                 conn.close()
                 return redirect(url_for('admin_add_doctor'))
-            cur.execute('INSERT INTO users (name, username, password, role, specialization, experience) VALUES (?,?,?,?,?,?)', (name, username, generate_password_hash(password), 'doctor', specialization, experience))
+            doctor_id = Users.create(conn, name, username, hasher.hash(password), 'doctor', specialization, experience)
             conn.commit()
+            reference_changed('doctors')
+            refresh_slots(conn, doctor_id)
         except sqlite3.IntegrityError:
             flash('Username already exists')
             conn.close()
             return redirect(url_for('admin_add_doctor'))
         conn.close()
         return redirect(url_for('admin_doctors'))
-    return render_template('admin/add_doctor.html')
+    return render_template('admin/add_doctor.html', specializations=reference.get(get_db()).specializations)
+
+def doctor_appointments_page(conn, doctor_id, cursor=None, limit=None):
+    # one doctor's appointments, newest first
+    return fetch_page(conn, '''SELECT a.id, a.date, a.time, a.status,
+                   p.id as patient_id, p.name as patient_name
+                   FROM appointments a
+                   LEFT JOIN users p ON a.patient_id = p.id''',
+                   ('a.date', 'a.time', 'a.id'), where='a.doctor_id=?', params=(doctor_id,), cursor=cursor, limit=limit)
 
 @app.route('/admin/doctor/<int:doctor_id>/appointments')
 @role_required('admin')
 def admin_doctor_appointments(doctor_id):
     conn = get_db()
-    cur = conn.cursor()
-    # Get doctor info
-    cur.execute('SELECT * FROM users WHERE id=? AND role="doctor"', (doctor_id,))
-    doctor = cur.fetchone()
+    doctor = reference.get(conn).doctor(doctor_id)
     if not doctor:
         flash('Doctor not found')
         return redirect(url_for('admin_doctors'))
-    
-    # Get all appointments for this doctor
-    cur.execute('''SELECT a.id, a.date, a.time, a.status, 
-                   p.id as patient_id, p.name as patient_name
-                   FROM appointments a
-                   LEFT JOIN users p ON a.patient_id = p.id
-                   WHERE a.doctor_id=?
-                   ORDER BY a.date DESC, a.time DESC''', (doctor_id,))
-    appointments = cur.fetchall()
+    appointments, next_cursor = list_page(doctor_appointments_page, doctor_id)
     conn.close()
-    return render_template('admin/doctor_appointments.html', doctor=doctor, appointments=appointments)
+    return render_template('admin/doctor_appointments.html', doctor=doctor, appointments=appointments, next_cursor=next_cursor)
+
+@app.route('/admin/api/doctor/<int:doctor_id>/appointments')
+@role_required('admin')
+def api_admin_doctor_appointments(doctor_id):
+    rows, next_cursor = list_page(doctor_appointments_page, doctor_id)
+    return page_json(rows, next_cursor, 'admin/_doctor_appointment_rows.html')
 
 @app.route('/api/patient-history/<int:patient_id>')
+@negotiated
 @flask_login_required
 def api_patient_history(patient_id):
     # Allow admins to view any patient's history.
@@ -273,16 +442,8 @@ def api_patient_history(patient_id):
     elif role == 'doctor':
         # check doctor-patient relation or past appointments
         conn = get_db()
-        cur = conn.cursor()
-        cur.execute('SELECT COUNT(*) as cnt FROM doctor_patient WHERE doctor_id=? AND patient_id=?', (uid, patient_id))
-        r = cur.fetchone()
-        has_rel = (r['cnt'] if r and 'cnt' in r.keys() else 0) > 0
-        if not has_rel:
-            cur.execute('SELECT COUNT(*) as cnt FROM appointments WHERE doctor_id=? AND patient_id=?', (uid, patient_id))
-            r2 = cur.fetchone()
-            has_rel = (r2['cnt'] if r2 and 'cnt' in r2.keys() else 0) > 0
+        allowed = Relations.related(conn, uid, patient_id)
         conn.close()
-        allowed = bool(has_rel)
     elif role == 'patient':
         allowed = (uid == patient_id)
     else:
@@ -292,73 +453,143 @@ def api_patient_history(patient_id):
         return jsonify({'success': False, 'message': 'Forbidden'}), 403
 
     conn = get_db()
-    cur = conn.cursor()
+    # ?format=ndjson|csv (or an Accept header) streams straight from the cursor
+    fmt = stream_format()
+    # unchanged since the client's copy: answer 304 before touching patient_history
+    ver = version(conn, 'ph%d%s' % (patient_id, fmt or ''), patient(patient_id), DOCTORS)
+    if ver.fresh():
+        return ver.not_modified()
     # Get patient history records
-    cur.execute('''SELECT ph.id, ph.appointment_id, ph.visit_info, ph.prescription, ph.date,
-                   d.name as doctor_name
-                   FROM patient_history ph
-                   LEFT JOIN users d ON ph.doctor_id = d.id
-                   WHERE ph.patient_id=?
-                   ORDER BY ph.date DESC''', (patient_id,))
+    cur = History.for_patient(conn, patient_id)
+    if fmt:
+        return ver.apply(stream_rows(cur, fmt, 'patient-%d-history' % patient_id))
     history = cur.fetchall()
     conn.close()
-    return jsonify([dict(row) for row in history])
+    return ver.apply(jsonify([dict(row) for row in history]))
+
+@app.route('/api/history/search')
+@flask_login_required
+def api_history_search():
+    # full-text search over visit notes and prescriptions, ranked, with highlighted snippets
+    q = (request.args.get('q') or '').strip()
+    if not q:
+        return jsonify({'success': False, 'message': 'Query required'}), 400
+    limit = min(max(request.args.get('limit', SEARCH_LIMIT, type=int), 1), MAX_SEARCH_LIMIT)
+    role = getattr(current_user, 'role', None)
+    results = search_history(get_db(), q, role, int(current_user.get_id()), limit)
+    return jsonify({'success': True, 'query': q, 'results': results})
 
 @app.route('/api/patient-appointments/<int:patient_id>')
+@negotiated
 @role_required('admin')
 def api_patient_appointments(patient_id):
     conn = get_db()
-    cur = conn.cursor()
-    
+    # ?format=ndjson|csv (or an Accept header) streams straight from the cursor
+    fmt = stream_format()
+    ver = version(conn, 'pa%d%s' % (patient_id, fmt or ''), patient(patient_id), DOCTORS)
+    if ver.fresh():
+        return ver.not_modified()
     # Get patient appointments
-    cur.execute('''SELECT a.id, a.date, a.time, a.status,
-                   d.name as doctor_name
-                   FROM appointments a
-                   LEFT JOIN users d ON a.doctor_id = d.id
-                   WHERE a.patient_id=?
-                   ORDER BY a.date DESC, a.time DESC''', (patient_id,))
+    cur = Appointments.for_patient(conn, patient_id)
+    if fmt:
+        return ver.apply(stream_rows(cur, fmt, 'patient-%d-appointments' % patient_id))
     appointments = cur.fetchall()
     
     conn.close()
-    return jsonify([dict(row) for row in appointments])
+    return ver.apply(jsonify([dict(row) for row in appointments]))
+
+def patient_summaries(conn, ids):
+    # History, appointments and visit aggregates for many patients: one query
+    # per table, however many patients are asked for.
+    return summarize(ids, History.for_patients(conn, ids), Appointments.for_patients(conn, ids))
+
+def summarize(ids, history, appointments):
+    summaries = {pid: {'history': [], 'appointments': [], 'visit_count': 0, 'last_visit': None, 'doctors_seen': []}
+                 for pid in ids}
+    seen = {pid: set() for pid in ids}
+    for row in history:
+        s = summaries[row['patient_id']]
+        s['history'].append(dict(row))
+        s['visit_count'] += 1
+        if s['last_visit'] is None or (row['date'] or '') > s['last_visit']:
+            s['last_visit'] = row['date']
+        if row['doctor_name']:
+            seen[row['patient_id']].add(row['doctor_name'])
+    for row in appointments:
+        summaries[row['patient_id']]['appointments'].append(dict(row))
+        if row['status'] == 'Completed' and row['doctor_name']:
+            seen[row['patient_id']].add(row['doctor_name'])
+    for pid in ids:
+        summaries[pid]['doctors_seen'] = sorted(seen[pid])
+    return summaries
+
+def summary_ids():
+    # ?ids=1,2,3 (or repeated ?id=) -> (ids, None), or (None, error response)
+    raw = ','.join(request.args.getlist('ids') + request.args.getlist('id'))
+    try:
+        ids = list(dict.fromkeys(int(x) for x in raw.split(',') if x.strip()))
+    except ValueError:
+        return None, (jsonify({'success': False, 'message': 'ids must be integers'}), 400)
+    if not ids:
+        return None, (jsonify({'success': False, 'message': 'ids required'}), 400)
+    if len(ids) > app.config['PATIENT_SUMMARY_MAX']:
+        return None, (jsonify({'success': False, 'message': 'At most %d patients per call' % app.config['PATIENT_SUMMARY_MAX']}), 400)
+    return ids, None
+
+@app.route('/api/patient-summary')
+@role_required('admin')
+def api_patient_summary():
+    # ?ids=1,2,3 (or repeated ?id=): everything the patients modal shows, for a whole page at once
+    ids, error = summary_ids()
+    if error:
+        return error
+    conn = get_db()
+    ver = version(conn, 'ps' + '.'.join(map(str, ids)), *[patient(pid) for pid in ids], DOCTORS)
+    if ver.fresh():
+        return ver.not_modified()
+    summaries = patient_summaries(conn, ids)
+    return ver.apply(jsonify({'success': True, 'patients': {str(pid): summaries[pid] for pid in ids}}))
+
+def patients_page(conn, cursor=None, limit=None):
+    return fetch_page(conn, 'SELECT id, name, username FROM users', ('id',),
+                      where='role="patient"', cursor=cursor, limit=limit, desc=False)
 
 @app.route('/admin/patients')
 @role_required('admin')
 def admin_patients():
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM users WHERE role="patient"')
-    pats = cur.fetchall()
-    conn.close()
-    return render_template('admin/patients.html', patients=pats)
+    pats, next_cursor = list_page(patients_page)
+    return render_template('admin/patients.html', patients=pats, next_cursor=next_cursor)
+
+@app.route('/admin/api/patients')
+@role_required('admin')
+def api_admin_patients():
+    rows, next_cursor = list_page(patients_page)
+    return page_json(rows, next_cursor, 'admin/_patient_rows.html')
 
 # Admin - patient history view
+def history_page(conn, patient_id=None, cursor=None, limit=None):
+    # history records with patient and doctor details, newest first
+    return fetch_page(conn, '''SELECT ph.id, ph.appointment_id, ph.visit_info, ph.prescription, ph.date,
+                   p.id as patient_id, p.name as patient_name,
+                   d.id as doctor_id, d.name as doctor_name, d.specialization as doctor_dept
+                   FROM patient_history ph
+                   LEFT JOIN users p ON ph.patient_id = p.id
+                   LEFT JOIN users d ON ph.doctor_id = d.id''',
+                   ('ph.date', 'ph.id'), where='ph.patient_id=?' if patient_id else None,
+                   params=(patient_id,) if patient_id else (), cursor=cursor, limit=limit)
+
 @app.route('/admin/patient-history')
 @role_required('admin')
 def admin_patient_history():
-    patient_id = request.args.get('patient_id')
-    conn = get_db()
-    cur = conn.cursor()
-    if patient_id:
-        cur.execute('''SELECT ph.id, ph.appointment_id, ph.visit_info, ph.prescription, ph.date,
-                       p.id as patient_id, p.name as patient_name,
-                       d.id as doctor_id, d.name as doctor_name, d.specialization as doctor_dept
-                       FROM patient_history ph
-                       LEFT JOIN users p ON ph.patient_id = p.id
-                       LEFT JOIN users d ON ph.doctor_id = d.id
-                       WHERE ph.patient_id=?
-                       ORDER BY ph.date DESC''', (patient_id,))
-    else:
-        cur.execute('''SELECT ph.id, ph.appointment_id, ph.visit_info, ph.prescription, ph.date,
-                       p.id as patient_id, p.name as patient_name,
-                       d.id as doctor_id, d.name as doctor_name, d.specialization as doctor_dept
-                       FROM patient_history ph
-                       LEFT JOIN users p ON ph.patient_id = p.id
-                       LEFT JOIN users d ON ph.doctor_id = d.id
-                       ORDER BY ph.date DESC''')
-    rows = cur.fetchall()
-    conn.close()
-    return render_template('admin/patient_history.html', records=rows)
+    patient_id = request.args.get('patient_id', type=int)
+    rows, next_cursor = list_page(history_page, patient_id)
+    return render_template('admin/patient_history.html', records=rows, next_cursor=next_cursor, patient_id=patient_id)
+
+@app.route('/admin/api/patient-history')
+@role_required('admin')
+def api_admin_patient_history():
+    rows, next_cursor = list_page(history_page, request.args.get('patient_id', type=int))
+    return page_json(rows, next_cursor, 'admin/_history_rows.html')
 
 # API: add or edit history (doctors + admin)
 @app.route('/api/patient-history', methods=['POST'])
@@ -375,13 +606,16 @@ def api_patient_history_add_edit():
     doctor_id = data.get('doctor_id')
     visit_info = data.get('visit_info')
     prescription = data.get('prescription')
-    date = data.get('date')
+    # records are listed by date, so a missing date defaults to today
+    date = data.get('date') or datetime.now().strftime(DATE_FMT)
+    try:
+        date = datetime.strptime(date, DATE_FMT).strftime(DATE_FMT)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'date must be YYYY-MM-DD'}), 400
     conn = get_db()
-    cur = conn.cursor()
     # If creating a new history entry, ensure appointment exists and its time has passed (unless already marked Completed)
     if not rec_id and appointment_id:
-        cur.execute('SELECT * FROM appointments WHERE id=?', (appointment_id,))
-        appt = cur.fetchone()
+        appt = Appointments.get(conn, appointment_id)
         if not appt:
             conn.close()
             return jsonify({'success': False, 'message': 'Appointment not found'}), 400
@@ -392,22 +626,8 @@ def api_patient_history_add_edit():
         # allow if appointment already Completed
         status = appt['status'] if 'status' in appt.keys() else None
         if status != 'Completed':
-            # parse appointment date/time — supports 'DD/MM/YYYY' or 'YYYY-MM-DD'
-            appt_date = appt['date'] if 'date' in appt.keys() else ''
-            appt_time = appt['time'] if 'time' in appt.keys() else '00:00'
-            try:
-                if '/' in appt_date:
-                    dparts = appt_date.split('/')
-                    appt_dt = datetime(int(dparts[2]), int(dparts[1]), int(dparts[0]), int(appt_time.split(':')[0]), int(appt_time.split(':')[1]))
-                else:
-                    # assume ISO format
-                    dtstr = appt_date
-                    if 'T' in dtstr:
-                        appt_dt = datetime.fromisoformat(dtstr)
-                    else:
-                        # combine date and time
-                        appt_dt = datetime.strptime(dtstr + ' ' + appt_time, '%Y-%m-%d %H:%M')
-            except Exception:
+            appt_dt = parse_slot(appt['date'], appt['time'])
+            if appt_dt is None:
                 # if parsing fails, deny to be safe
                 conn.close()
                 return jsonify({'success': False, 'message': 'Invalid appointment datetime'}), 400
@@ -415,25 +635,17 @@ def api_patient_history_add_edit():
                 conn.close()
                 return jsonify({'success': False, 'message': 'Cannot add history before appointment time'}), 400
 
-    if rec_id:
-        # update
-        cur.execute('UPDATE patient_history SET visit_info=?, prescription=?, date=? WHERE id=?', (visit_info, prescription, date, rec_id))
-        res_id = rec_id
-    else:
-        cur.execute('INSERT INTO patient_history (appointment_id, patient_id, doctor_id, visit_info, prescription, date) VALUES (?,?,?,?,?,?)', (appointment_id, patient_id, doctor_id, visit_info, prescription, date))
-        res_id = cur.lastrowid
-    conn.commit()
+    def save(cur):
+        if rec_id:
+            # update
+            History.update(cur, rec_id, visit_info, prescription, date)
+            return rec_id
+        return History.add(cur, appointment_id, patient_id, doctor_id, visit_info, prescription, date)
+
+    res_id = write(conn, save)
     conn.close()
     return jsonify({'success': True, 'id': res_id})
 
-def add_doctor_patient_relation(conn, doctor_id, patient_id):
-    cur = conn.cursor()
-    try:
-        cur.execute('INSERT INTO doctor_patient (doctor_id, patient_id) VALUES (?,?)', (doctor_id, patient_id))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass
-
 # Allow doctors to create new patients (AJAX)
 @app.route('/doctor/add-patient', methods=['POST'])
 @role_required('doctor')
@@ -445,26 +657,101 @@ def doctor_add_patient():
     if not name or not username or not password:
         return jsonify({'success': False, 'message': 'Missing fields'}), 400
     conn = get_db()
-    cur = conn.cursor()
+    pwhash = hasher.hash(password)
+    doctor_id = session['user_id']
+
+    def create(cur):
+        new_id = Users.create(cur, name, username, pwhash, 'patient')
+        # create doctor-patient relation (same transaction)
+        Relations.add(cur, doctor_id, new_id)
+        return new_id
+
     try:
-        cur.execute('INSERT INTO users (name, username, password, role) VALUES (?,?,?,?)', (name, username, generate_password_hash(password), 'patient'))
-        conn.commit()
-        new_id = cur.lastrowid
+        new_id = write(conn, create)
     except sqlite3.IntegrityError:
         conn.close()
         return jsonify({'success': False, 'message': 'Username already exists'}), 400
-    # create doctor-patient relation
-    add_doctor_patient_relation(conn, session['user_id'], new_id)
     conn.close()
     return jsonify({'success': True, 'id': new_id, 'message': 'Patient created'})
 
 
-# Doctor availability management removed — availability derived from booking status
+# Weekly slot template and dated exceptions of one doctor (the doctor or an admin).
+# POST {"weekly": [{"weekday": 0, "start": "09:00", "end": "17:00", "slot_minutes": 30}, ...],
+#       "exceptions": [{"date": "2026-12-25"}, {"date": "...", "start": ..., "end": ..., "slot_minutes": ...}]}
+# replaces whichever of the two is given and regenerates the doctor's slots.
+@app.route('/api/doctor/<int:doctor_id>/slot-template', methods=['GET', 'POST'])
+@flask_login_required
+def api_slot_template(doctor_id):
+    role = getattr(current_user, 'role', None)
+    if role != 'admin' and not (role == 'doctor' and int(current_user.get_id()) == doctor_id):
+        return jsonify({'success': False, 'message': 'Forbidden'}), 403
+    conn = get_db()
+    if reference.get(conn).doctor(doctor_id) is None:
+        conn.close()
+        return jsonify({'success': False, 'message': 'Doctor not found'}), 404
+    if request.method == 'POST':
+        try:
+            weekly, exceptions = parse_template(request.get_json(silent=True) or {})
+        except ValueError as exc:
+            conn.close()
+            return jsonify({'success': False, 'message': str(exc)}), 400
+
+        def save(cur):
+            Slots.replace_template(cur, doctor_id, weekly, exceptions)
+            return materialize(cur, Date.today(), app.config['SLOT_HORIZON_DAYS'], [doctor_id])
+        write(conn, save)
+    weekly, exceptions = Slots.template(conn, doctor_id)
+    default = not weekly
+    if default:
+        weekly = Slots.template(conn, 0)[0]
+    conn.close()
+    return jsonify({'success': True, 'default': default,
+                    'weekly': [{'weekday': r['weekday'], 'start': r['start_time'], 'end': r['end_time'],
+                                'slot_minutes': r['slot_minutes']} for r in weekly],
+                    'exceptions': [{'date': r['date'], 'start': r['start_time'], 'end': r['end_time'],
+                                    'slot_minutes': r['slot_minutes']} for r in exceptions]})
+
+# The earliest open slots across every doctor of a specialization, strictly after
+# ?after=YYYY-MM-DD[THH:MM] (default and lower bound: now); ?cursor= continues
+# from the previous response's next_cursor.
+@app.route('/api/availability/earliest')
+@flask_login_required
+def api_earliest_availability():
+    specialization = request.args.get('specialization') or 'General'
+    limit = min(max(request.args.get('limit', app.config['EARLIEST_SLOTS_LIMIT'], type=int), 1),
+                app.config['EARLIEST_SLOTS_MAX'])
+    now = datetime.now()
+    after = (now.strftime(DATE_FMT), now.strftime('%H:%M'), None)
+    try:
+        if request.args.get('cursor'):
+            cursor = decode_cursor(request.args['cursor'])
+            if [type(v) for v in cursor] != [str, str, int]:
+                raise ValueError('invalid cursor')
+            after = max(after, tuple(cursor), key=lambda key: key[:2])
+        elif request.args.get('after'):
+            value = request.args['after']
+            start = datetime.strptime(value, DATE_FMT + ('T%H:%M' if 'T' in value else ''))
+            # a bare date means the whole day
+            after = max(after, (start.strftime(DATE_FMT), start.strftime('%H:%M') if 'T' in value else '', None),
+                        key=lambda key: key[:2])
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid after or cursor'}), 400
+    conn = get_db()
+    ref = reference.get(conn)
+    doctor_ids = [d['id'] for d in ref.doctors if (d['specialization'] or 'General') == specialization]
+    slots, next_cursor = earliest_slots(conn, doctor_ids, after, limit)
+    conn.close()
+    return jsonify({'success': True, 'specialization': specialization, 'next_cursor': next_cursor,
+                    'items': [{'date': day, 'time': t, 'end_time': end_time, 'doctor_id': doctor_id,
+                               'doctor_name': ref.doctor(doctor_id)['name']}
+                              for day, t, doctor_id, end_time in slots]})
+
+# Doctor availability management removed; see /api/doctor/<id>/slot-template
 @app.route('/doctor/availability', methods=['GET','POST','DELETE'])
 @role_required('doctor')
 def doctor_availability():
     # This endpoint is intentionally disabled. Availability is no longer managed by doctors.
-    return jsonify({'success': False, 'message': 'Doctor-managed availability removed. System derives availability from booked slots.'}), 410
+    return jsonify({'success': False, 'message': 'Doctor-managed availability removed. Use /api/doctor/<id>/slot-template.'}), 410
 
 @app.route('/admin/api/doctor/blacklist', methods=['GET','POST'])
 @role_required('admin')
@@ -472,10 +759,10 @@ def api_doctor_blacklist():
     conn = get_db()
     cur = conn.cursor()
     if request.method == 'GET':
-        cur.execute('SELECT name, username, specialization FROM blacklisted_doctors')
-        rows = cur.fetchall()
-        conn.close()
-        return jsonify({'success': True, 'blacklist': [dict(x) for x in rows]})
+        ver = version(conn, 'bl', BLACKLIST)
+        if ver.fresh():
+            return ver.not_modified()
+        return ver.apply(jsonify({'success': True, 'blacklist': reference.get(conn).blacklist}))
     data = request.get_json() or request.form
     name = data.get('name')
     username = data.get('username')
@@ -483,12 +770,12 @@ def api_doctor_blacklist():
     if not username or not name:
         conn.close()
         return jsonify({'success': False, 'message': 'Missing fields'}), 400
-    cur.execute('SELECT * FROM blacklisted_doctors WHERE username=? AND name=? AND specialization=?', (username, name, specialization))
-    if cur.fetchone():
+    if reference.get(conn).is_blacklisted(username, name, specialization):
         conn.close()
         return jsonify({'success': False, 'message': 'Already blacklisted'})
     cur.execute('INSERT INTO blacklisted_doctors (name, username, specialization) VALUES (?,?,?)', (name, username, specialization))
     conn.commit()
+    reference_changed('blacklist')
     conn.close()
     return jsonify({'success': True, 'message': 'Blacklisted', 'entry': {'name': name, 'username': username, 'specialization': specialization}})
 
@@ -507,10 +794,11 @@ def api_doctor_edit():
     if not name or not username:
         return jsonify({'success': False, 'message': 'Missing fields'}), 400
     conn = get_db()
-    cur = conn.cursor()
     try:
-        cur.execute('UPDATE users SET name=?, username=?, specialization=?, experience=? WHERE id=?', (name, username, specialization, experience, doc_id))
+        Users.update_doctor(conn, doc_id, name, username, specialization, experience)
         conn.commit()
+        identity_cache.invalidate(doc_id)
+        reference_changed('doctors')
     except sqlite3.IntegrityError:
         conn.close()
         return jsonify({'success': False, 'message': 'Username already exists'}), 400
@@ -526,31 +814,42 @@ def api_doctor_delete():
     except Exception:
         return jsonify({'success': False, 'message': 'Invalid id'}), 400
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('DELETE FROM users WHERE id=?', (doc_id,))
+    Users.delete(conn, doc_id)
     conn.commit()
+    identity_cache.invalidate(doc_id)
+    reference_changed('doctors')
+    # drops the free slots; booked ones stay with their appointments
+    refresh_slots(conn, doc_id)
     conn.close()
     return jsonify({'success': True, 'message': 'Deleted'})
 
 # Doctor
+def doctor_dashboard_page(conn, doctor_id, cursor=None, limit=None):
+    # the doctor's appointments in date order, with the latest history record
+    # if any (one row per appointment, so the keyset stays unique)
+    return fetch_page(conn, '''SELECT a.id, a.date, a.time, a.status, p.id as patient_id, p.name as patient_name,
+                   (SELECT ph.id FROM patient_history ph WHERE ph.appointment_id = a.id
+                    ORDER BY ph.id DESC LIMIT 1) as history_id
+                   FROM appointments a
+                   LEFT JOIN users p ON a.patient_id = p.id''',
+                   ('a.date', 'a.time', 'a.id'), where='a.doctor_id=?', params=(doctor_id,),
+                   cursor=cursor, limit=limit, desc=False)
+
 @app.route('/doctor')
 @role_required('doctor')
 def doctor_dashboard():
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('''SELECT a.id, a.date, a.time, a.status, p.id as patient_id, p.name as patient_name,
-                   ph.id as history_id
-                   FROM appointments a
-                   LEFT JOIN users p ON a.patient_id = p.id
-                   LEFT JOIN patient_history ph ON ph.appointment_id = a.id
-                   WHERE a.doctor_id=?
-                   ORDER BY a.date, a.time''', (session['user_id'],))
-    appts = cur.fetchall()
+    appts, next_cursor = list_page(doctor_dashboard_page, session['user_id'])
     # fetch recent patients for sidebar (most recent 20)
-    cur.execute('SELECT id, name, username FROM users WHERE role="patient" ORDER BY id DESC LIMIT 20')
-    pats = cur.fetchall()
+    pats = Users.recent_patients(conn)
     conn.close()
-    return render_template('doctor/dashboard.html', appts=appts, patients=pats)
+    return render_template('doctor/dashboard.html', appts=appts, patients=pats, next_cursor=next_cursor)
+
+@app.route('/api/doctor/appointments')
+@role_required('doctor')
+def api_doctor_appointments():
+    rows, next_cursor = list_page(doctor_dashboard_page, session['user_id'])
+    return page_json(rows, next_cursor, 'doctor/_appointment_rows.html')
 
 
 @app.route('/api/history/<int:appointment_id>')
@@ -558,18 +857,17 @@ def doctor_dashboard():
 def api_history_by_appointment(appointment_id):
     # Ensure appointment belongs to logged-in doctor
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT doctor_id FROM appointments WHERE id=?', (appointment_id,))
-    ap = cur.fetchone()
-    if not ap or ap['doctor_id'] != session['user_id']:
+    if Appointments.doctor_of(conn, appointment_id) != session['user_id']:
         conn.close()
         return jsonify({'error': 'Not found'}), 404
-    cur.execute('SELECT * FROM patient_history WHERE appointment_id=?', (appointment_id,))
-    row = cur.fetchone()
+    ver = version(conn, 'ha%d' % appointment_id, appointment(appointment_id))
+    if ver.fresh():
+        return ver.not_modified()
+    row = History.by_appointment(conn, appointment_id)
     conn.close()
     if not row:
         return jsonify({}), 404
-    return jsonify(dict(row))
+    return ver.apply(jsonify(dict(row)))
 
 
 @app.route('/doctor/schedule')
@@ -577,61 +875,16 @@ def api_history_by_appointment(appointment_id):
 def doctor_schedule():
     doctor_id = session['user_id']
     conn = get_db()
-    cur = conn.cursor()
 
     # fetch all appointments for this doctor (to show upcoming/past)
-    cur.execute('''SELECT a.id, a.date, a.time, a.status, p.id as patient_id, p.name as patient_name
-                   FROM appointments a
-                   LEFT JOIN users p ON a.patient_id = p.id
-                   WHERE a.doctor_id=?
-                   ORDER BY a.date DESC, a.time DESC''', (doctor_id,))
-    appts = cur.fetchall()
-
-    # Generate 7 days of availability (excluding Sundays), starting from today
-    today = datetime.now()
-    availability = []
-    current_date = today
-    days_added = 0
-    while days_added < 7:
-        # Skip Sundays (weekday() returns 6 for Sunday)
-        if current_date.weekday() != 6:
-            date_str = current_date.strftime('%d/%m/%Y')
-
-            # Use fixed default slots; availability is simply whether a slot is already booked or not
-            default_slots = [('08:00','12:00'), ('04:00','09:00')]
-            avail_times = [s[0] for s in default_slots]
-
-            # Get booked slots for this date with patient info
-            cur.execute('SELECT id, time, patient_id FROM appointments WHERE doctor_id=? AND date=? AND status="Booked"', (doctor_id, date_str))
-            booked_rows = cur.fetchall()
-            booked = {row['time']: {'appt_id': row['id'], 'patient_id': row['patient_id']} for row in booked_rows}
-
-            day_slots = []
-            for t in avail_times:
-                if t in booked:
-                    appt_info = booked[t]
-                    pid = appt_info.get('patient_id')
-                    appt_id = appt_info.get('appt_id')
-                    pname = None
-                    if pid:
-                        cur2 = conn.cursor()
-                        cur2.execute('SELECT name FROM users WHERE id=?', (pid,))
-                        pr = cur2.fetchone()
-                        pname = pr['name'] if pr else None
-                    # determine end_time from defaults
-                    end_time = next((de for ds, de in default_slots if ds == t), '')
-                    day_slots.append({'time': t, 'end_time': end_time, 'available': False, 'patient_id': pid, 'patient_name': pname, 'appt_id': appt_id})
-                else:
-                    end_time = next((de for ds, de in default_slots if ds == t), '')
-                    day_slots.append({'time': t, 'end_time': end_time, 'available': True})
-
-            if day_slots:
-                availability.append({'date': date_str, 'slots': day_slots})
-            days_added += 1
-        current_date += timedelta(days=1)
+    appts = Appointments.schedule(conn, doctor_id)
+
+    # availability for the coming working days (days off skipped), starting from today
+    days = horizon(request.args.get('days'), app.config['AVAILABILITY_DAYS'])
+    availability = build_availability(conn, doctor_id, datetime.now(), days, with_patients=True)
 
     conn.close()
-    return render_template('doctor/schedule.html', availability=availability, appointments=appts)
+    return render_template('doctor/schedule.html', availability=availability, appointments=appts, days=days)
 
 @app.route('/doctor/complete/<int:appt_id>', methods=['POST'])
 @role_required('doctor')
@@ -639,9 +892,9 @@ def doctor_complete(appt_id):
     diagnosis = request.form.get('diagnosis','')
     prescription = request.form.get('prescription','')
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('UPDATE appointments SET status="Completed", diagnosis=?, prescription=? WHERE id=?', (diagnosis, prescription, appt_id))
-    conn.commit()
+    patient_id = write(conn, lambda c: Appointments.complete(c, appt_id, diagnosis, prescription))
+    if patient_id is not None:
+        fragments.invalidate('patient:%d' % patient_id)
     conn.close()
     return redirect(url_for('doctor_dashboard'))
 
@@ -650,20 +903,19 @@ def doctor_complete(appt_id):
 @role_required('patient')
 def patient_dashboard():
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM users WHERE role="doctor"')
-    doctors = cur.fetchall()
-    cur.execute('SELECT a.*, d.name as doctor_name FROM appointments a LEFT JOIN users d ON a.doctor_id=d.id WHERE a.patient_id=? ORDER BY a.date, a.time', (session['user_id'],))
-    appts = cur.fetchall()
-    conn.close()
-    return render_template('patient/dashboard.html', doctors=doctors, appts=appts)
+    patient_id = session['user_id']
+    ref = reference.get(conn)
+    # the appointments query only runs if the cached table is stale
+    appts = Deferred(lambda: Appointments.dashboard(conn, patient_id))
+    appts_version = version(conn, 'pd%d' % patient_id, patient(patient_id), DOCTORS).etag
+    return render_template('patient/dashboard.html', doctors=ref.doctors, ref_version=ref.stamp, appts=appts,
+                           appts_version=appts_version, patient_id=patient_id)
 
 
 @app.route('/patient/profile', methods=['GET','POST'])
 @role_required('patient')
 def patient_profile():
     conn = get_db()
-    cur = conn.cursor()
     if request.method == 'POST':
         name = (request.form.get('name') or '').strip()
         username = (request.form.get('username') or '').strip()
@@ -672,23 +924,19 @@ def patient_profile():
             flash('Name and username required')
             return redirect(url_for('patient_profile'))
         # ensure username uniqueness
-        cur.execute('SELECT id FROM users WHERE username=? AND id<>?', (username, session['user_id']))
-        if cur.fetchone():
+        if Users.username_taken(conn, username, session['user_id']):
             flash('Username already taken')
             return redirect(url_for('patient_profile'))
-        if password:
-            cur.execute('UPDATE users SET name=?, username=?, password=? WHERE id=?', (name, username, generate_password_hash(password), session['user_id']))
-        else:
-            cur.execute('UPDATE users SET name=?, username=? WHERE id=?', (name, username, session['user_id']))
+        Users.update_profile(conn, session['user_id'], name, username, hasher.hash(password) if password else None)
         conn.commit()
+        identity_cache.invalidate(session['user_id'])
         # update session username
         session['username'] = username
         flash('Profile updated')
         conn.close()
         return redirect(url_for('patient_dashboard'))
 
-    cur.execute('SELECT * FROM users WHERE id=?', (session['user_id'],))
-    user = cur.fetchone()
+    user = Users.profile(conn, session['user_id'])
     conn.close()
     return render_template('patient/profile.html', user=user)
 
@@ -697,10 +945,8 @@ def patient_profile():
 @role_required('patient')
 def reschedule(appt_id):
     conn = get_db()
-    cur = conn.cursor()
     # ensure appointment belongs to patient
-    cur.execute('SELECT * FROM appointments WHERE id=? AND patient_id=?', (appt_id, session['user_id']))
-    appt = cur.fetchone()
+    appt = Appointments.owned(conn, appt_id, session['user_id'])
     if not appt:
         flash('Appointment not found')
         conn.close()
@@ -712,69 +958,47 @@ def reschedule(appt_id):
         if not new_date or not new_time:
             flash('Date and time required')
             return redirect(url_for('reschedule', appt_id=appt_id))
-        # No availability table check: a slot is available if it's not already booked
-        # check conflict (already booked by other appointment)
-        cur.execute('SELECT * FROM appointments WHERE doctor_id=? AND date=? AND time=? AND status="Booked" AND id<>?', (doctor_id, new_date, new_time, appt_id))
-        if cur.fetchone():
+        if parse_slot(new_date, new_time) is None:
             flash('Selected slot is not available')
             conn.close()
             return redirect(url_for('reschedule', appt_id=appt_id))
-        cur.execute('UPDATE appointments SET date=?, time=? WHERE id=?', (new_date, new_time, appt_id))
-        conn.commit()
+        # the move only goes through into an open slot of the doctor's
+        try:
+            moved = write(conn, lambda c: Appointments.move(c, appt_id, new_date, new_time))
+        except sqlite3.IntegrityError:
+            moved = False
+        except sqlite3.OperationalError as exc:
+            if not is_busy(exc):
+                raise
+            flash('The system is busy, please try again')
+            conn.close()
+            return redirect(url_for('reschedule', appt_id=appt_id))
+        if not moved:
+            flash('Selected slot is not available')
+            conn.close()
+            return redirect(url_for('reschedule', appt_id=appt_id))
+        fragments.invalidate('patient:%d' % session['user_id'])
         conn.close()
         flash('Appointment rescheduled')
         return redirect(url_for('patient_dashboard'))
 
     # prepare availability similar to booking page
-    cur.execute('SELECT * FROM users WHERE id=?', (doctor_id,))
-    doctor = cur.fetchone()
-    # Build availability from availability table for next 7 days
-    today = datetime.now()
-    availability = []
-    current_date = today + timedelta(days=1)
-    days_added = 0
-    while days_added < 7:
-        if current_date.weekday() != 6:
-            date_str = current_date.strftime('%d/%m/%Y')
-            # get availability entries for this doctor/date
-            cur.execute('SELECT time_slot FROM availability WHERE doctor_id=? AND date=?', (doctor_id, date_str))
-            avail_times = [row[0] for row in cur.fetchall()]
-            default_slots = [('08:00','12:00'),('04:00','09:00')]
-            if not avail_times:
-                avail_times = [s[0] for s in default_slots]
-            # get booked slots
-            cur.execute('SELECT time FROM appointments WHERE doctor_id=? AND date=? AND status="Booked"', (doctor_id, date_str))
-            booked_slots = set(row[0] for row in cur.fetchall())
-            day_slots = []
-            for t in avail_times:
-                is_available = t not in booked_slots
-                # match end_time from default slots
-                end_time = ''
-                for ds, de in default_slots:
-                    if ds == t:
-                        end_time = de
-                        break
-                day_slots.append({'time': t, 'end_time': end_time, 'available': is_available})
-            if day_slots:
-                availability.append({'date': date_str, 'date_obj': current_date, 'slots': day_slots})
-            days_added += 1
-        current_date += timedelta(days=1)
+    doctor = reference.get(conn).doctor(doctor_id)
+    days = horizon(request.args.get('days'), app.config['AVAILABILITY_DAYS'])
+    availability = build_availability(conn, doctor_id, datetime.now() + timedelta(days=1), days)
     conn.close()
-    return render_template('patient/reschedule.html', doc=doctor, availability=availability, appt=appt)
+    return render_template('patient/reschedule.html', doc=doctor, availability=availability, appt=appt, days=days)
 
 @app.route('/cancel/<int:appt_id>', methods=['POST'])
 @role_required('patient')
 def cancel(appt_id):
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM appointments WHERE id=? AND patient_id=?', (appt_id, session['user_id']))
-    appt = cur.fetchone()
-    if not appt:
+    if not Appointments.owned(conn, appt_id, session['user_id']):
         flash('Appointment not found')
         conn.close()
         return redirect(url_for('patient_dashboard'))
-    cur.execute('UPDATE appointments SET status="Cancelled" WHERE id=?', (appt_id,))
-    conn.commit()
+    write(conn, lambda c: Appointments.cancel(c, appt_id))
+    fragments.invalidate('patient:%d' % session['user_id'])
     conn.close()
     flash('Appointment cancelled successfully')
     return redirect(url_for('patient_dashboard'))
@@ -785,76 +1009,185 @@ def book(doctor_id):
     if request.method=='POST':
         date = request.form['date']
         time = request.form['time']
+        if parse_slot(date, time) is None:
+            flash('Slot not available')
+            return redirect(url_for('book', doctor_id=doctor_id))
+        patient_id = session['user_id']
         conn = get_db()
-        cur = conn.cursor()
-        # No availability table check: a slot is available if it's not already booked
-        cur.execute('SELECT * FROM appointments WHERE doctor_id=? AND date=? AND time=? AND status="Booked"', (doctor_id, date, time))
-        exists = cur.fetchone()
-        if exists:
+
+        def insert_booking(cur):
+            # only into an open slot of the doctor's; None if there is none
+            appt_id = Appointments.book(cur, doctor_id, patient_id, date, time)
+            if appt_id is not None:
+                # create doctor-patient relation from booking if not exists (same transaction)
+                Relations.add(cur, doctor_id, patient_id)
+            return appt_id
+
+        try:
+            appt_id = write(conn, insert_booking)
+        except sqlite3.IntegrityError:
+            appt_id = None
+        except sqlite3.OperationalError as exc:
+            if not is_busy(exc):
+                raise
+            flash('The system is busy, please try again')
+            conn.close()
+            return redirect(url_for('book', doctor_id=doctor_id))
+        if appt_id is None:
             flash('Slot not available')
             conn.close()
             return redirect(url_for('book', doctor_id=doctor_id))
-        cur.execute('INSERT INTO appointments (doctor_id, patient_id, date, time, status) VALUES (?,?,?,?,?)', (doctor_id, session['user_id'], date, time, 'Booked'))
-        conn.commit()
-        # create doctor-patient relation from booking if not exists
-        add_doctor_patient_relation(conn, doctor_id, session['user_id'])
+        fragments.invalidate('patient:%d' % patient_id)
         flash('Appointment booked successfully!')
         conn.close()
         return redirect(url_for('patient_dashboard'))
     
     conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM users WHERE id=?', (doctor_id,))
-    doctor = cur.fetchone()
-    
-    # Build availability for next 7 days from availability table
-    today = datetime.now()
-    availability = []
-    current_date = today + timedelta(days=1)
-    days_added = 0
-
-    while days_added < 7:
-        # Skip Sundays (weekday() returns 6 for Sunday)
-        if current_date.weekday() != 6:
-            date_str = current_date.strftime('%d/%m/%Y')
-
-            # Use default slots for every date; availability is whether the slot is already booked
-            default_slots = [('08:00','12:00'), ('04:00','09:00')]
-            avail_times = [s[0] for s in default_slots]
-
-            # Get booked slots for this date
-            cur.execute('SELECT time FROM appointments WHERE doctor_id=? AND date=? AND status="Booked"', (doctor_id, date_str))
-            booked_slots = set(row[0] for row in cur.fetchall())
-
-            day_availability = {
-                'date': date_str,
-                'date_obj': current_date,
-                'slots': []
-            }
-
-            for t in avail_times:
-                is_available = t not in booked_slots
-                # find matching default end_time if available
-                end_time = ''
-                for ds, de in default_slots:
-                    if ds == t:
-                        end_time = de
-                        break
-                day_availability['slots'].append({ 'time': t, 'end_time': end_time, 'available': is_available })
-
-            availability.append(day_availability)
-            days_added += 1
-        current_date += timedelta(days=1)
+    doctor = reference.get(conn).doctor(doctor_id)
     
+    # availability for the coming working days; a slot is free unless already booked
+    days = horizon(request.args.get('days'), app.config['AVAILABILITY_DAYS'])
+    availability = build_availability(conn, doctor_id, datetime.now() + timedelta(days=1), days)
     conn.close()
-    return render_template('patient/book.html', doc=doctor, availability=availability, doctor_id=doctor_id)
+    return render_template('patient/book.html', doc=doctor, availability=availability, doctor_id=doctor_id, days=days)
 
-def add_doctor_patient_relation(conn, doctor_id, patient_id):
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM doctor_patient WHERE doctor_id=? AND patient_id=?', (doctor_id, patient_id))
-    if not cur.fetchone():
-        cur.execute('INSERT INTO doctor_patient (doctor_id, patient_id) VALUES (?,?)', (doctor_id, patient_id))
-        conn.commit()
+# Async read path (ASYNC_READS): the read-only JSON APIs as async views that
+# query through aiosqlite on a bounded set of read-only connections
+# (aioreads.py), behind the same login/role decorators. Streamed formats
+# stay on the threaded views: stream_with_context cannot outlive the event
+# loop Flask runs an async view on.
+read_pool = None
+
+@negotiated
+@flask_login_required
+async def api_patient_history_async(patient_id):
+    role = getattr(current_user, 'role', None)
+    uid = int(current_user.get_id())
+    if role == 'patient' and uid != patient_id or role not in ('admin', 'doctor', 'patient'):
+        return jsonify({'success': False, 'message': 'Forbidden'}), 403
+    async with read_pool.connection() as conn:
+        if role == 'doctor':
+            related = await conn.fetchone(Relations.RELATED, (uid, patient_id, uid, patient_id))
+            if not related[0]:
+                return jsonify({'success': False, 'message': 'Forbidden'}), 403
+        ver = await version_async(conn, 'ph%d' % patient_id, patient(patient_id), DOCTORS)
+        if ver.fresh():
+            return ver.not_modified()
+        rows = await conn.execute_fetchall(History.PATIENT, (patient_id,))
+    return ver.apply(jsonify([dict(row) for row in rows]))
+
+@negotiated
+@role_required('admin')
+async def api_patient_appointments_async(patient_id):
+    async with read_pool.connection() as conn:
+        ver = await version_async(conn, 'pa%d' % patient_id, patient(patient_id), DOCTORS)
+        if ver.fresh():
+            return ver.not_modified()
+        rows = await conn.execute_fetchall(Appointments.PATIENT, (patient_id,))
+    return ver.apply(jsonify([dict(row) for row in rows]))
+
+@role_required('doctor')
+async def api_history_by_appointment_async(appointment_id):
+    async with read_pool.connection() as conn:
+        ap = await conn.fetchone(Appointments.DOCTOR, (appointment_id,))
+        if not ap or ap['doctor_id'] != session['user_id']:
+            return jsonify({'error': 'Not found'}), 404
+        ver = await version_async(conn, 'ha%d' % appointment_id, appointment(appointment_id))
+        if ver.fresh():
+            return ver.not_modified()
+        row = await conn.fetchone(History.BY_APPOINTMENT, (appointment_id,))
+    if not row:
+        return jsonify({}), 404
+    return ver.apply(jsonify(dict(row)))
+
+@role_required('admin')
+async def api_patient_summary_async():
+    ids, error = summary_ids()
+    if error:
+        return error
+    async with read_pool.connection() as conn:
+        ver = await version_async(conn, 'ps' + '.'.join(map(str, ids)), *[patient(pid) for pid in ids], DOCTORS)
+        if ver.fresh():
+            return ver.not_modified()
+        summaries = summarize(ids, await conn.execute_fetchall(History.PATIENTS, (id_list(ids),)),
+                              await conn.execute_fetchall(Appointments.PATIENTS, (id_list(ids),)))
+    return ver.apply(jsonify({'success': True, 'patients': {str(pid): summaries[pid] for pid in ids}}))
+
+# endpoint: (threaded view, async view)
+READ_VIEWS = {
+    'api_patient_history': (api_patient_history, api_patient_history_async),
+    'api_patient_appointments': (api_patient_appointments, api_patient_appointments_async),
+    'api_history_by_appointment': (api_history_by_appointment, api_history_by_appointment_async),
+    'api_patient_summary': (api_patient_summary, api_patient_summary_async),
+}
+
+def async_read(threaded, async_view):
+    @wraps(threaded)
+    def view(*args, **kwargs):
+        if stream_format():
+            return threaded(*args, **kwargs)
+        return async_view(*args, **kwargs)
+    return view
+
+def use_async_reads(enabled=True):
+    # switch the read-only JSON endpoints between the threaded and async views
+    global read_pool
+    if enabled and read_pool is None:
+        read_pool = AsyncReadPool(app.config['DB_PATH'], app.config['ASYNC_READ_CONNECTIONS'],
+                                  statement_cache=app.config['DB_STATEMENT_CACHE'])
+    for endpoint, (threaded, async_view) in READ_VIEWS.items():
+        app.view_functions[endpoint] = async_read(threaded, async_view) if enabled else threaded
+
+if app.config['ASYNC_READS']:
+    use_async_reads()
+
+def create_app(config=None):
+    # The app for a server process, with HMS_SECRET_KEY / HMS_DB_PATH and
+    # `config` applied and every component that reads them set up again.
+    # Routes are registered at import, so this configures the process's one
+    # app; main.py calls it in each worker after forking.
+    global identity_cache, reference, hasher, read_pool, writer, slot_generator
+    if os.environ.get('HMS_SECRET_KEY'):
+        app.secret_key = os.environ['HMS_SECRET_KEY']
+    if os.environ.get('HMS_DB_PATH'):
+        app.config['DB_PATH'] = os.environ['HMS_DB_PATH']
+    app.config.update(config or {})
+    db.configure(app)
+    identity_cache = IdentityCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+    reference = ReferenceCache(app.config['REFERENCE_CHECK_INTERVAL'])
+    fragments.max_bytes = app.config['FRAGMENT_CACHE_BYTES']
+    fragments.clear()
+    hasher.shutdown(wait=False)
+    hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_HASH_WORKERS'],
+                            app.config['PASSWORD_HASH_QUEUE'])
+    writer.shutdown(wait=False)
+    writer = GroupCommitWriter(lambda: db.connect(pooled=False), app.config['GROUP_COMMIT_BATCH'],
+                               app.config['GROUP_COMMIT_QUEUE'])
+    slot_generator.shutdown()
+    slot_generator = SlotGenerator(lambda: db.connect(pooled=False), app.config['SLOT_HORIZON_DAYS'],
+                                   app.config['SLOT_CHECK_INTERVAL'])
+    if read_pool is not None:
+        read_pool.close()
+        read_pool = None
+    use_async_reads(app.config['ASYNC_READS'])
+    return app
+
+def warm_up():
+    # worker start-up: open the pooled connections, load the reference data and
+    # bring the slots up to date before the first request has to
+    db.prefill()
+    slot_generator.ensure_started()
+    with app.app_context():
+        reference.get(get_db())
+
+def shutdown_app():
+    # after the server has stopped: finish queued hashing and writes, close connections
+    hasher.shutdown()
+    writer.shutdown()
+    slot_generator.shutdown()
+    db.close_all()
+    if read_pool is not None:
+        read_pool.close()
 
 if __name__ == '__main__':
     app.run(debug=True)
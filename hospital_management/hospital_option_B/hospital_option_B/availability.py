@@ -0,0 +1,82 @@
+import heapq
+from datetime import datetime
+from itertools import islice
+from pagination import encode_cursor
+from repository import Slots
+
+# Appointment dates are stored as ISO 'YYYY-MM-DD' and times as 'HH:MM', so
+# plain string comparison orders them chronologically.
+DATE_FMT = '%Y-%m-%d'
+
+# horizons the booking/schedule pages may ask for, in days
+HORIZONS = (7, 30, 90)
+
+# earliest_slots(): rows read per doctor at first, doubling up to the maximum
+EARLIEST_FIRST_PAGE = 2
+EARLIEST_MAX_PAGE = 64
+
+
+def horizon(value, default=7):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return value if value in HORIZONS else default
+
+
+def build_availability(conn, doctor_id, start=None, days=7, with_patients=False):
+    # Slot grid for one doctor over the first `days` dates from `start` that have
+    # slots. The slots are materialized from the doctor's template (slots.py), so
+    # this is one range read on the slots primary key whatever the horizon;
+    # with_patients joins the patient name into that same query.
+    rows = Slots.availability(conn, doctor_id, (start or datetime.now()).strftime(DATE_FMT), days, with_patients)
+    availability = []
+    for row in rows:
+        if not availability or availability[-1]['date'] != row['date']:
+            availability.append({'date': row['date'], 'date_obj': datetime.strptime(row['date'], DATE_FMT), 'slots': []})
+        if row['appointment_id'] is None:
+            slot = {'time': row['time'], 'end_time': row['end_time'], 'available': True}
+        else:
+            slot = {'time': row['time'], 'end_time': row['end_time'], 'available': False,
+                    'appt_id': row['appointment_id'], 'patient_id': row['patient_id']}
+            if with_patients:
+                slot['patient_name'] = row['patient_name']
+        availability[-1]['slots'].append(slot)
+    return availability
+
+
+def open_slots(conn, doctor_id, date, time, inclusive=False, first=None):
+    # one doctor's open slots after (date, time) as (date, time, doctor_id,
+    # end_time) in order, read lazily in pages that start small and double.
+    # `first` is a prefetched first open slot on or after (date, time).
+    if first is not None:
+        if inclusive or first[:2] != (date, time):
+            yield first[0], first[1], doctor_id, first[2]
+        date, time, inclusive = first[0], first[1], False
+    page = EARLIEST_FIRST_PAGE
+    while True:
+        rows = Slots.open_after(conn, doctor_id, date, time, page, inclusive)
+        for row in rows:
+            yield row[0], row[1], doctor_id, row[2]
+        if len(rows) < page:
+            return
+        date, time, inclusive = rows[-1][0], rows[-1][1], False
+        page = min(page * 2, EARLIEST_MAX_PAGE)
+
+
+def earliest_slots(conn, doctor_ids, after, limit):
+    # The `limit` earliest open slots of any of doctor_ids, strictly after the
+    # (date, time, doctor_id) key `after` (doctor_id None: after date and time
+    # for every doctor). One statement finds every doctor's first open slot and
+    # seeds heapq.merge with it; only the doctors whose slots are taken from
+    # the heap are read further, a short primary-key range at a time, and the
+    # merge stops at `limit`. Returns (slots, next_cursor); next_cursor is None
+    # when there are no more.
+    date, time, after_doctor = after
+    merged = heapq.merge(*(open_slots(conn, doctor_id, date, time, after_doctor is not None and doctor_id > after_doctor, first)
+                           for doctor_id, first in Slots.first_open(conn, doctor_ids, date, time)))
+    slots = list(islice(merged, limit + 1))
+    if len(slots) <= limit:
+        return slots, None
+    slots = slots[:limit]
+    return slots, encode_cursor(slots[-1][:3])
@@ -0,0 +1,90 @@
+# Python-side cost of the hot read routes: time, peak memory allocated while
+# serving one request (tracemalloc) and bytes fetched from SQLite into rows.
+# The fragment cache is off unless --fragments, so every request runs its
+# queries. Usage: python bench/allocations.py [--db /tmp/big.db] [--requests 200]
+import argparse, logging, sqlite3, time, tracemalloc
+
+from common import make_app, client_for, percentile
+from routes import ROUTES, SMALL, sample
+from database import seed
+
+HOT = ('patient_dashboard', 'patient_profile', 'patient_reschedule_page', 'admin_doctors', 'admin_patients',
+       'admin_patient_summary', 'doctor_dashboard', 'doctor_history_by_appt', 'doctor_history_api', 'doctor_schedule')
+
+
+def fetched_bytes(appmod):
+    # wrap the cursor fetches to add up the size of the values they return
+    from db import InstrumentedCursor
+    total = [0]
+    fetch = InstrumentedCursor._fetch
+
+    def counting(self, fn, *args):
+        rows = fetch(self, fn, *args)
+        for row in rows if isinstance(rows, list) else [rows] if rows is not None else []:
+            total[0] += sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in row)
+        return rows
+    InstrumentedCursor._fetch = counting
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='existing (seeded) database; default: a fresh small one')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--fragments', action='store_true', help='keep the fragment cache on')
+    args = parser.parse_args()
+
+    appmod, db_path = make_app(args.db) if args.db else make_app()
+    if not args.db:
+        seed.seed(db_path, **SMALL)
+    app = appmod.app
+    app.config['FRAGMENT_CACHE_ENABLED'] = args.fragments
+    app.logger.setLevel(logging.ERROR)  # the slow-query log
+    ids, _ = sample(db_path)
+    users = {'admin': ids['admin'], 'doctor': ids['doctor'], 'patient': ids['patient']}
+    fetched = fetched_bytes(appmod)
+    print('%-26s %9s %9s %11s %12s' % ('route', 'p50 ms', 'mean ms', 'peak KB', 'fetched KB'))
+    for name, role, method, path, body in ROUTES:
+        if name not in HOT:
+            continue
+        client = client_for(app, users[role])
+        url = path.format(**ids)
+        client.get(url)  # warm up
+        peaks = []
+        fetched[0] = 0
+        tracemalloc.start()
+        for _ in range(args.requests):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            r = client.get(url)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+            assert r.status_code == 200, (name, r.status_code)
+        tracemalloc.stop()
+        fetched_kb = fetched[0] / args.requests / 1024
+        # time without the tracemalloc overhead
+        plain = []
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            client.get(url)
+            plain.append((time.perf_counter() - started) * 1000)
+        print('%-26s %9.2f %9.2f %11.1f %12.1f' % (name, percentile(plain, 50), sum(plain) / len(plain),
+              sum(peaks) / len(peaks) / 1024, fetched_kb))
+
+    # patient summaries for 1..100 ids at a time: one statement per table, or
+    # one per list length if the ids are spliced in as placeholders
+    client = client_for(app, users['admin'])
+    pids = [r[0] for r in sqlite3.connect(db_path).execute("SELECT id FROM users WHERE role='patient' LIMIT 100")]
+    urls = ['/api/patient-summary?ids=' + ','.join(map(str, pids[:n])) for n in range(1, len(pids) + 1)]
+    for url in urls:
+        client.get(url)
+    plain = []
+    for _ in range(3):
+        for url in urls:
+            started = time.perf_counter()
+            client.get(url)
+            plain.append((time.perf_counter() - started) * 1000)
+    print('%-26s %9.2f %9.2f' % ('summary, 1..%d ids' % len(pids), percentile(plain, 50), sum(plain) / len(plain)))
+
+
+if __name__ == '__main__':
+    main()
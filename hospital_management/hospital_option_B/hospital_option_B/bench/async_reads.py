@@ -0,0 +1,109 @@
+# Concurrent throughput of the read-only JSON APIs, threaded views vs the
+# async (aiosqlite) views, served over HTTP by a server with a fixed number of
+# worker threads (like gunicorn's gthread worker) while patients load the
+# booking page. Needs aiosqlite and asgiref.
+# Usage: python bench/async_reads.py [--db /tmp/big.db] [--threads 8] [--readers 16]
+#        [--bookers 4] [--seconds 5] [--connections 4]
+import argparse, http.client, logging, sqlite3, threading, time
+
+from common import make_app, percentile
+from main import PooledServer
+from database import seed
+
+SMALL = {'doctors': 20, 'patients': 2000, 'appointments': 50000, 'history': 20000}
+
+
+def targets(db_path):
+    # read requests (as admin and as the treating doctor) and the booking page a patient loads
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('''SELECT appointment_id, patient_id, doctor_id FROM patient_history
+                           ORDER BY id DESC LIMIT 50''').fetchall()
+    admin = conn.execute("SELECT MIN(id) FROM users WHERE role='admin'").fetchone()[0]
+    pids = ','.join(str(r[1]) for r in rows[:20])
+    conn.close()
+    reads = []
+    for appt, pid, doctor in rows:
+        reads += [(admin, '/api/patient-history/%d' % pid), (admin, '/api/patient-appointments/%d' % pid),
+                  (doctor, '/api/history/%d' % appt), (doctor, '/api/patient-history/%d' % pid)]
+    reads.append((admin, '/api/patient-summary?ids=' + pids))
+    bookings = [(pid, '/book/%d' % doctor) for _, pid, doctor in rows]
+    return reads, bookings
+
+
+def cookie_for(app, user_id):
+    # a session cookie as Flask-Login would set it, signed with the app's key
+    value = app.session_interface.get_signing_serializer(app).dumps({'_user_id': str(user_id), '_fresh': True})
+    return '%s=%s' % (app.config['SESSION_COOKIE_NAME'], value)
+
+
+def hammer(port, requests, stop, out, offset):
+    i = offset
+    while not stop.is_set():
+        cookie, path = requests[i % len(requests)]
+        i += 1
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        conn.request('GET', path, headers={'Cookie': cookie})
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        out.append((time.perf_counter() - started, resp.status))
+
+
+def run(app, port, reads, bookings, readers, bookers, seconds):
+    stop = threading.Event()
+    read_out, book_out = [], []
+    threads = [threading.Thread(target=hammer, args=(port, reads, stop, read_out, i * 7)) for i in range(readers)]
+    threads += [threading.Thread(target=hammer, args=(port, bookings, stop, book_out, i * 3)) for i in range(bookers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return read_out, book_out
+
+
+def report(label, samples, seconds):
+    times = sorted(t * 1000 for t, _ in samples)
+    errors = sum(1 for _, status in samples if status >= 500)
+    print('  %-9s %7.1f req/s  p50 %7.2f ms  p99 %8.2f ms  %d errors'
+          % (label, len(samples) / seconds, percentile(times, 50), percentile(times, 99), errors))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='existing (seeded) database; default: a fresh small one')
+    parser.add_argument('--threads', type=int, default=8, help='server worker threads')
+    parser.add_argument('--readers', type=int, default=16, help='concurrent clients polling the JSON APIs')
+    parser.add_argument('--bookers', type=int, default=4, help='concurrent clients loading the booking page')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--connections', type=int, default=4, help='ASYNC_READ_CONNECTIONS')
+    args = parser.parse_args()
+
+    appmod, db_path = make_app(args.db) if args.db else make_app()
+    if not args.db:
+        seed.seed(db_path, **SMALL)
+    app = appmod.app
+    app.config['ASYNC_READ_CONNECTIONS'] = args.connections
+    reads, bookings = targets(db_path)
+    reads = [(cookie_for(app, uid), path) for uid, path in reads]
+    bookings = [(cookie_for(app, uid), path) for uid, path in bookings]
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = PooledServer('127.0.0.1', 0, app, args.threads)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('%d server threads, %d readers, %d bookers, %.0fs per mode'
+          % (args.threads, args.readers, args.bookers, args.seconds))
+    for mode in ('threaded', 'async'):
+        appmod.use_async_reads(mode == 'async')
+        run(app, server.port, reads, bookings, args.readers, args.bookers, 1)  # warm up
+        read_out, book_out = run(app, server.port, reads, bookings, args.readers, args.bookers, args.seconds)
+        print(mode)
+        report('reads', read_out, args.seconds)
+        report('booking', book_out, args.seconds)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
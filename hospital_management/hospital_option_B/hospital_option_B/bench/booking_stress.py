@@ -0,0 +1,60 @@
+# Throughput of many simultaneous bookings at one doctor slot, and how the
+# connection pool holds up (that exactly one wins is tested in
+# tests/test_booking_race.py). Usage: python bench/booking_stress.py [--threads 300] [--rounds 3]
+import argparse, sqlite3, threading, time
+
+from common import make_app, add_users, client_for, open_slots
+
+
+def run_round(app, db_path, doctor_id, clients, date, slot):
+    barrier = threading.Barrier(len(clients))
+    results = [None] * len(clients)
+
+    def worker(i, c):
+        barrier.wait()
+        r = c.post('/book/%d' % doctor_id, data={'date': date, 'time': slot}, follow_redirects=False)
+        # success redirects to the patient dashboard, a conflict back to the booking page
+        results[i] = r.headers.get('Location', '')
+
+    threads = [threading.Thread(target=worker, args=(i, c)) for i, c in enumerate(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    conn = sqlite3.connect(db_path)
+    booked = conn.execute('SELECT COUNT(*) FROM appointments WHERE doctor_id=? AND date=? AND time=? AND status="Booked"',
+                          (doctor_id, date, slot)).fetchone()[0]
+    conn.close()
+    wins = sum(1 for loc in results if loc.endswith('/patient'))
+    return wins, booked, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=300)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    appmod, db_path = make_app()
+    app = appmod.app
+    doctor_id = add_users(db_path, 'doctor', 1, prefix='stressdoc')[0]
+    patients = add_users(db_path, 'patient', args.threads, prefix='stresspat')
+    clients = [client_for(app, pid) for pid in patients]
+
+    slots = open_slots(db_path, doctor_id)
+    total_requests, total_time = 0, 0.0
+    for r in range(args.rounds):
+        wins, booked, elapsed = run_round(app, db_path, doctor_id, clients, *slots[r])
+        total_requests += len(clients)
+        total_time += elapsed
+        print('round %d: %d concurrent bookings -> %d won, %d Booked rows, %.3fs (%.0f req/s)'
+              % (r + 1, len(clients), wins, booked, elapsed, len(clients) / elapsed))
+    print('throughput: %.0f booking requests/s over %d requests' % (total_requests / total_time, total_requests))
+    print('connections:', appmod.db.snapshot())
+
+
+if __name__ == '__main__':
+    main()
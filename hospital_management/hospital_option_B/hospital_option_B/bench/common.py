@@ -0,0 +1,116 @@
+# Shared setup for the scripts in bench/: a throwaway database and the Flask
+# app pointed at it. Run the scripts from the project root, e.g.
+#   python bench/booking_stress.py
+import os, sys, sqlite3, tempfile
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from database import create_db
+
+
+def make_app(db_path=None):
+    # returns (app module, db path) with the schema created and migrated
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix='hms-bench-'), 'hms.db')
+    create_db.init_db(db_path)
+    import app as appmod
+    appmod.app.config['DB_PATH'] = db_path
+    appmod.db.close_all()
+    appmod.db.path = db_path
+    return appmod, db_path
+
+
+def add_users(db_path, role, count, prefix=None, password_hash='x'):
+    # bulk-insert users and return their ids (password hashes are not usable for login)
+    prefix = prefix or role
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    start = cur.execute('SELECT COALESCE(MAX(id), 0) FROM users').fetchone()[0]
+    cur.executemany('INSERT INTO users (name, username, password, role) VALUES (?,?,?,?)',
+                    [('%s %d' % (prefix, start + i), '%s%d' % (prefix, start + i), password_hash, role) for i in range(count)])
+    conn.commit()
+    ids = [r[0] for r in cur.execute('SELECT id FROM users WHERE id>? ORDER BY id', (start,))]
+    conn.close()
+    return ids
+
+
+def open_slots(db_path, doctor_id, days=None, slot_minutes=None):
+    # the doctor's open slots from tomorrow, in order, materialized first
+    # (slots.py); with slot_minutes the doctor gets a template of that slot
+    # length over 08:00-18:00 every day, for benches that need many slots
+    from slots import DEFAULT_HORIZON, materialize
+    from repository import Slots
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    if slot_minutes:
+        Slots.replace_template(cur, doctor_id, [(d, '08:00', '18:00', slot_minutes) for d in range(7)])
+    materialize(cur, date.today(), days or DEFAULT_HORIZON, [doctor_id])
+    conn.commit()
+    rows = conn.execute('''SELECT date, time FROM slots WHERE doctor_id=? AND date>? AND appointment_id IS NULL
+                           ORDER BY date, time''', (doctor_id, date.today().strftime('%Y-%m-%d'))).fetchall()
+    conn.close()
+    return [(r['date'], r['time']) for r in rows]
+
+
+def client_for(app, user_id):
+    # test client already logged in as user_id, without going through the password check
+    c = app.test_client()
+    with c.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    return c
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(pct / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+# transaction control the group-commit writer runs around each batch and job
+# (writer.py); it is shared by every write in a batch, not part of a route
+TRANSACTION_CONTROL = ('BEGIN', 'SAVEPOINT', 'RELEASE', 'COMMIT', 'ROLLBACK')
+
+
+class StatementCounter:
+    # counts the statements the app executes (an executemany counts once),
+    # leaving out the PRAGMAs a new connection is set up with and the writer
+    # connection's transaction control. A sqlite3 trace
+    # callback over-counts: each trigger program that fires is reported as its
+    # outer statement again, so a write to a table with stats, search and
+    # generation triggers looked like half a dozen statements.
+    def __init__(self):
+        self.count = 0
+
+    def counts(self, conn, sql):
+        if sql.startswith('PRAGMA'):
+            return False
+        # the writer's connection is the app's one unpooled connection during requests
+        return conn.manager is not None or not sql.lstrip().upper().startswith(TRANSACTION_CONTROL)
+
+
+def count_statements(appmod):
+    # count from now on what every app connection executes, through the cursor
+    # class they all use (db.InstrumentedCursor); replaces an earlier counter
+    from db import InstrumentedCursor
+    counter = StatementCounter()
+
+    def counted(fn):
+        fn = getattr(fn, '__wrapped__', fn)
+
+        def wrapped(cursor, sql, params=()):
+            if counter.counts(cursor.connection, sql):
+                counter.count += 1
+            return fn(cursor, sql, params)
+        wrapped.__wrapped__ = fn
+        return wrapped
+    InstrumentedCursor.execute = counted(InstrumentedCursor.execute)
+    InstrumentedCursor.executemany = counted(InstrumentedCursor.executemany)
+    return counter
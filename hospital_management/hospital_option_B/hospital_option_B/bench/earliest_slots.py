@@ -0,0 +1,85 @@
+# /api/availability/earliest for one specialization with many doctors: the
+# heap merge over per-doctor slot ranges (availability.earliest_slots) against
+# a single query ordering every open slot of the specialization, and against
+# what a patient did before (a week of availability per doctor page). Most
+# doctors are booked out for the first --booked-days, so the merge has to page
+# past their taken slots. Usage:
+#   python bench/earliest_slots.py [--doctors 300] [--booked-days 14] [--requests 200]
+import argparse, logging, sqlite3, time
+from datetime import date, datetime, timedelta
+
+from common import make_app, add_users, client_for, count_statements, percentile
+from availability import DATE_FMT, build_availability, earliest_slots
+from repository import Slots
+from slots import materialize
+
+SPECIALIZATION = 'Bench'
+SINGLE_QUERY = '''SELECT s.date, s.time, s.doctor_id, s.end_time FROM slots s JOIN users u ON u.id = s.doctor_id
+                  WHERE u.specialization=? AND s.appointment_id IS NULL AND (s.date, s.time) > (?, ?)
+                  ORDER BY s.date, s.time, s.doctor_id LIMIT ?'''
+
+
+def timed(fn, requests):
+    times = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - started) * 1000)
+    return '   p50 %7.2f ms  p99 %7.2f ms' % (percentile(times, 50), percentile(times, 99))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--doctors', type=int, default=300)
+    parser.add_argument('--booked-days', type=int, default=14, help='days booked out for 9 in 10 doctors')
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    appmod, db_path = make_app()
+    app = appmod.app
+    app.logger.setLevel(logging.ERROR)  # the slow-query log
+    doctors = add_users(db_path, 'doctor', args.doctors, prefix='earlydoc')
+    patient = add_users(db_path, 'patient', 1, prefix='earlypat')[0]
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    cur.execute('UPDATE users SET specialization=? WHERE id IN (%s)' % ','.join(map(str, doctors)), (SPECIALIZATION,))
+    # half the doctors work 15 minute slots, the rest keep the clinic default
+    for doctor_id in doctors[::2]:
+        Slots.replace_template(cur, doctor_id, [(d, '09:00', '17:00', 15) for d in range(6)])
+    materialize(cur, date.today(), 120, doctors)
+    until = (date.today() + timedelta(days=args.booked_days)).strftime(DATE_FMT)
+    busy = [d for i, d in enumerate(doctors) if i % 10]
+    cur.execute('''INSERT INTO appointments (doctor_id, patient_id, date, time, status)
+                   SELECT doctor_id, ?, date, time, 'Booked' FROM slots
+                   WHERE doctor_id IN (%s) AND date <= ?''' % ','.join(map(str, busy)), (patient, until))
+    conn.commit()
+    open_count = conn.execute('SELECT COUNT(*) FROM slots WHERE appointment_id IS NULL').fetchone()[0]
+    print('%d doctors, %d booked out for %d days, %d open slots' % (len(doctors), len(busy), args.booked_days, open_count))
+
+    now = datetime.now()
+    after = (now.strftime(DATE_FMT), now.strftime('%H:%M'), None)
+    for limit in (10, 50):
+        print('limit %d' % limit)
+        print('  heap merge           ' + timed(lambda: earliest_slots(conn, doctors, after, limit), args.requests))
+        print('  single query         ' + timed(lambda: conn.execute(SINGLE_QUERY, (SPECIALIZATION,) + after[:2] + (limit,)).fetchall(),
+                                                args.requests))
+        merged = [tuple(s) for s in earliest_slots(conn, doctors, after, limit)[0]]
+        single = [tuple(r) for r in conn.execute(SINGLE_QUERY, (SPECIALIZATION,) + after[:2] + (limit,))]
+        assert merged == single, 'heap merge and single query disagree'
+
+    counter = count_statements(appmod)
+    client = client_for(app, patient)
+    url = '/api/availability/earliest?specialization=%s&limit=10' % SPECIALIZATION
+    client.get(url)
+    before = counter.count
+    print('  endpoint, limit 10   ' + timed(lambda: client.get(url), args.requests)
+          + '  %d statements' % ((counter.count - before) // args.requests))
+    start = datetime.now() + timedelta(days=1)
+    print('  a week per doctor    ' + timed(lambda: [build_availability(conn, d, start, 7) for d in doctors], 5))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
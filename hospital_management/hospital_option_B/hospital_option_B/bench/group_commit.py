@@ -0,0 +1,104 @@
+# Write throughput with GROUP_COMMIT on (one writer thread, concurrent writes
+# committed together) and off (each request commits on its own connection).
+# "direct" runs the booking transaction through app.write() from N threads;
+# "routes" posts to /book/<doctor> through the Flask test client. Every write
+# takes a distinct slot, except that --conflicts of them target a taken one.
+# Usage: python bench/group_commit.py [--threads 16] [--writes 2000] [--synchronous NORMAL|FULL]
+import argparse, itertools, logging, sqlite3, threading, time
+
+from common import make_app, add_users, client_for, open_slots, percentile
+from db import DEFAULT_PRAGMAS
+from repository import Appointments, Relations
+
+
+def run(label, make_writer, threads, writes, conflicts, slot_iter):
+    lock = threading.Lock()
+    taken = next(slot_iter)
+    plan = [taken if i % (writes // conflicts) == 0 else next(slot_iter) for i in range(writes)] if conflicts else \
+        [next(slot_iter) for _ in range(writes)]
+    jobs = iter(plan)
+    times, results = [], []
+
+    def worker():
+        with lock:
+            write, close = make_writer()
+        while True:
+            with lock:
+                slot = next(jobs, None)
+            if slot is None:
+                break
+            started = time.perf_counter()
+            ok = write(slot)
+            times.append(time.perf_counter() - started)
+            results.append(ok)
+        close()
+
+    ts = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    elapsed = time.perf_counter() - started
+    ms = sorted(t * 1000 for t in times)
+    print('  %-22s %7.0f writes/s  p50 %6.2f ms  p99 %7.2f ms  %d ok  %d conflicts'
+          % (label, len(times) / elapsed, percentile(ms, 50), percentile(ms, 99), sum(results), len(results) - sum(results)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=2000)
+    parser.add_argument('--conflicts', type=int, default=20, help='writes aimed at an already booked slot')
+    parser.add_argument('--synchronous', default='NORMAL', help='PRAGMA synchronous (FULL fsyncs every commit)')
+    args = parser.parse_args()
+
+    appmod, db_path = make_app()
+    app = appmod.app
+    app.logger.setLevel(logging.ERROR)  # per-request BEGIN IMMEDIATE waits trip the slow-query log
+    app.config['DB_PRAGMAS'] = tuple((k, args.synchronous if k == 'synchronous' else v) for k, v in DEFAULT_PRAGMAS)
+    appmod.db.pragmas = app.config['DB_PRAGMAS']
+    doctor_id = add_users(db_path, 'doctor', 1, prefix='gcdoc')[0]
+    patients = add_users(db_path, 'patient', args.threads, prefix='gcpat')
+    # four runs of --writes bookings, each into a slot of its own (30 minute slots, 20 a day)
+    slot_iter = iter(open_slots(db_path, doctor_id, days=4 * args.writes // 20 + 2, slot_minutes=30))
+    print('%d threads, %d writes per run, synchronous=%s' % (args.threads, args.writes, args.synchronous))
+
+    for group in (False, True):
+        app.config['GROUP_COMMIT'] = group
+        mode = 'group commit' if group else 'per-request'
+
+        def book_direct():
+            conn = appmod.db.connect(pooled=False)
+            patient_id = patients[0]
+
+            def write(slot):
+                def book(cur):
+                    if Appointments.book(cur, doctor_id, patient_id, *slot) is None:
+                        return False
+                    Relations.add(cur, doctor_id, patient_id)
+                    return True
+                try:
+                    return appmod.write(conn, book)
+                except sqlite3.IntegrityError:
+                    return False
+            return write, conn.close
+
+        clients = itertools.cycle(patients)
+
+        def book_route():
+            client = client_for(app, next(clients))
+
+            def write(slot):
+                r = client.post('/book/%d' % doctor_id, data={'date': slot[0], 'time': slot[1]})
+                # success redirects to the patient dashboard, a conflict back to the booking page
+                return r.headers.get('Location', '').endswith('/patient')
+            return write, lambda: None
+
+        run('direct, ' + mode, book_direct, args.threads, args.writes, args.conflicts, slot_iter)
+        run('routes, ' + mode, book_route, args.threads, args.writes, args.conflicts, slot_iter)
+    print('writer:', appmod.writer.snapshot())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Login burst next to ordinary traffic: reports logins/s and the latency of
+# other routes with and without the burst.
+# Usage: python bench/login_burst.py [--logins 16] [--others 4] [--seconds 5]
+#        [--workers 2] [--queue 32] [--legacy-hashes]
+import argparse, threading, time
+from werkzeug.security import generate_password_hash
+
+from common import make_app, add_users, client_for, percentile
+
+# what logged-in patients do meanwhile (doctor 2 is the seeded sample doctor)
+OTHER_ROUTES = ('/patient', '/patient/profile', '/book/2', '/api/history/search?q=fever')
+
+
+def hammer(fn, stop, out):
+    while not stop.is_set():
+        started = time.perf_counter()
+        status = fn()
+        out.append((time.perf_counter() - started, status))
+
+
+def run(app, seconds, patients, other_clients, login_threads):
+    stop = threading.Event()
+    logins, others = [], []
+    threads = []
+    for i in range(login_threads):
+        c = app.test_client()
+        username = 'burstpat%d' % patients[i % len(patients)]
+
+        def login(c=c, username=username):
+            return c.post('/login', data={'username': username, 'password': 'secret'}).status_code
+        threads.append(threading.Thread(target=hammer, args=(login, stop, logins)))
+    for i, c in enumerate(other_clients):
+        route = OTHER_ROUTES[i % len(OTHER_ROUTES)]
+
+        def other(c=c, route=route):
+            return c.get(route).status_code
+        threads.append(threading.Thread(target=hammer, args=(other, stop, others)))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return logins, others
+
+
+def report(label, logins, others, seconds):
+    ok = sum(1 for _, s in logins if s == 302)
+    busy = sum(1 for _, s in logins if s == 503)
+    lat = [d * 1000 for d, _ in others]
+    errors = sum(1 for _, s in others if s != 200)
+    print('%-9s logins: %6.1f/s ok, %d rejected busy | other routes: %6.0f req/s, p50 %.1f ms, p99 %.1f ms, %d non-200'
+          % (label, ok / seconds, busy, len(others) / seconds, percentile(lat, 50), percentile(lat, 99), errors))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--logins', type=int, default=16, help='concurrent login threads')
+    parser.add_argument('--others', type=int, default=4, help='concurrent threads on other routes')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=2, help='password hashing pool size')
+    parser.add_argument('--queue', type=int, default=32, help='max queued hashing jobs')
+    parser.add_argument('--legacy-hashes', action='store_true',
+                        help='seed users with old pbkdf2 parameters to exercise rehash-on-login')
+    args = parser.parse_args()
+
+    appmod, db_path = make_app()
+    hasher = appmod.hasher
+    hasher.__init__(hasher.method, args.workers, args.queue)
+    method = 'pbkdf2:sha256:260000' if args.legacy_hashes else hasher.method
+    pwhash = generate_password_hash('secret', method)
+    patients = add_users(db_path, 'patient', max(args.logins, 1), prefix='burstpat', password_hash=pwhash)
+    other_clients = [client_for(appmod.app, patients[i % len(patients)]) for i in range(args.others)]
+
+    _, others = run(appmod.app, args.seconds, patients, other_clients, 0)
+    report('baseline', [], others, args.seconds)
+    logins, others = run(appmod.app, args.seconds, patients, other_clients, args.logins)
+    report('burst', logins, others, args.seconds)
+    print('hasher:', hasher.snapshot())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+# Per-route latency and query counts for every role, through the Flask test
+# client. Results go to a JSON baseline that later runs can be diffed against.
+#   python bench/routes.py --out bench/baseline.json            (small seeded db)
+#   python bench/routes.py --db /tmp/big.db --out big.json      (see database/seed.py)
+#   python bench/routes.py --db /tmp/big.db --compare big.json [--tolerance 20]
+# Runs against the database in place: the write routes book and cancel one
+# free slot of the sampled doctor and rewrite one history record with its own values.
+import argparse, json, platform, sqlite3, sys, time
+from datetime import datetime
+
+from common import make_app, client_for, count_statements, open_slots, percentile
+from database import seed
+
+SMALL = {'doctors': 20, 'patients': 2000, 'appointments': 50000, 'history': 20000}
+
+# (name, role, method, path, request body as test-client kwargs); {placeholders}
+# come from sample()
+ROUTES = [
+    ('index', None, 'GET', '/', None),
+    ('login_page', None, 'GET', '/login', None),
+    ('register_page', None, 'GET', '/register', None),
+    ('login', None, 'POST', '/login', {'data': {'username': '{patient_username}', 'password': 'password'}}),
+    ('admin_dashboard', 'admin', 'GET', '/admin', None),
+    ('admin_doctors', 'admin', 'GET', '/admin/doctors', None),
+    ('admin_db_stats', 'admin', 'GET', '/admin/api/db-stats', None),
+    ('admin_stats', 'admin', 'GET', '/admin/stats', None),
+    ('admin_appointments', 'admin', 'GET', '/admin/appointments', None),
+    ('admin_api_appointments', 'admin', 'GET', '/admin/api/appointments', None),
+    ('admin_doctor_appointments', 'admin', 'GET', '/admin/doctor/{doctor}/appointments', None),
+    ('admin_api_doctor_appointments', 'admin', 'GET', '/admin/api/doctor/{doctor}/appointments', None),
+    ('admin_patients', 'admin', 'GET', '/admin/patients', None),
+    ('admin_api_patients', 'admin', 'GET', '/admin/api/patients', None),
+    ('admin_patient_history', 'admin', 'GET', '/admin/patient-history', None),
+    ('admin_api_patient_history', 'admin', 'GET', '/admin/api/patient-history?patient_id={patient}', None),
+    ('admin_patient_appointments', 'admin', 'GET', '/api/patient-appointments/{patient}', None),
+    ('admin_history_api', 'admin', 'GET', '/api/patient-history/{patient}', None),
+    ('admin_patient_summary', 'admin', 'GET', '/api/patient-summary?ids={patient}', None),
+    ('admin_blacklist', 'admin', 'GET', '/admin/api/doctor/blacklist', None),
+    ('admin_add_doctor_page', 'admin', 'GET', '/admin/add-doctor', None),
+    ('admin_search', 'admin', 'GET', '/api/history/search?q=metformin', None),
+    ('doctor_dashboard', 'doctor', 'GET', '/doctor', None),
+    ('doctor_api_appointments', 'doctor', 'GET', '/api/doctor/appointments', None),
+    ('doctor_schedule', 'doctor', 'GET', '/doctor/schedule', None),
+    ('doctor_schedule_90', 'doctor', 'GET', '/doctor/schedule?days=90', None),
+    ('doctor_history_by_appt', 'doctor', 'GET', '/api/history/{history_appt}', None),
+    ('doctor_history_api', 'doctor', 'GET', '/api/patient-history/{patient}', None),
+    ('doctor_search', 'doctor', 'GET', '/api/history/search?q=fever', None),
+    ('doctor_edit_history', 'doctor', 'POST', '/api/patient-history',
+     {'json': {'id': '{history_id}', 'visit_info': '{history_visit}', 'prescription': '{history_rx}', 'date': '{history_date}'}}),
+    ('patient_dashboard', 'patient', 'GET', '/patient', None),
+    ('patient_profile', 'patient', 'GET', '/patient/profile', None),
+    ('patient_book_page', 'patient', 'GET', '/book/{doctor}', None),
+    ('patient_book_page_30', 'patient', 'GET', '/book/{doctor}?days=30', None),
+    ('patient_earliest', 'patient', 'GET', '/api/availability/earliest?specialization={specialization}', None),
+    ('patient_reschedule_page', 'patient', 'GET', '/reschedule/{appt}', None),
+    ('patient_history_api', 'patient', 'GET', '/api/patient-history/{patient}', None),
+    ('patient_search', 'patient', 'GET', '/api/history/search?q=paracetamol', None),
+    ('patient_book', 'patient', 'POST', '/book/{doctor}', {'data': {'date': '{free_date}', 'time': '{free_time}'}}),
+    ('patient_cancel', 'patient', 'POST', '/cancel/{booked_appt}', None),
+]
+
+
+def sample(db_path):
+    # the doctor with the most appointments, and that doctor's busiest patient
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    doctor = conn.execute('''SELECT doctor_id FROM appointments GROUP BY doctor_id
+                             ORDER BY COUNT(*) DESC LIMIT 1''').fetchone()[0]
+    patient = conn.execute('''SELECT patient_id FROM appointments WHERE doctor_id=? GROUP BY patient_id
+                              ORDER BY COUNT(*) DESC LIMIT 1''', (doctor,)).fetchone()[0]
+    appt = conn.execute('''SELECT id FROM appointments WHERE doctor_id=? AND patient_id=?
+                           ORDER BY status='Booked' DESC, date DESC LIMIT 1''', (doctor, patient)).fetchone()[0]
+    hist = conn.execute('SELECT * FROM patient_history WHERE doctor_id=? ORDER BY id DESC LIMIT 1', (doctor,)).fetchone()
+    ids = {r['role']: r['id'] for r in conn.execute("SELECT role, MIN(id) as id FROM users WHERE role='admin' GROUP BY role")}
+    username = conn.execute('SELECT username FROM users WHERE id=?', (patient,)).fetchone()[0]
+    specialization = conn.execute('SELECT specialization FROM users WHERE id=?', (doctor,)).fetchone()[0] or 'General'
+    counts = {t: conn.execute('SELECT COUNT(*) FROM %s' % t).fetchone()[0]
+              for t in ('users', 'appointments', 'patient_history', 'doctor_patient')}
+    conn.close()
+    # the doctor's last open slot, far from the seeded bookings
+    free_date, free_time = open_slots(db_path, doctor)[-1]
+    return {'doctor': doctor, 'patient': patient, 'appt': appt, 'admin': ids['admin'],
+            'patient_username': username, 'specialization': specialization, 'history_appt': hist['appointment_id'] if hist else appt,
+            'history_id': hist['id'] if hist else '', 'history_visit': hist['visit_info'] if hist else '',
+            'history_rx': hist['prescription'] if hist else '', 'history_date': hist['date'] if hist else '',
+            'free_date': free_date, 'free_time': free_time}, counts
+
+
+def fill(value, ctx):
+    if isinstance(value, dict):
+        return {k: fill(v, ctx) for k, v in value.items()}
+    return value.format(**ctx) if isinstance(value, str) else value
+
+
+def booked_appt(db_path, ctx):
+    conn = sqlite3.connect(db_path)
+    row = conn.execute('''SELECT id FROM appointments WHERE doctor_id=? AND patient_id=? AND date=? AND time=?
+                          AND status='Booked' ''', (ctx['doctor'], ctx['patient'], ctx['free_date'], ctx['free_time'])).fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+
+def run(appmod, db_path, ctx, requests, only=None):
+    counter = count_statements(appmod)
+    app = appmod.app
+    clients = {None: app.test_client(), 'admin': client_for(app, ctx['admin']),
+               'doctor': client_for(app, ctx['doctor']), 'patient': client_for(app, ctx['patient'])}
+    results = {}
+    for name, role, method, path, data in ROUTES:
+        if only and name not in only:
+            continue
+        client = clients[role]
+        timings, queries, status = [], [], None
+        for i in range(requests):
+            if name == 'patient_cancel':
+                # book the slot (untimed) so there is something to cancel
+                if not booked_appt(db_path, ctx):
+                    client.post(fill('/book/{doctor}', ctx), data={'date': ctx['free_date'], 'time': ctx['free_time']})
+                ctx['booked_appt'] = booked_appt(db_path, ctx)
+            elif name == 'patient_book':
+                # cancel last round's booking so the slot is free again
+                pending = booked_appt(db_path, ctx)
+                if pending:
+                    client.post('/cancel/%d' % pending)
+            url = fill(path, ctx)
+            kwargs = fill(data, ctx) if data else {}
+            before = counter.count
+            started = time.perf_counter()
+            resp = client.open(url, method=method, **kwargs)
+            timings.append((time.perf_counter() - started) * 1000)
+            queries.append(counter.count - before)
+            status = resp.status_code
+        timings.sort()
+        results[name] = {'role': role, 'method': method, 'path': path, 'status': status,
+                         'p50_ms': round(percentile(timings, 50), 3), 'p90_ms': round(percentile(timings, 90), 3),
+                         'p99_ms': round(percentile(timings, 99), 3), 'mean_ms': round(sum(timings) / len(timings), 3),
+                         'queries': max(queries)}
+        print('%-32s %-7s %3s  p50 %8.2f ms  p99 %8.2f ms  %3d queries'
+              % (name, role or '-', status, results[name]['p50_ms'], results[name]['p99_ms'], results[name]['queries']))
+    return results
+
+
+def compare(current, baseline, tolerance):
+    # prints the per-route change against a baseline; returns the regressions
+    regressions = []
+    print('\n%-32s %12s %12s %9s %9s' % ('route', 'p50 before', 'p50 now', 'change', 'queries'))
+    for name, now in current.items():
+        old = baseline.get(name)
+        if old is None:
+            print('%-32s %12s %10.2fms %9s %9s' % (name, '-', now['p50_ms'], 'new', now['queries']))
+            continue
+        change = (now['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100 if old['p50_ms'] else 0.0
+        queries = '%d->%d' % (old['queries'], now['queries']) if old['queries'] != now['queries'] else str(now['queries'])
+        flag = ''
+        if now['queries'] > old['queries'] or (tolerance is not None and change > tolerance):
+            flag = '  <-- regression'
+            regressions.append(name)
+        print('%-32s %10.2fms %10.2fms %+8.1f%% %9s%s' % (name, old['p50_ms'], now['p50_ms'], change, queries, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='existing (seeded) database; default: a fresh small one')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=50, help='requests per route')
+    parser.add_argument('--route', action='append', help='only run these routes (repeatable)')
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--compare', help='diff against a previous JSON result')
+    parser.add_argument('--tolerance', type=float, help='with --compare: fail if a p50 grows by more than this many percent')
+    args = parser.parse_args()
+
+    if args.db:
+        appmod, db_path = make_app(args.db)
+    else:
+        appmod, db_path = make_app()
+        seed.seed(db_path, seed=args.seed, **SMALL)
+    ctx, counts = sample(db_path)
+    # the slot generator's first pass runs before the first request otherwise
+    appmod.slot_generator.ensure_started()
+    results = run(appmod, db_path, ctx, args.requests, args.route)
+    report = {'meta': {'created': datetime.now().isoformat(timespec='seconds'), 'rows': counts,
+                       'requests': args.requests, 'seed': None if args.db else args.seed,
+                       'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version},
+              'routes': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('wrote', args.out)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['routes']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('%d route(s) regressed: %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
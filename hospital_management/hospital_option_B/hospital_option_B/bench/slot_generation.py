@@ -0,0 +1,64 @@
+# Cost of materializing slot templates (slots.py): a full pass over every
+# doctor for --days days on an empty slots table and again with nothing to
+# change, one doctor after a template edit, and the availability read the
+# booking pages then do. Half the doctors keep the clinic default, half get
+# 15 minute slots 09:00-17:00 Monday to Friday.
+# Usage: python bench/slot_generation.py [--doctors 500] [--days 90]
+import argparse, sqlite3, time
+from datetime import date
+
+from common import make_app, add_users, percentile
+from availability import build_availability
+from repository import Slots
+from slots import materialize
+
+
+def timed(conn, fn):
+    started = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE')
+    result = fn(conn.cursor())
+    conn.commit()
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--doctors', type=int, default=500)
+    parser.add_argument('--days', type=int, default=90)
+    args = parser.parse_args()
+
+    appmod, db_path = make_app()
+    doctors = add_users(db_path, 'doctor', args.doctors, prefix='slotdoc')
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    for doctor_id in doctors[::2]:
+        Slots.replace_template(cur, doctor_id, [(d, '09:00', '17:00', 15) for d in range(5)])
+    conn.commit()
+    today = date.today()
+    print('%d doctors x %d days' % (len(doctors), args.days))
+
+    count, ms = timed(conn, lambda c: materialize(c, today, args.days))
+    print('  full pass, empty table   %8.1f ms  %d slots written' % (ms, count))
+    count, ms = timed(conn, lambda c: materialize(c, today, args.days))
+    print('  full pass, no changes    %8.1f ms  %d slots written' % (ms, count))
+
+    def edit(c):
+        Slots.replace_template(c, doctors[1], [(d, '10:00', '14:00', 20) for d in range(6)])
+        return materialize(c, today, args.days, [doctors[1]])
+    count, ms = timed(conn, edit)
+    print('  one doctor, new template %8.1f ms  %d slots written' % (ms, count))
+
+    for days in (7, 90):
+        times = []
+        for doctor_id in doctors[:200]:
+            started = time.perf_counter()
+            build_availability(conn, doctor_id, today, days)
+            times.append((time.perf_counter() - started) * 1000)
+        print('  availability, %2d days    p50 %6.3f ms  p99 %6.3f ms' % (days, percentile(times, 50), percentile(times, 99)))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Throughput of the production launcher (main.py) with 1 worker vs N workers:
+# starts main.py as a subprocess on a seeded database and drives the GET
+# routes from bench/routes.py over HTTP with concurrent clients.
+# Usage: python bench/workers.py [--db /tmp/big.db] [--workers 1 4] [--threads 8]
+#        [--clients 32] [--seconds 5]
+import argparse, http.client, logging, os, signal, socket, subprocess, sys, threading, time
+
+from common import ROOT, make_app, percentile
+from routes import ROUTES, SMALL, sample
+from async_reads import cookie_for
+from database import seed
+
+SECRET = 'bench-workers'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def hammer(port, requests, stop, out, offset):
+    i = offset
+    while not stop.is_set():
+        cookie, path = requests[i % len(requests)]
+        i += 1
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        conn.request('GET', path, headers={'Cookie': cookie})
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        out.append((time.perf_counter() - started, resp.status))
+
+
+def drive(port, requests, clients, seconds):
+    stop = threading.Event()
+    out = []
+    threads = [threading.Thread(target=hammer, args=(port, requests, stop, out, i * 5)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return out
+
+
+def run(db_path, workers, threads, requests, clients, seconds):
+    port = free_port()
+    env = dict(os.environ, HMS_DB_PATH=db_path, HMS_SECRET_KEY=SECRET)
+    proc = subprocess.Popen([sys.executable, 'main.py', '--port', str(port), '--workers', str(workers),
+                             '--threads', str(threads)], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port)
+        drive(port, requests, clients, 1)  # warm up every worker
+        out = drive(port, requests, clients, seconds)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        code = proc.wait(60)
+    times = sorted(t * 1000 for t, _ in out)
+    errors = sum(1 for _, status in out if status >= 500)
+    print('  %2d workers %8.1f req/s  p50 %7.2f ms  p99 %8.2f ms  %d errors  (exit %d)'
+          % (workers, len(out) / seconds, percentile(times, 50), percentile(times, 99), errors, code))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='existing (seeded) database; default: a fresh small one')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    parser.add_argument('--threads', type=int, default=8, help='threads per worker')
+    parser.add_argument('--clients', type=int, default=32, help='concurrent clients')
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    appmod, db_path = make_app(args.db) if args.db else make_app()
+    if not args.db:
+        seed.seed(db_path, **SMALL)
+    app = appmod.app
+    app.secret_key = SECRET
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    ids, _ = sample(db_path)
+    users = {None: ids['patient'], 'admin': ids['admin'], 'doctor': ids['doctor'], 'patient': ids['patient']}
+    requests = [(cookie_for(app, users[role]), path.format(**ids))
+                for name, role, method, path, body in ROUTES if method == 'GET']
+    print('%d GET routes, %d clients, %d threads per worker, %.0fs per run'
+          % (len(requests), args.clients, args.threads, args.seconds))
+    for workers in args.workers:
+        run(db_path, workers, args.threads, requests, args.clients, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
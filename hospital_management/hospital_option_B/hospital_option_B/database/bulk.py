@@ -0,0 +1,371 @@
+# Bulk import/export of users, appointments and history, streamed in chunks.
+#   python database/bulk.py import users patients.csv
+#   python database/bulk.py import appointments appts.ndjson --chunk 20000
+#   python database/bulk.py export appointments out.csv --from 2024-01-01 --to 2024-12-31
+#   python database/bulk.py export history -            (NDJSON to stdout)
+# Files are CSV or NDJSON (by extension, or --format). Doctors and patients are
+# referenced by username, so an export can be imported into another database.
+#
+# users:        name, username, password | password_hash, role (patient), specialization, experience
+# appointments: doctor, patient, date, time, status (Booked), diagnosis, prescription
+# history:      patient, doctor, date, visit_info, prescription, appointment_id
+#               (appointment_id is kept only if it is an appointment of the same patient and doctor here)
+import argparse, csv, json, os, sqlite3, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash
+
+try:
+    from database import create_db
+except ImportError:
+    import create_db
+
+CHUNK = 10000
+# rejected rows remembered for the report (all of them are counted)
+MAX_ERRORS = 1000
+ROLES = ('patient', 'doctor', 'admin')
+# patient and doctor of the appointments a chunk of history rows refers to
+LINKED_APPOINTMENTS = 'SELECT id, patient_id, doctor_id FROM appointments WHERE id IN (SELECT value FROM json_each(?))'
+
+EXPORTS = {
+    # password hashes are exported so users can be moved to another database as-is
+    'users': ('''SELECT id, name, username, password as password_hash, role, specialization, experience
+                 FROM users''', None),
+    'appointments': ('''SELECT a.id, d.username as doctor, p.username as patient, a.date, a.time, a.status,
+                        a.diagnosis, a.prescription
+                        FROM appointments a
+                        LEFT JOIN users d ON a.doctor_id = d.id
+                        LEFT JOIN users p ON a.patient_id = p.id''', 'a.date'),
+    'history': ('''SELECT ph.id, ph.appointment_id, p.username as patient, d.username as doctor, ph.date,
+                   ph.visit_info, ph.prescription
+                   FROM patient_history ph
+                   LEFT JOIN users p ON ph.patient_id = p.id
+                   LEFT JOIN users d ON ph.doctor_id = d.id''', 'ph.date'),
+}
+
+
+def _format(path, fmt):
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+
+def read_rows(path, fmt=None):
+    # yields one dict per record without loading the file
+    f = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    try:
+        if _format(path, fmt) == 'csv':
+            for row in csv.DictReader(f):
+                yield {k.strip(): v for k, v in row.items() if k}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _chunks(rows, size):
+    chunk = []
+    for item in rows:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Importer:
+    # Validates rows against in-memory maps (usernames, blacklist, booked
+    # slots) loaded once up front, then writes each chunk with executemany in
+    # one transaction. Rejected rows are reported with their reason instead of
+    # aborting the load, including rows that only fail in the database (a slot
+    # the app booked after self.booked was loaded hits the unique index).
+
+    def __init__(self, conn, hash_method=None, hash_workers=4, log=print):
+        self.conn = conn
+        self.log = log
+        self.hash_method = hash_method
+        self.hash_workers = hash_workers
+        self.inserted = 0
+        self.rejected = 0
+        self.unlinked = 0
+        self.errors = []
+        cur = conn.cursor()
+        self.user_ids = {u: (i, r) for i, u, r in cur.execute('SELECT id, username, role FROM users')}
+        self.blacklist = {(u, n, s or 'General') for n, u, s in cur.execute(
+            'SELECT name, username, specialization FROM blacklisted_doctors')}
+        self.booked = set(cur.execute("SELECT doctor_id, date, time FROM appointments WHERE status='Booked'"))
+
+    def reject(self, line, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, reason))
+
+    def _user(self, username, role):
+        entry = self.user_ids.get((username or '').strip())
+        if entry is None or entry[1] != role:
+            return None
+        return entry[0]
+
+    def _write(self, sql, params, lines, then=None):
+        # One transaction per chunk; `then` is a (sql, fn) pair run for the
+        # inserted rows with fn(row) as its parameters. If a constraint fails the
+        # chunk is rolled back and written again row by row, each in a savepoint,
+        # so only the rows that conflict are rejected.
+        cur = self.conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            cur.executemany(sql, params)
+            if then is not None:
+                cur.executemany(then[0], sorted(set(map(then[1], params))))
+            self.conn.commit()
+            self.inserted += len(params)
+            return
+        except sqlite3.IntegrityError:
+            self.conn.rollback()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            for line, row in zip(lines, params):
+                cur.execute('SAVEPOINT import_row')
+                try:
+                    cur.execute(sql, row)
+                    if then is not None:
+                        cur.execute(then[0], then[1](row))
+                    self.inserted += 1
+                except sqlite3.IntegrityError as exc:
+                    cur.execute('ROLLBACK TO import_row')
+                    self.reject(line, 'conflicts with the database: %s' % exc)
+                cur.execute('RELEASE import_row')
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+
+    def users(self, chunk):
+        valid, lines, plain = [], [], []
+        for line, row in chunk:
+            username = (row.get('username') or '').strip()
+            name = (row.get('name') or '').strip()
+            role = (row.get('role') or 'patient').strip().lower()
+            specialization = (row.get('specialization') or '').strip() or None
+            if not name or not username:
+                self.reject(line, 'name and username required')
+            elif role not in ROLES:
+                self.reject(line, 'unknown role %r' % role)
+            elif username in self.user_ids:
+                self.reject(line, 'username %r already exists' % username)
+            elif role == 'doctor' and (username, name, specialization or 'General') in self.blacklist:
+                self.reject(line, 'doctor %r is blacklisted' % username)
+            elif not row.get('password_hash') and not row.get('password'):
+                self.reject(line, 'password or password_hash required')
+            else:
+                if role == 'doctor' and specialization is None:
+                    specialization = 'General'
+                self.user_ids[username] = (None, role)
+                valid.append([name, username, row.get('password_hash'), role, specialization,
+                              (row.get('experience') or '') if role == 'doctor' else None])
+                lines.append(line)
+                if not row.get('password_hash'):
+                    plain.append((len(valid) - 1, str(row['password'])))
+        if plain:
+            # the KDF dominates a user import; hashlib releases the GIL, so hash on threads
+            with ThreadPoolExecutor(self.hash_workers) as pool:
+                hashes = pool.map(lambda p: generate_password_hash(p, self.hash_method) if self.hash_method
+                                  else generate_password_hash(p), [p for _, p in plain])
+                for (i, _), h in zip(plain, hashes):
+                    valid[i][2] = h
+        if valid:
+            self._write('INSERT INTO users (name, username, password, role, specialization, experience) VALUES (?,?,?,?,?,?)', valid, lines)
+            names = [v[1] for v in valid]
+            for i in range(0, len(names), 500):
+                part = names[i:i + 500]
+                for username, uid, role in self.conn.execute(
+                        'SELECT username, id, role FROM users WHERE username IN (%s)' % ','.join('?' * len(part)), part):
+                    self.user_ids[username] = (uid, role)
+
+    def appointments(self, chunk):
+        valid, lines = [], []
+        for line, row in chunk:
+            doctor = self._user(row.get('doctor'), 'doctor')
+            patient = self._user(row.get('patient'), 'patient')
+            date = _date(row.get('date'))
+            slot = _time(row.get('time'))
+            status = (row.get('status') or 'Booked').strip()
+            if doctor is None:
+                self.reject(line, 'unknown doctor %r' % row.get('doctor'))
+            elif patient is None:
+                self.reject(line, 'unknown patient %r' % row.get('patient'))
+            elif not _valid_date(date) or not _valid_time(slot):
+                self.reject(line, 'bad date/time %r %r' % (row.get('date'), row.get('time')))
+            elif status == 'Booked' and (doctor, date, slot) in self.booked:
+                self.reject(line, 'slot %s %s already booked for %r' % (date, slot, row.get('doctor')))
+            else:
+                if status == 'Booked':
+                    self.booked.add((doctor, date, slot))
+                valid.append((doctor, patient, date, slot, status, row.get('diagnosis') or None,
+                              row.get('prescription') or None))
+                lines.append(line)
+        if valid:
+            self._write('INSERT INTO appointments (doctor_id, patient_id, date, time, status, diagnosis, prescription) VALUES (?,?,?,?,?,?,?)', valid, lines,
+                        ('INSERT OR IGNORE INTO doctor_patient (doctor_id, patient_id) VALUES (?,?)', lambda row: row[:2]))
+
+    def history(self, chunk):
+        valid, lines = [], []
+        for line, row in chunk:
+            doctor = self._user(row.get('doctor'), 'doctor')
+            patient = self._user(row.get('patient'), 'patient')
+            date = _date(row.get('date'))
+            if patient is None:
+                self.reject(line, 'unknown patient %r' % row.get('patient'))
+            elif row.get('doctor') and doctor is None:
+                self.reject(line, 'unknown doctor %r' % row.get('doctor'))
+            elif not _valid_date(date):
+                self.reject(line, 'bad date %r' % row.get('date'))
+            else:
+                valid.append([_int(row.get('appointment_id')), patient, doctor, row.get('visit_info') or '',
+                              row.get('prescription') or '', date])
+                lines.append(line)
+        # appointment ids come from the source database: a record keeps its link
+        # only to an appointment here of the same patient and doctor, otherwise
+        # /api/history/<id> would show it to whoever owns a colliding id
+        ids = sorted({v[0] for v in valid if v[0] is not None})
+        if ids:
+            linked = {r[0]: (r[1], r[2]) for r in self.conn.execute(LINKED_APPOINTMENTS, (json.dumps(ids),))}
+            for v in valid:
+                if v[0] is not None and linked.get(v[0]) != (v[1], v[2]):
+                    v[0] = None
+                    self.unlinked += 1
+        if valid:
+            self._write('INSERT INTO patient_history (appointment_id, patient_id, doctor_id, visit_info, prescription, date) VALUES (?,?,?,?,?,?)', valid, lines)
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _date(value):
+    # ISO dates pass through; DD/MM/YYYY is converted like the schema migration does
+    try:
+        return create_db._iso_date(str(value or '').strip())
+    except ValueError:
+        return None
+
+
+def _time(value):
+    try:
+        return create_db._iso_time(str(value or '').strip())
+    except ValueError:
+        return None
+
+
+def _valid_date(value):
+    return len(value or '') == 10 and value[4] == '-' and value[7] == '-' and value.replace('-', '').isdigit()
+
+
+def _valid_time(value):
+    return len(value or '') == 5 and value[2] == ':' and value.replace(':', '').isdigit()
+
+
+def import_file(db_path, kind, path, fmt=None, chunk=CHUNK, hash_method=None, hash_workers=4, log=print):
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA busy_timeout=5000')
+    importer = Importer(conn, hash_method, hash_workers, log)
+    handle = getattr(importer, kind)
+    started = time.perf_counter()
+    seen = 0
+    for rows in _chunks(enumerate(read_rows(path, fmt), 1), chunk):
+        handle(rows)
+        seen += len(rows)
+        elapsed = time.perf_counter() - started
+        log('%s: %d read, %d inserted, %d rejected (%.0f rows/s)'
+            % (kind, seen, importer.inserted, importer.rejected, seen / elapsed if elapsed else 0))
+    conn.close()
+    return importer, seen, time.perf_counter() - started
+
+
+def export_table(db_path, kind, path, fmt=None, date_from=None, date_to=None, chunk=CHUNK):
+    # one cursor, fetchmany-sized batches: memory stays flat for any table size
+    sql, date_col = EXPORTS[kind]
+    where, params = [], []
+    if date_from and date_col:
+        where.append('%s >= ?' % date_col)
+        params.append(date_from)
+    if date_to and date_col:
+        where.append('%s <= ?' % date_col)
+        params.append(date_to)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    conn = sqlite3.connect(db_path)
+    cur = conn.execute(sql, params)
+    columns = [c[0] for c in cur.description]
+    out = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+    count = 0
+    try:
+        if _format(path, fmt) == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(columns)
+            while True:
+                rows = cur.fetchmany(chunk)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                count += len(rows)
+        else:
+            while True:
+                rows = cur.fetchmany(chunk)
+                if not rows:
+                    break
+                out.writelines(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + '\n' for r in rows)
+                count += len(rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        conn.close()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk import/export for the HMS database')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('kind', choices=('users', 'appointments', 'history'))
+    parser.add_argument('path', help="input/output file, or - for stdin/stdout")
+    parser.add_argument('--db', default=create_db.DB)
+    parser.add_argument('--format', choices=('csv', 'ndjson'))
+    parser.add_argument('--chunk', type=int, default=CHUNK, help='rows per transaction / fetch')
+    parser.add_argument('--hash-method', help='werkzeug method for plain passwords; cheaper methods are upgraded on first login')
+    parser.add_argument('--hash-workers', type=int, default=4)
+    parser.add_argument('--from', dest='date_from', help='export: first date (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='date_to', help='export: last date (YYYY-MM-DD)')
+    parser.add_argument('--errors', type=int, default=20, help='import: rejected rows to print')
+    args = parser.parse_args()
+    if args.action == 'import':
+        log = lambda msg: print(msg, file=sys.stderr)
+        importer, seen, elapsed = import_file(args.db, args.kind, args.path, args.format, args.chunk,
+                                              args.hash_method, args.hash_workers, log)
+        for line, reason in importer.errors[:args.errors]:
+            log('row %d: %s' % (line, reason))
+        log('done: %d inserted, %d rejected of %d rows in %.1fs (%.0f rows/s)'
+            % (importer.inserted, importer.rejected, seen, elapsed, seen / elapsed if elapsed else 0))
+        if importer.unlinked:
+            log('%d history rows imported without their appointment_id (no appointment of that patient and doctor here)'
+                % importer.unlinked)
+        sys.exit(1 if importer.rejected else 0)
+    else:
+        started = time.perf_counter()
+        try:
+            count = export_table(args.db, args.kind, args.path, args.format, args.date_from, args.date_to, args.chunk)
+        except BrokenPipeError:
+            # stdout closed early (e.g. piped into head); keep the exit quiet
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            sys.exit(0)
+        elapsed = time.perf_counter() - started
+        print('exported %d %s rows in %.1fs (%.0f rows/s)' % (count, args.kind, elapsed, count / elapsed if elapsed else 0),
+              file=sys.stderr)
@@ -1,10 +1,388 @@
-import sqlite3, os
+import re, sqlite3, os, sys
+from datetime import date
 from werkzeug.security import generate_password_hash
 BASE = os.path.dirname(__file__)
 DB = os.path.join(BASE, 'hms.db')
 
-def init_db():
-    conn = sqlite3.connect(DB)
+def _iso_date(value):
+    # 'DD/MM/YYYY' (what the booking pages used to write) -> 'YYYY-MM-DD';
+    # anything else that does not parse is left as it is
+    if not value or '/' not in value:
+        return value
+    try:
+        d, m, y = value.split('/')
+        return date(int(y), int(m), int(d)).strftime('%Y-%m-%d')
+    except ValueError:
+        return value
+
+
+def _iso_time(value):
+    # 'H:MM' -> 'HH:MM' so times compare in minutes-since-midnight order
+    if not value or ':' not in value:
+        return value
+    try:
+        h, m = (int(v) for v in value.split(':')[:2])
+    except ValueError:
+        return value
+    return '%02d:%02d' % (h, m)
+
+
+def _migrate_iso_dates(cur):
+    for table, cols in (('appointments', ('date', 'time')), ('patient_history', ('date',)), ('availability', ('date', 'time_slot'))):
+        rows = cur.execute('SELECT id, %s FROM %s' % (', '.join(cols), table)).fetchall()
+        updates, skipped = [], 0
+        for row in rows:
+            new = [_iso_date(row[1])] + [_iso_time(v) for v in row[2:]]
+            if isinstance(new[0], str) and '/' in new[0]:
+                skipped += 1
+            if tuple(new) != tuple(row[1:]):
+                updates.append(tuple(new) + (row[0],))
+        if updates:
+            sets = ', '.join('%s=?' % c for c in cols)
+            cur.executemany('UPDATE %s SET %s WHERE id=?' % (table, sets), updates)
+        if skipped:
+            print('migration 3: %d %s rows have a date that is not DD/MM/YYYY, left as they were' % (skipped, table))
+
+
+STATS_TRIGGERS = '''
+CREATE TRIGGER IF NOT EXISTS stats_users_ai AFTER INSERT ON users BEGIN
+    INSERT INTO stats_counters (kind, key, cnt) VALUES ('role', COALESCE(NEW.role, ''), 1)
+        ON CONFLICT(kind, key) DO UPDATE SET cnt = cnt + 1;
+    INSERT INTO stats_counters (kind, key, cnt) SELECT 'specialization', COALESCE(NEW.specialization, ''), 1 WHERE NEW.role = 'doctor'
+        ON CONFLICT(kind, key) DO UPDATE SET cnt = cnt + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS stats_users_ad AFTER DELETE ON users BEGIN
+    UPDATE stats_counters SET cnt = cnt - 1 WHERE kind = 'role' AND key = COALESCE(OLD.role, '');
+    UPDATE stats_counters SET cnt = cnt - 1 WHERE OLD.role = 'doctor' AND kind = 'specialization' AND key = COALESCE(OLD.specialization, '');
+END;
+CREATE TRIGGER IF NOT EXISTS stats_users_au AFTER UPDATE OF role, specialization ON users BEGIN
+    UPDATE stats_counters SET cnt = cnt - 1 WHERE kind = 'role' AND key = COALESCE(OLD.role, '');
+    INSERT INTO stats_counters (kind, key, cnt) VALUES ('role', COALESCE(NEW.role, ''), 1)
+        ON CONFLICT(kind, key) DO UPDATE SET cnt = cnt + 1;
+    UPDATE stats_counters SET cnt = cnt - 1 WHERE OLD.role = 'doctor' AND kind = 'specialization' AND key = COALESCE(OLD.specialization, '');
+    INSERT INTO stats_counters (kind, key, cnt) SELECT 'specialization', COALESCE(NEW.specialization, ''), 1 WHERE NEW.role = 'doctor'
+        ON CONFLICT(kind, key) DO UPDATE SET cnt = cnt + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS stats_appointments_ai AFTER INSERT ON appointments BEGIN
+    INSERT INTO stats_counters (kind, key, cnt) VALUES ('appointments', '', 1)
+        ON CONFLICT(kind, key) DO UPDATE SET cnt = cnt + 1;
+    INSERT INTO stats_counters (kind, key, cnt) VALUES ('appointment_status', COALESCE(NEW.status, ''), 1)
+        ON CONFLICT(kind, key) DO UPDATE SET cnt = cnt + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS stats_appointments_ad AFTER DELETE ON appointments BEGIN
+    UPDATE stats_counters SET cnt = cnt - 1 WHERE kind = 'appointments' AND key = '';
+    UPDATE stats_counters SET cnt = cnt - 1 WHERE kind = 'appointment_status' AND key = COALESCE(OLD.status, '');
+END;
+CREATE TRIGGER IF NOT EXISTS stats_appointments_au AFTER UPDATE OF status ON appointments BEGIN
+    UPDATE stats_counters SET cnt = cnt - 1 WHERE kind = 'appointment_status' AND key = COALESCE(OLD.status, '');
+    INSERT INTO stats_counters (kind, key, cnt) VALUES ('appointment_status', COALESCE(NEW.status, ''), 1)
+        ON CONFLICT(kind, key) DO UPDATE SET cnt = cnt + 1;
+END;
+'''
+
+def _bump(scope, key, when=None):
+    # trigger statement: advance the (scope, key) generation, creating it at 1
+    cond = '%s IS NOT NULL' % key + (' AND (%s)' % when if when else '')
+    return ("INSERT INTO generations (scope, key, gen, modified) SELECT '%s', %s, 1, CAST(strftime('%%s', 'now') AS INTEGER) WHERE %s\n"
+            "        ON CONFLICT(scope, key) DO UPDATE SET gen = gen + 1, modified = excluded.modified;" % (scope, key, cond))
+
+
+# Per-resource change counters for conditional GETs (ETag / Last-Modified):
+# one per patient (appointments and history), one per appointment (its history
+# record), one for doctor rows (names shown in the patient APIs) and one for
+# the blacklist.
+GENERATION_TRIGGERS = '''
+CREATE TRIGGER IF NOT EXISTS gen_appointments_ai AFTER INSERT ON appointments BEGIN
+    %(new_patient)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_appointments_au AFTER UPDATE ON appointments BEGIN
+    %(new_patient)s
+    %(old_patient)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_appointments_ad AFTER DELETE ON appointments BEGIN
+    %(old_patient_any)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_history_ai AFTER INSERT ON patient_history BEGIN
+    %(new_patient)s
+    %(new_appointment)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_history_au AFTER UPDATE ON patient_history BEGIN
+    %(new_patient)s
+    %(old_patient)s
+    %(new_appointment)s
+    %(old_appointment)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_history_ad AFTER DELETE ON patient_history BEGIN
+    %(old_patient_any)s
+    %(old_appointment_any)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_users_ai AFTER INSERT ON users WHEN NEW.role = 'doctor' BEGIN
+    %(doctors)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_users_au AFTER UPDATE OF name, username, role, specialization, experience ON users
+    WHEN NEW.role = 'doctor' OR OLD.role = 'doctor' BEGIN
+    %(doctors)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_users_ad AFTER DELETE ON users WHEN OLD.role = 'doctor' BEGIN
+    %(doctors)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_blacklist_ai AFTER INSERT ON blacklisted_doctors BEGIN
+    %(blacklist)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_blacklist_au AFTER UPDATE ON blacklisted_doctors BEGIN
+    %(blacklist)s
+END;
+CREATE TRIGGER IF NOT EXISTS gen_blacklist_ad AFTER DELETE ON blacklisted_doctors BEGIN
+    %(blacklist)s
+END;
+''' % {
+    'new_patient': _bump('patient', 'NEW.patient_id'),
+    'old_patient': _bump('patient', 'OLD.patient_id', 'OLD.patient_id IS NOT NEW.patient_id'),
+    'old_patient_any': _bump('patient', 'OLD.patient_id'),
+    'new_appointment': _bump('appointment', 'NEW.appointment_id'),
+    'old_appointment': _bump('appointment', 'OLD.appointment_id', 'OLD.appointment_id IS NOT NEW.appointment_id'),
+    'old_appointment_any': _bump('appointment', 'OLD.appointment_id'),
+    'doctors': _bump('doctors', '0'),
+    'blacklist': _bump('blacklist', '0'),
+}
+
+# Bookable slots, materialized from per-doctor weekly templates by slots.py.
+# These triggers keep slots.appointment_id pointing at the slot's Booked
+# appointment whatever writes the appointments (booking, reschedule, cancel,
+# completion, bulk imports), so a slot is free exactly when it is NULL.
+SLOT_TRIGGERS = '''
+CREATE TRIGGER IF NOT EXISTS slots_appointments_ai AFTER INSERT ON appointments WHEN NEW.status = 'Booked' BEGIN
+    UPDATE slots SET appointment_id = NEW.id WHERE doctor_id = NEW.doctor_id AND date = NEW.date AND time = NEW.time;
+END;
+CREATE TRIGGER IF NOT EXISTS slots_appointments_au AFTER UPDATE OF doctor_id, date, time, status ON appointments BEGIN
+    UPDATE slots SET appointment_id = NULL
+        WHERE doctor_id = OLD.doctor_id AND date = OLD.date AND time = OLD.time AND appointment_id = OLD.id;
+    UPDATE slots SET appointment_id = NEW.id
+        WHERE NEW.status = 'Booked' AND doctor_id = NEW.doctor_id AND date = NEW.date AND time = NEW.time;
+END;
+CREATE TRIGGER IF NOT EXISTS slots_appointments_ad AFTER DELETE ON appointments WHEN OLD.status = 'Booked' BEGIN
+    UPDATE slots SET appointment_id = NULL
+        WHERE doctor_id = OLD.doctor_id AND date = OLD.date AND time = OLD.time AND appointment_id = OLD.id;
+END;
+'''
+
+# what stats_counters should contain, computed from the base tables
+STATS_SOURCE = '''SELECT 'role', COALESCE(role, ''), COUNT(*) FROM users GROUP BY 2
+    UNION ALL SELECT 'specialization', COALESCE(specialization, ''), COUNT(*) FROM users WHERE role = 'doctor' GROUP BY 2
+    UNION ALL SELECT 'appointments', '', COUNT(*) FROM appointments
+    UNION ALL SELECT 'appointment_status', COALESCE(status, ''), COUNT(*) FROM appointments GROUP BY 2'''
+
+
+def rebuild_history_fts(cur):
+    # repopulate the full-text index from patient_history (external content table)
+    cur.execute("INSERT INTO patient_history_fts(patient_history_fts) VALUES('rebuild')")
+
+
+def rebuild_stats(cur):
+    cur.execute('DELETE FROM stats_counters')
+    cur.execute('INSERT INTO stats_counters (kind, key, cnt) ' + STATS_SOURCE)
+
+
+def check_stats(conn, repair=True):
+    # compares stats_counters with a full recount; rebuilds it on drift when repair is set
+    expected = {(k, key): n for k, key, n in conn.execute(STATS_SOURCE)}
+    actual = {(k, key): n for k, key, n in conn.execute('SELECT kind, key, cnt FROM stats_counters') if n}
+    drift = sorted((k, actual.get(k, 0), expected.get(k, 0)) for k in set(expected) | set(actual) if actual.get(k, 0) != expected.get(k, 0))
+    if drift and repair:
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        rebuild_stats(cur)
+        conn.commit()
+    return drift
+
+
+def _statements(script):
+    # split a SQL script into statements, keeping trigger bodies (BEGIN ... END;) whole
+    buf = ''
+    for line in script.splitlines(True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            if buf.strip():
+                yield buf.strip()
+            buf = ''
+    if buf.strip():
+        yield buf.strip()
+
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+# Each entry is either a SQL script or a function taking a cursor; never edit
+# or reorder an entry once it has shipped, append a new one instead.
+MIGRATIONS = [
+    # 1: secondary indexes for the per-doctor/per-patient lookups
+    '''CREATE INDEX IF NOT EXISTS idx_appointments_doctor_date ON appointments(doctor_id, date, status, time);
+    CREATE INDEX IF NOT EXISTS idx_appointments_patient_date ON appointments(patient_id, date);
+    CREATE INDEX IF NOT EXISTS idx_history_patient_date ON patient_history(patient_id, date);
+    CREATE INDEX IF NOT EXISTS idx_history_appointment ON patient_history(appointment_id);
+    CREATE INDEX IF NOT EXISTS idx_users_role ON users(role);''',
+    # 2: the remaining lookups still scanning (blacklist check, legacy availability table)
+    '''CREATE INDEX IF NOT EXISTS idx_blacklist_username ON blacklisted_doctors(username);
+    CREATE INDEX IF NOT EXISTS idx_availability_doctor_date ON availability(doctor_id, date);''',
+    # 3: dates stored as sortable ISO 'YYYY-MM-DD', times as zero-padded 'HH:MM'
+    _migrate_iso_dates,
+    # 4: keyset pagination of the list views on (date, time, id) / (date, id);
+    # history records without a date take their appointment's date so the key is never NULL
+    '''CREATE INDEX IF NOT EXISTS idx_appointments_date ON appointments(date, time);
+    CREATE INDEX IF NOT EXISTS idx_appointments_doctor_slot ON appointments(doctor_id, date, time);
+    UPDATE patient_history SET date = COALESCE((SELECT a.date FROM appointments a WHERE a.id = patient_history.appointment_id), '') WHERE date IS NULL;
+    CREATE INDEX IF NOT EXISTS idx_history_date ON patient_history(date);''',
+    # 5: at most one Booked appointment per doctor slot. Duplicates left by the old
+    # check-then-insert race keep the earliest booking; the rest are cancelled.
+    '''UPDATE appointments SET status = 'Cancelled'
+       WHERE status = 'Booked' AND id NOT IN (
+           SELECT MIN(id) FROM appointments WHERE status = 'Booked' GROUP BY doctor_id, date, time);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_booked_slot ON appointments(doctor_id, date, time) WHERE status = 'Booked';''',
+    # 6: counters for the admin dashboard and stats page, kept current by triggers
+    '''CREATE TABLE IF NOT EXISTS stats_counters (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        cnt INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, key)
+    ) WITHOUT ROWID;
+    ''' + STATS_TRIGGERS,
+    # 7: fill the counters from the rows already there
+    rebuild_stats,
+    # 8: full-text index over history notes and prescriptions, mirrored by triggers;
+    # patient_id is indexed too so scoped searches filter inside FTS5
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS patient_history_fts USING fts5(
+        visit_info, prescription, patient_id, content='patient_history', content_rowid='id',
+        tokenize='porter unicode61', prefix='2 3');
+    CREATE TRIGGER IF NOT EXISTS history_fts_ai AFTER INSERT ON patient_history BEGIN
+        INSERT INTO patient_history_fts(rowid, visit_info, prescription, patient_id) VALUES (NEW.id, NEW.visit_info, NEW.prescription, NEW.patient_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS history_fts_ad AFTER DELETE ON patient_history BEGIN
+        INSERT INTO patient_history_fts(patient_history_fts, rowid, visit_info, prescription, patient_id) VALUES ('delete', OLD.id, OLD.visit_info, OLD.prescription, OLD.patient_id);
+    END;
+    CREATE TRIGGER IF NOT EXISTS history_fts_au AFTER UPDATE OF visit_info, prescription, patient_id ON patient_history BEGIN
+        INSERT INTO patient_history_fts(patient_history_fts, rowid, visit_info, prescription, patient_id) VALUES ('delete', OLD.id, OLD.visit_info, OLD.prescription, OLD.patient_id);
+        INSERT INTO patient_history_fts(rowid, visit_info, prescription, patient_id) VALUES (NEW.id, NEW.visit_info, NEW.prescription, NEW.patient_id);
+    END;''',
+    rebuild_history_fts,
+    # 10: change counters for ETags; the random epoch keeps tags from an older
+    # copy of the database from matching this one
+    '''CREATE TABLE IF NOT EXISTS generations (
+        scope TEXT NOT NULL,
+        key INTEGER NOT NULL,
+        gen INTEGER NOT NULL DEFAULT 0,
+        modified INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (scope, key)
+    ) WITHOUT ROWID;
+    INSERT OR IGNORE INTO generations (scope, key, gen, modified)
+        VALUES ('epoch', 0, abs(random() % 1000000000), CAST(strftime('%s', 'now') AS INTEGER));
+    ''' + GENERATION_TRIGGERS,
+    # 11: per-doctor weekly slot templates and dated exceptions, and the slots
+    # materialized from them (filled by slots.py, which needs today's date).
+    # doctor_id 0 is the clinic default, seeded with the old fixed slots
+    # Monday to Saturday; weekdays are Python's (0 = Monday). The exception rows
+    # for a date replace the template's hours that day; one without a
+    # start_time makes it a day off.
+    '''CREATE TABLE IF NOT EXISTS slot_templates (
+        doctor_id INTEGER NOT NULL,
+        weekday INTEGER NOT NULL,
+        start_time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        slot_minutes INTEGER NOT NULL,
+        PRIMARY KEY (doctor_id, weekday, start_time)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS slot_exceptions (
+        doctor_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        start_time TEXT,
+        end_time TEXT,
+        slot_minutes INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_slot_exceptions_doctor_date ON slot_exceptions(doctor_id, date);
+    CREATE TABLE IF NOT EXISTS slots (
+        doctor_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        appointment_id INTEGER,
+        PRIMARY KEY (doctor_id, date, time)
+    ) WITHOUT ROWID;
+    INSERT OR IGNORE INTO slot_templates (doctor_id, weekday, start_time, end_time, slot_minutes)
+        WITH RECURSIVE w(d) AS (SELECT 0 UNION ALL SELECT d + 1 FROM w WHERE d < 5)
+        SELECT 0, d, '08:00', '12:00', 240 FROM w UNION ALL SELECT 0, d, '04:00', '09:00', 300 FROM w;
+    ''' + SLOT_TRIGGERS,
+    # 12: open slots only (covering), so finding a doctor's next free slot seeks
+    # straight to it instead of stepping over the booked ones
+    '''CREATE INDEX IF NOT EXISTS idx_slots_open ON slots(doctor_id, date, time, end_time) WHERE appointment_id IS NULL;''',
+]
+
+# The classes in repository.py whose statements the routes run; check_query_plans()
+# fails if any of them (or a generation lookup from versions.py) is answered
+# with a table scan, so a new or changed route query is checked as soon as it
+# is added there.
+ROUTE_STATEMENTS = ('Users', 'Appointments', 'History', 'Relations', 'Slots')
+
+
+def _placeholders(sql):
+    # parameters a statement takes: ?NNN numbers them, plain ? count up
+    numbered = [int(n) for n in re.findall(r'\?(\d+)', sql)]
+    return max(numbered) if numbered else sql.count('?')
+
+
+def hot_queries():
+    # [(name, sql, params)]: every fixed statement of ROUTE_STATEMENTS plus the
+    # generations lookups for one key and for a JSON list of keys. Parameters
+    # are placeholders, which is all EXPLAIN QUERY PLAN needs.
+    root = os.path.dirname(os.path.abspath(BASE))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    import repository, versions
+    queries = []
+    for cls_name in ROUTE_STATEMENTS:
+        for name, sql in vars(getattr(repository, cls_name)).items():
+            if name.isupper() and isinstance(sql, str):
+                queries.append(('%s.%s' % (cls_name, name), sql, (None,) * _placeholders(sql)))
+    for keys in ([('patient', 1)], [('patient', n) for n in range(versions.MAX_INLINE_KEYS + 1)]):
+        sql, params = versions._query(keys)
+        queries.append(('versions.version(%d keys)' % len(keys), sql, params))
+    return queries
+
+
+def migrate(conn):
+    cur = conn.cursor()
+    version = cur.execute('PRAGMA user_version').fetchone()[0]
+    for target in range(version + 1, len(MIGRATIONS) + 1):
+        step = MIGRATIONS[target - 1]
+        cur.execute('BEGIN')
+        try:
+            if callable(step):
+                step(cur)
+            else:
+                for stmt in _statements(step):
+                    cur.execute(stmt)
+            cur.execute('PRAGMA user_version=%d' % target)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return len(MIGRATIONS)
+
+
+def check_query_plans(conn, queries=None):
+    # returns [(name, plan detail)] for every hot query that still scans a table
+    offenders = []
+    for name, sql, params in hot_queries() if queries is None else queries:
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[3]
+            # json_each() id lists and INSERT ... SELECT's single row are scanned by
+            # design; the tables they index into are not
+            if detail.startswith('SCAN') and 'VIRTUAL TABLE' not in detail and 'CONSTANT ROW' not in detail:
+                offenders.append((name, detail))
+    return offenders
+
+
+def init_db(path=None):
+    conn = sqlite3.connect(path or DB)
+    # WAL is a property of the database file: switch it on here, once, rather
+    # than leave it to the first pooled connection of whichever worker wins
+    conn.execute('PRAGMA journal_mode=WAL')
     cur = conn.cursor()
     cur.execute('''CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -69,8 +447,34 @@ def init_db():
     if not cur.fetchone():
         cur.execute("INSERT INTO users (name, username, password, role, specialization, experience) VALUES (?,?,?,?,?,?)", ('Dr. Alice','dr1', generate_password_hash('dr1pass'), 'doctor','Cardiology','5'))
     conn.commit()
+    version = migrate(conn)
     conn.close()
-    print('DB initialized at', DB)
+    print('DB initialized at', path or DB, '(schema version %d)' % version)
 
 if __name__=='__main__':
     init_db()
+    if '--rebuild-fts' in sys.argv:
+        conn = sqlite3.connect(DB)
+        cur = conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        rebuild_history_fts(cur)
+        conn.commit()
+        conn.close()
+        print('History search index rebuilt')
+    if '--check-stats' in sys.argv:
+        conn = sqlite3.connect(DB)
+        drift = check_stats(conn)
+        conn.close()
+        for (kind, key), have, want in drift:
+            print('stats drift: %s %r was %d, recounted %d' % (kind, key, have, want))
+        print('Stats counters rebuilt' if drift else 'Stats counters consistent')
+    if '--check' in sys.argv:
+        conn = sqlite3.connect(DB)
+        queries = hot_queries()
+        bad = check_query_plans(conn, queries)
+        conn.close()
+        for name, detail in bad:
+            print('SCAN:', detail, '<-', name)
+        if bad:
+            sys.exit(1)
+        print('Query plans OK: %d hot queries use indexes' % len(queries))
@@ -0,0 +1,163 @@
+# Synthetic data at hospital scale, for benchmarking. Run against a fresh
+# database (usernames are fixed per index), from the project root:
+#   python database/seed.py --db /tmp/big.db --doctors 500 --patients 200000 \
+#       --appointments 5000000 --history 2000000 --seed 42
+# Every seeded user's password is "password".
+import argparse, random, sqlite3, time
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+
+try:
+    from database import create_db
+except ImportError:
+    import create_db
+
+SPECIALIZATIONS = ('Cardiology', 'Neurology', 'Orthopedics', 'Pediatrics', 'Dermatology',
+                   'General', 'Oncology', 'Psychiatry', 'Radiology', 'ENT')
+SLOTS = ('08:00', '04:00')
+COMPLAINTS = ('fever', 'persistent cough', 'chest pain', 'lower back pain', 'migraine', 'skin rash',
+              'knee pain', 'shortness of breath', 'abdominal pain', 'dizziness', 'fatigue', 'sore throat')
+FINDINGS = ('stable', 'improving', 'no acute distress', 'mild inflammation', 'elevated blood pressure',
+            'normal ECG', 'x-ray unremarkable', 'bloods ordered', 'referred for imaging', 'follow-up in 2 weeks')
+DRUGS = ('paracetamol 500mg', 'ibuprofen 400mg', 'amoxicillin 500mg', 'lisinopril 10mg', 'atorvastatin 20mg',
+         'omeprazole 20mg', 'salbutamol inhaler', 'cetirizine 10mg', 'metformin 500mg', 'sertraline 50mg',
+         'prednisolone 5mg', 'amlodipine 5mg', 'levothyroxine 50mcg', 'insulin glargine', 'naproxen 250mg')
+DATE_FMT = '%Y-%m-%d'
+CHUNK = 50000
+
+
+def _working_days(end, count):
+    # `count` dates ending at `end`, oldest first, skipping Sundays
+    out, day = [], end
+    while len(out) < count:
+        if day.weekday() != 6:
+            out.append(day.strftime(DATE_FMT))
+        day -= timedelta(days=1)
+    out.reverse()
+    return out
+
+
+def _bulk_schema(cur, tables):
+    # indexes and triggers on the seeded tables; they are dropped for the bulk
+    # insert and recreated afterwards, which is far cheaper than maintaining
+    # them row by row
+    return cur.execute('''SELECT type, name, sql FROM sqlite_master
+                          WHERE type IN ('index', 'trigger') AND sql IS NOT NULL AND tbl_name IN (%s)'''
+                       % ', '.join('?' * len(tables)), tables).fetchall()
+
+
+def seed(path, doctors=500, patients=200000, appointments=5000000, history=2000000, seed=42,
+         future_days=30, log=print):
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    cur = conn.cursor()
+    for pragma in ('synchronous=OFF', 'cache_size=-262144', 'temp_store=MEMORY'):
+        cur.execute('PRAGMA ' + pragma)
+    started = time.perf_counter()
+    pwhash = generate_password_hash('password')
+    cur.execute('BEGIN IMMEDIATE')
+    try:
+        saved = _bulk_schema(cur, ('users', 'appointments', 'patient_history', 'doctor_patient'))
+        for kind, name, _ in saved:
+            cur.execute('DROP %s %s' % (kind.upper(), name))
+
+        base = cur.execute('SELECT COALESCE(MAX(id), 0) FROM users').fetchone()[0]
+        doctor_ids = list(range(base + 1, base + doctors + 1))
+        cur.executemany('INSERT INTO users (id, name, username, password, role, specialization, experience) VALUES (?,?,?,?,?,?,?)',
+                        ((uid, 'Dr. Seed %d' % i, 'seeddoc%d' % i, pwhash, 'doctor', rnd.choice(SPECIALIZATIONS), str(rnd.randint(1, 35)))
+                         for i, uid in enumerate(doctor_ids)))
+        patient_ids = list(range(base + doctors + 1, base + doctors + patients + 1))
+        cur.executemany('INSERT INTO users (id, name, username, password, role) VALUES (?,?,?,?,?)',
+                        ((uid, 'Patient %d' % i, 'seedpat%d' % i, pwhash, 'patient') for i, uid in enumerate(patient_ids)))
+        log('users: %d doctors, %d patients (%.1fs)' % (doctors, patients, time.perf_counter() - started))
+
+        # each patient is registered with one to three doctors; appointments
+        # are drawn from the doctor's own panel, like a real practice
+        panels = {d: [] for d in doctor_ids}
+        relations = []
+        for pid in patient_ids:
+            for d in rnd.sample(doctor_ids, min(len(doctor_ids), rnd.choice((1, 1, 2, 3)))):
+                panels[d].append(pid)
+                relations.append((d, pid))
+        cur.executemany('INSERT INTO doctor_patient (doctor_id, patient_id) VALUES (?,?)', relations)
+        del relations
+
+        # Appointments fill each doctor's slots back to back, oldest first, up
+        # to `future_days` ahead: past ones are mostly Completed, future ones
+        # mostly Booked; one Booked row per slot at most.
+        appt_id = cur.execute('SELECT COALESCE(MAX(id), 0) FROM appointments').fetchone()[0]
+        today = datetime.now().strftime(DATE_FMT)
+        completed_rate = min(1.0, history / max(1, appointments * 0.85))
+        history_left = history
+        per_doctor, extra = divmod(appointments, max(1, doctors))
+        appt_rows, history_rows, n_appts, n_hist = [], [], 0, 0
+        for i, d in enumerate(doctor_ids):
+            count = per_doctor + (1 if i < extra else 0)
+            if not count:
+                continue
+            panel = panels[d] or patient_ids
+            dates = _working_days(datetime.now() + timedelta(days=future_days), (count + 1) // 2)
+            for k in range(count):
+                date, slot = dates[k // 2], SLOTS[k % 2]
+                patient = rnd.choice(panel)
+                roll = rnd.random()
+                if date >= today:
+                    status = 'Booked' if roll < 0.9 else 'Cancelled'
+                else:
+                    status = 'Completed' if roll < 0.85 else 'Cancelled'
+                appt_id += 1
+                diagnosis = prescription = None
+                if status == 'Completed' and history_left and rnd.random() < completed_rate:
+                    history_left -= 1
+                    diagnosis = rnd.choice(COMPLAINTS)
+                    prescription = ', '.join(rnd.sample(DRUGS, rnd.randint(1, 3)))
+                    history_rows.append((appt_id, patient, d, 'Presented with %s; %s.' % (diagnosis, rnd.choice(FINDINGS)),
+                                         prescription, date))
+                appt_rows.append((appt_id, d, patient, date, slot, status, diagnosis, prescription))
+                if len(appt_rows) >= CHUNK:
+                    n_appts += _flush_appointments(cur, appt_rows)
+                    n_hist += _flush_history(cur, history_rows)
+        n_appts += _flush_appointments(cur, appt_rows)
+        n_hist += _flush_history(cur, history_rows)
+        log('appointments: %d, history: %d (%.1fs)' % (n_appts, n_hist, time.perf_counter() - started))
+
+        for kind, name, sql in saved:
+            cur.execute(sql)
+        create_db.rebuild_stats(cur)
+        create_db.rebuild_history_fts(cur)
+        log('indexes, triggers, counters and search index rebuilt (%.1fs)' % (time.perf_counter() - started))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    cur.execute('ANALYZE')
+    conn.close()
+    log('done in %.1fs' % (time.perf_counter() - started))
+    return {'doctors': doctor_ids, 'patients': patient_ids}
+
+
+def _flush_appointments(cur, rows):
+    cur.executemany('INSERT INTO appointments (id, doctor_id, patient_id, date, time, status, diagnosis, prescription) VALUES (?,?,?,?,?,?,?,?)', rows)
+    n = len(rows)
+    del rows[:]
+    return n
+
+
+def _flush_history(cur, rows):
+    cur.executemany('INSERT INTO patient_history (appointment_id, patient_id, doctor_id, visit_info, prescription, date) VALUES (?,?,?,?,?,?)', rows)
+    n = len(rows)
+    del rows[:]
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill a fresh HMS database with synthetic data')
+    parser.add_argument('--db', default=create_db.DB)
+    parser.add_argument('--doctors', type=int, default=500)
+    parser.add_argument('--patients', type=int, default=200000)
+    parser.add_argument('--appointments', type=int, default=5000000)
+    parser.add_argument('--history', type=int, default=2000000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    create_db.init_db(args.db)
+    seed(args.db, args.doctors, args.patients, args.appointments, args.history, args.seed)
@@ -0,0 +1,303 @@
+import sqlite3, threading, time
+from queue import LifoQueue, Empty, Full
+from flask import g, has_app_context
+
+# Applied once, when a connection is first opened. WAL lets readers run
+# alongside a writer; NORMAL sync is safe in WAL mode and avoids an fsync per commit.
+DEFAULT_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 268435456),
+    ('cache_size', -16000),
+    ('busy_timeout', 5000),
+    ('temp_store', 'MEMORY'),
+)
+
+# prepared statements kept per connection (sqlite3's default is 128). The app's
+# fixed statements (repository.py, pagination, versions) plus the ad-hoc ones
+# must fit, or reuse turns into re-preparing.
+DEFAULT_STATEMENT_CACHE = 256
+
+
+class PoolExhausted(Exception):
+    # every pooled connection stayed checked out for DB_POOL_TIMEOUT seconds
+    pass
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # Reports each statement, its time (execute plus fetches) and the rows it
+    # returned to the connection's observer, when one is attached (see metrics.py)
+    _record = None
+
+    def _timed(self, fn, sql, params, record_params):
+        observer = self.connection.observer
+        if observer is None:
+            return fn(sql, params)
+        started = time.perf_counter()
+        try:
+            return fn(sql, params)
+        finally:
+            self._record = observer.statement(sql, params if record_params else (), time.perf_counter() - started)
+
+    def execute(self, sql, params=()):
+        return self._timed(super().execute, sql, params, True)
+
+    def executemany(self, sql, seq_of_params):
+        return self._timed(super().executemany, sql, seq_of_params, False)
+
+    def _fetch(self, fn, *args):
+        observer = self.connection.observer
+        if observer is None or self._record is None:
+            return fn(*args)
+        started = time.perf_counter()
+        rows = fn(*args)
+        n = (1 if rows is not None else 0) if not isinstance(rows, list) else len(rows)
+        observer.fetched(self._record, time.perf_counter() - started, n)
+        return rows
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+    def __next__(self):
+        observer = self.connection.observer
+        if observer is None or self._record is None:
+            return super().__next__()
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            observer.fetched(self._record, time.perf_counter() - started, 0)
+            raise
+        observer.fetched(self._record, time.perf_counter() - started, 1)
+        return row
+
+
+class PooledConnection(sqlite3.Connection):
+    # routes still call conn.close(); for a pooled connection that only ends
+    # the open transaction, the manager does the real close
+    manager = None
+    observer = None
+    pool = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or InstrumentedCursor)
+
+    # the C shortcuts would bypass cursor(), so route them through it
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def close(self):
+        if self.manager is None:
+            return super().close()
+        if self.in_transaction:
+            self.rollback()
+
+    def close_for_real(self):
+        self.manager = None
+        super().close()
+
+
+class ConnectionManager:
+    # One connection per app context: the first get() checks a connection out of
+    # the pool and keeps it on g, so later get_db() calls in the same request
+    # (user loader included) reuse it. Teardown puts it back. At most
+    # DB_POOL_SIZE pooled connections are open at once; when all of them are
+    # checked out, get() waits up to DB_POOL_TIMEOUT seconds for one to come
+    # back instead of opening (and later closing) an extra one.
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.stats = {'opened': 0, 'closed': 0, 'checkouts': 0, 'reused': 0, 'waits': 0, 'timeouts': 0}
+        self._pool = None
+        self._open = 0
+        self.timeout = 5.0
+        self.path = None
+        self.pragmas = DEFAULT_PRAGMAS
+        self.statement_cache = DEFAULT_STATEMENT_CACHE
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DB_POOL_SIZE', 8)
+        app.config.setdefault('DB_POOL_TIMEOUT', 5.0)
+        app.config.setdefault('DB_PRAGMAS', DEFAULT_PRAGMAS)
+        app.config.setdefault('DB_STATEMENT_CACHE', DEFAULT_STATEMENT_CACHE)
+        self.configure(app)
+        app.extensions['db'] = self
+        app.teardown_appcontext(self.release)
+
+    def configure(self, app):
+        # (re)read path, pragmas and pool size; idle connections are closed
+        if self._pool is not None:
+            self.close_all()
+        self.app = app
+        self.path = app.config['DB_PATH']
+        self.pragmas = app.config['DB_PRAGMAS']
+        self.statement_cache = app.config['DB_STATEMENT_CACHE']
+        self.timeout = app.config.get('DB_POOL_TIMEOUT', 5.0)
+        with self._lock:
+            # connections still checked out from the old pool are closed on release
+            self._pool = LifoQueue(maxsize=app.config['DB_POOL_SIZE'])
+            self._open = 0
+
+    def prefill(self, count=None):
+        # open pooled connections ahead of the first requests (worker start-up)
+        count = self._pool.maxsize if count is None else min(count, self._pool.maxsize)
+        for _ in range(count - self._pool.qsize()):
+            conn = self._open_pooled()
+            if conn is None:
+                break
+            self._pool.put_nowait(conn)
+
+    def connect(self, pooled=True):
+        conn = sqlite3.connect(self.path, factory=PooledConnection, check_same_thread=False,
+                               cached_statements=self.statement_cache)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            conn.execute('PRAGMA %s=%s' % (name, value))
+        if pooled:
+            conn.manager = self
+        with self._lock:
+            self.stats['opened'] += 1
+        return conn
+
+    def _open_pooled(self):
+        # a new pooled connection, or None when DB_POOL_SIZE are already open
+        with self._lock:
+            if self._open >= self._pool.maxsize:
+                return None
+            self._open += 1
+            pool = self._pool
+        try:
+            conn = self.connect()
+        except BaseException:
+            with self._lock:
+                self._open -= 1
+            raise
+        conn.pool = pool
+        return conn
+
+    def get(self):
+        if not has_app_context():
+            # scripts and shells: plain connection, closed by the caller
+            return self.connect(pooled=False)
+        conn = g.get('_db_conn')
+        if conn is not None:
+            return conn
+        try:
+            conn = self._pool.get_nowait()
+            reused = True
+        except Empty:
+            conn = self._open_pooled()
+            reused = False
+            if conn is None:
+                with self._lock:
+                    self.stats['waits'] += 1
+                try:
+                    conn = self._pool.get(timeout=self.timeout)
+                except Empty:
+                    with self._lock:
+                        self.stats['timeouts'] += 1
+                    raise PoolExhausted()
+                reused = True
+        with self._lock:
+            self.stats['checkouts'] += 1
+            if reused:
+                self.stats['reused'] += 1
+        conn.observer = g.get('sql_stats')
+        g._db_conn = conn
+        return conn
+
+    def release(self, exc=None):
+        conn = g.pop('_db_conn', None)
+        if conn is None:
+            return
+        conn.observer = None
+        if conn.in_transaction:
+            conn.rollback()
+        if conn.pool is not self._pool:
+            self._discard(conn)
+            return
+        try:
+            self._pool.put_nowait(conn)
+        except Full:
+            self._discard(conn)
+
+    def explain(self, sql, params=()):
+        # EXPLAIN QUERY PLAN details for a statement, on the request's connection
+        # when there is one; the base-class execute keeps it out of the metrics
+        conn = g.get('_db_conn') if has_app_context() else None
+        own = conn is None
+        if own:
+            conn = self.connect(pooled=False)
+        try:
+            return [row[3] for row in sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params)]
+        except (sqlite3.Error, ValueError):
+            return []
+        finally:
+            if own:
+                conn.close()
+
+    def _discard(self, conn):
+        pool, conn.pool = conn.pool, None
+        conn.close_for_real()
+        with self._lock:
+            self.stats['closed'] += 1
+            if pool is not None and pool is self._pool:
+                self._open -= 1
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except Empty:
+                break
+            self._discard(conn)
+
+    def snapshot(self):
+        with self._lock:
+            s = dict(self.stats)
+            s['open'] = self._open
+        s['idle'] = self._pool.qsize() if self._pool is not None else 0
+        s['reuse_rate'] = round(s['reused'] / s['checkouts'], 4) if s['checkouts'] else 0.0
+        return s
+
+
+def is_busy(exc):
+    return isinstance(exc, sqlite3.OperationalError) and ('locked' in str(exc) or 'busy' in str(exc))
+
+
+def begin_immediate(conn, retries=5, backoff=0.02):
+    # Take the write lock up front, so concurrent writers queue on busy_timeout
+    # instead of failing mid-transaction; if the lock still cannot be had,
+    # retry a bounded number of times with exponential backoff.
+    for attempt in range(retries + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as exc:
+            if not is_busy(exc) or attempt == retries:
+                raise
+            time.sleep(backoff * (2 ** attempt))
+
+
+def immediate(conn, fn, retries=5, backoff=0.02):
+    # Run fn(cursor) in a BEGIN IMMEDIATE transaction and commit.
+    # IntegrityError (e.g. a unique index conflict) propagates to the caller.
+    begin_immediate(conn, retries, backoff)
+    try:
+        result = fn(conn.cursor())
+        conn.commit()
+        return result
+    except BaseException:
+        conn.rollback()
+        raise
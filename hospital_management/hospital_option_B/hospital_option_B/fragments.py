@@ -0,0 +1,125 @@
+import threading, time
+from collections import OrderedDict
+from markupsafe import Markup
+
+
+class Deferred:
+    # rows loaded on first iteration, so a query whose only consumer is a
+    # cached fragment does not run when the fragment is served from cache
+    def __init__(self, load):
+        self._load = load
+        self._rows = None
+
+    def __iter__(self):
+        if self._rows is None:
+            self._rows = self._load()
+        return iter(self._rows)
+
+
+class FragmentCache:
+    # Rendered template fragments, LRU-evicted once their total size passes
+    # max_bytes. Each entry carries dependency tags ('doctors', 'patient:12',
+    # ...) that write paths invalidate; the version in the key (usually a
+    # generation stamp) makes changes from other processes miss instead.
+    #
+    #   {% call fragment('doctor-list', 'doctors', version=stamp) %}...{% endcall %}
+
+    def __init__(self, app=None, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._tags = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.render_seconds = 0.0
+        self.saved_seconds = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_ENABLED', True)
+        app.config.setdefault('FRAGMENT_CACHE_BYTES', self.max_bytes)
+        self.app = app
+        self.max_bytes = app.config['FRAGMENT_CACHE_BYTES']
+        app.extensions['fragments'] = self
+        app.jinja_env.globals['fragment'] = self.fragment
+
+    def fragment(self, name, *tags, version=None, caller=None):
+        # jinja call-block global: the body (caller) only renders on a miss
+        if not self.app.config['FRAGMENT_CACHE_ENABLED']:
+            return caller()
+        key = (name, version)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry[2]
+                return entry[0]
+            self.misses += 1
+        started = time.perf_counter()
+        html = Markup(caller())
+        elapsed = time.perf_counter() - started
+        self._put(key, html, tags, elapsed)
+        return html
+
+    def _put(self, key, html, tags, elapsed):
+        with self._lock:
+            self.render_seconds += elapsed
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (html, tags, elapsed)
+            self._bytes += len(html)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._bytes > self.max_bytes and self._data:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        html, tags, _ = self._data.pop(key)
+        self._bytes -= len(html)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {'entries': len(self._data), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'render_seconds': round(self.render_seconds, 6),
+                    'saved_seconds': round(self.saved_seconds, 6)}
+
+    def expose(self):
+        # Prometheus lines, added to /admin/metrics
+        s = self.snapshot()
+        lines = []
+        for name, kind, help, value in (
+                ('hms_fragment_cache_hits_total', 'counter', 'Fragments served from cache', s['hits']),
+                ('hms_fragment_cache_misses_total', 'counter', 'Fragments rendered', s['misses']),
+                ('hms_fragment_cache_evictions_total', 'counter', 'Fragments evicted by the size bound', s['evictions']),
+                ('hms_fragment_cache_invalidations_total', 'counter', 'Fragments dropped by tag', s['invalidations']),
+                ('hms_fragment_cache_render_seconds_total', 'counter', 'Time spent rendering fragments on a miss', s['render_seconds']),
+                ('hms_fragment_cache_saved_seconds_total', 'counter', 'Render time of the fragments served from cache', s['saved_seconds']),
+                ('hms_fragment_cache_bytes', 'gauge', 'Size of the cached fragments', s['bytes'])):
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind), '%s %s' % (name, value)]
+        return lines
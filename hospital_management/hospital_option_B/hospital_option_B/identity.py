@@ -0,0 +1,64 @@
+import threading, time
+from collections import OrderedDict
+
+
+class UserRecord:
+    # the few user columns every request needs; never the password hash
+    __slots__ = ('id', 'username', 'role', 'name')
+
+    def __init__(self, id, username, role, name):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.name = name
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['username'], row['role'], row['name'])
+
+
+class IdentityCache:
+    # Bounded LRU of UserRecords with a TTL. Entries are dropped explicitly when
+    # a user is edited or deleted in this process; the TTL bounds how long an
+    # edit made by another process can go unseen.
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[1] < now:
+                if entry is not None:
+                    del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, record):
+        with self._lock:
+            self._data[record.id] = (record, time.monotonic() + self.ttl)
+            self._data.move_to_end(record.id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
@@ -1,6 +1,162 @@
+# Production launcher: pre-forked worker processes, each serving the app on a
+# fixed pool of threads from one shared listening socket.
+#   HMS_SECRET_KEY=... HMS_DB_PATH=/srv/hms/hms.db python main.py --workers 4 --threads 8
+# The schema is created/migrated (and WAL enabled) once, before forking; each
+# worker then opens its own connections and warms its caches. SIGTERM or
+# SIGINT stops accepting connections, lets in-flight requests finish and
+# exits; workers that die are restarted.
+import argparse, logging, os, secrets, signal, socket, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+from database import create_db
+
+log = logging.getLogger('hms.main')
+
+
+class RequestHandler(WSGIRequestHandler):
+    # one request per connection: an idle keep-alive client would otherwise
+    # hold one of the worker's threads
+    protocol_version = 'HTTP/1.0'
+
+
+class PooledServer(BaseWSGIServer):
+    # werkzeug's WSGI server with requests run on a fixed-size thread pool
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None):
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='request')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def serve(sock, args):
+    # one worker: configure the app for this process and serve until signalled
+    import app as appmod
+    app = appmod.create_app({'DB_POOL_SIZE': args.threads})
+    appmod.warm_up()
+    server = PooledServer(args.host, args.port, app, args.threads, fd=sock.fileno())
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        if not stopping.is_set():
+            stopping.set()
+            # shutdown() waits for serve_forever(), so not from this (the serving) thread
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    log.info('worker %d serving on %s:%d with %d threads', os.getpid(), args.host, server.port, args.threads)
+    server.serve_forever()
+    server.pool.shutdown(wait=True)
+    server.server_close()
+    appmod.shutdown_app()
+    log.info('worker %d stopped', os.getpid())
+
+
+def spawn(sock, args):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            serve(sock, args)
+        except BaseException:
+            log.exception('worker %d crashed', os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def supervise(sock, args):
+    workers = {spawn(sock, args): time.monotonic() for _ in range(args.workers)}
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while not stopping.is_set():
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid = 0
+        if pid and pid in workers:
+            started = workers.pop(pid)
+            log.warning('worker %d exited (status %d), restarting', pid, status)
+            if time.monotonic() - started < 1:
+                time.sleep(1)  # crashing at start-up: do not spin
+            workers[spawn(sock, args)] = time.monotonic()
+        else:
+            stopping.wait(0.2)
+    log.info('stopping %d workers', len(workers))
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + args.graceful_timeout
+    while workers and time.monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            workers.pop(pid, None)
+        else:
+            time.sleep(0.05)
+    for pid in workers:
+        log.warning('worker %d did not stop in time, killing it', pid)
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+
 def main():
-    print("Hello from hospital-option-b!")
+    parser = argparse.ArgumentParser(description='Run the hospital management app')
+    parser.add_argument('--host', default=os.environ.get('HMS_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('HMS_PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('HMS_WORKERS', os.cpu_count() or 1)),
+                        help='worker processes (default: CPU count)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('HMS_THREADS', 8)),
+                        help='request threads per worker')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='seconds to let in-flight requests finish on shutdown')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    if not os.environ.get('HMS_SECRET_KEY'):
+        # all workers must sign sessions with the same key
+        os.environ['HMS_SECRET_KEY'] = secrets.token_hex(32)
+        log.warning('HMS_SECRET_KEY is not set; using a random key, sessions end when the server restarts')
+    import app as appmod  # loaded once here and shared by the forked workers
+    db_path = os.environ.get('HMS_DB_PATH') or appmod.app.config['DB_PATH']
+    os.environ['HMS_DB_PATH'] = db_path
+    create_db.init_db(db_path)
+
+    sock = socket.create_server((args.host, args.port), backlog=max(128, args.workers * args.threads * 4))
+    sock.set_inheritable(True)
+    log.info('listening on %s:%d (%s)', args.host, sock.getsockname()[1], db_path)
+    if args.workers <= 1 or not hasattr(os, 'fork'):
+        serve(sock, args)
+    else:
+        supervise(sock, args)
+    sock.close()
 
 
-if __name__ == "__main__":
-    main()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import threading, time
+from collections import deque
+from flask import g, request, before_render_template, template_rendered
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+ROW_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+# statements kept per request for the slow-query check; counting goes on past it
+MAX_RECORDS = 200
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    # a Prometheus histogram with one series per label tuple
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for labels, series in items:
+            base = ','.join('%s="%s"' % (k, _label(v)) for k, v in zip(self.labels, labels))
+            sep = ',' if base else ''
+            for bound, count in zip(self.buckets, series):
+                lines.append('%s_bucket{%s%sle="%s"} %d' % (self.name, base, sep, bound, count))
+            lines.append('%s_bucket{%s%sle="+Inf"} %d' % (self.name, base, sep, series[-1]))
+            lines.append('%s_sum{%s} %.6f' % (self.name, base, series[-2]))
+            lines.append('%s_count{%s} %d' % (self.name, base, series[-1]))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            base = ','.join('%s="%s"' % (k, _label(v)) for k, v in zip(self.labels, labels))
+            lines.append('%s{%s} %d' % (self.name, base, value))
+        return lines
+
+
+class RequestStats:
+    # per-request observer attached to the pooled connection (db.InstrumentedCursor)
+    __slots__ = ('started', 'statements', 'sql_time', 'rows', 'render_time', 'records', '_render_started')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.render_time = 0.0
+        self.records = []
+        self._render_started = None
+
+    def statement(self, sql, params, elapsed):
+        self.statements += 1
+        self.sql_time += elapsed
+        if len(self.records) >= MAX_RECORDS:
+            return None
+        record = [sql, params, elapsed, 0]
+        self.records.append(record)
+        return record
+
+    def fetched(self, record, elapsed, rows):
+        self.sql_time += elapsed
+        self.rows += rows
+        record[2] += elapsed
+        record[3] += rows
+
+
+class Metrics:
+    # Per-endpoint request, render and SQL histograms plus a slow-query log.
+    # Handler time is the request time minus template rendering.
+
+    def __init__(self, app=None, db=None):
+        self.slow_log = deque()
+        self.collectors = []
+        self.request_seconds = Histogram('hms_request_duration_seconds', 'Request time, handler plus rendering',
+                                         ('endpoint', 'method'), SECONDS_BUCKETS)
+        self.handler_seconds = Histogram('hms_handler_duration_seconds', 'Request time excluding template rendering',
+                                         ('endpoint',), SECONDS_BUCKETS)
+        self.render_seconds = Histogram('hms_render_duration_seconds', 'Template rendering time per request',
+                                        ('endpoint',), SECONDS_BUCKETS)
+        self.sql_seconds = Histogram('hms_sql_duration_seconds', 'SQL time (execute and fetch) per request',
+                                     ('endpoint',), SECONDS_BUCKETS)
+        self.sql_statements = Histogram('hms_sql_statements', 'SQL statements per request',
+                                        ('endpoint',), STATEMENT_BUCKETS)
+        self.sql_rows = Histogram('hms_sql_rows', 'Rows fetched per request', ('endpoint',), ROW_BUCKETS)
+        self.responses = Counter('hms_responses_total', 'Responses by status', ('endpoint', 'status'))
+        self.slow_queries = Counter('hms_slow_queries_total', 'Statements slower than SLOW_QUERY_MS', ('endpoint',))
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('SLOW_QUERY_MS', 100)
+        app.config.setdefault('SLOW_QUERY_LOG_SIZE', 100)
+        app.config.setdefault('SLOW_QUERY_PARAMS', False)
+        app.config.setdefault('SERVER_TIMING', False)
+        self.app = app
+        self.db = db
+        self.slow_log = deque(maxlen=app.config['SLOW_QUERY_LOG_SIZE'])
+        app.extensions['metrics'] = self
+        # registered before the app's own hooks, so the user loader is measured too
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._render_start, app)
+        template_rendered.connect(self._render_end, app)
+
+    def _start(self):
+        if self.app.config['METRICS_ENABLED']:
+            g.sql_stats = RequestStats()
+
+    def _render_start(self, sender, **extra):
+        stats = g.get('sql_stats')
+        if stats is not None:
+            stats._render_started = time.perf_counter()
+
+    def _render_end(self, sender, **extra):
+        stats = g.get('sql_stats')
+        if stats is not None and stats._render_started is not None:
+            stats.render_time += time.perf_counter() - stats._render_started
+            stats._render_started = None
+
+    def _finish(self, response):
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return response
+        total = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+        self.request_seconds.observe((endpoint, request.method), total)
+        self.handler_seconds.observe((endpoint,), total - stats.render_time)
+        self.render_seconds.observe((endpoint,), stats.render_time)
+        self.sql_seconds.observe((endpoint,), stats.sql_time)
+        self.sql_statements.observe((endpoint,), stats.statements)
+        self.sql_rows.observe((endpoint,), stats.rows)
+        self.responses.inc((endpoint, response.status_code))
+        threshold = self.app.config['SLOW_QUERY_MS'] / 1000.0
+        for sql, params, elapsed, rows in stats.records:
+            if elapsed >= threshold:
+                self.slow_queries.inc((endpoint,))
+                entry = {'endpoint': endpoint, 'sql': ' '.join(sql.split()), 'params': self._params(params),
+                         'ms': round(elapsed * 1000, 3), 'rows': rows, 'plan': self.db.explain(sql, params),
+                         'at': time.time()}
+                self.slow_log.append(entry)
+                self.app.logger.warning('slow query (%.1f ms) on %s: %s | plan: %s',
+                                        entry['ms'], endpoint, entry['sql'], '; '.join(entry['plan']))
+        if self.app.config['SERVER_TIMING']:
+            response.headers.add('Server-Timing', 'db;dur=%.2f;desc="%d queries, %d rows"'
+                                 % (stats.sql_time * 1000, stats.statements, stats.rows))
+            response.headers.add('Server-Timing', 'render;dur=%.2f' % (stats.render_time * 1000))
+            response.headers.add('Server-Timing', 'app;dur=%.2f' % ((total - stats.render_time) * 1000))
+        return response
+
+    def _params(self, params):
+        # parameter values hold password hashes, search terms and visit notes:
+        # only their types are kept unless SLOW_QUERY_PARAMS is set
+        values = list(params.values()) if isinstance(params, dict) else list(params)
+        if self.app.config['SLOW_QUERY_PARAMS']:
+            return [str(p) for p in values]
+        return [type(p).__name__ for p in values]
+
+    def expose(self):
+        lines = []
+        for metric in (self.request_seconds, self.handler_seconds, self.render_seconds, self.sql_seconds,
+                       self.sql_statements, self.sql_rows, self.responses, self.slow_queries):
+            lines.extend(metric.expose())
+        for collect in self.collectors:
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+    def register(self, collect):
+        # extra exposition lines from another component (e.g. FragmentCache.expose)
+        self.collectors.append(collect)
+
+    def slow(self):
+        return list(self.slow_log)
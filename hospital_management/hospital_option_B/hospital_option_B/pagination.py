@@ -0,0 +1,59 @@
+import base64, json
+
+# rows per page for the list views and their /api counterparts
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    # raises ValueError on anything that is not a cursor we issued
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+    except Exception:
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('invalid cursor')
+    return values
+
+
+def page_size(value, default=PAGE_SIZE):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(value, MAX_PAGE_SIZE))
+
+
+def fetch_page(conn, select, keys, where=None, params=(), cursor=None, limit=PAGE_SIZE, desc=True):
+    # Keyset (seek) pagination: `keys` are the ORDER BY columns, ending in a
+    # unique one (usually the id), and must not be NULL. The next page starts
+    # strictly after the last row of this one via a row-value comparison, so
+    # with a matching index every page costs the same however deep it is.
+    # Returns (rows, next_cursor); next_cursor is None on the last page.
+    clauses = [where] if where else []
+    args = list(params)
+    after = decode_cursor(cursor)
+    if after is not None:
+        if len(after) != len(keys):
+            raise ValueError('invalid cursor')
+        clauses.append('(%s) %s (%s)' % (', '.join(keys), '<' if desc else '>', ', '.join('?' * len(keys))))
+        args.extend(after)
+    sql = select
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += ' ORDER BY ' + ', '.join(k + (' DESC' if desc else '') for k in keys) + ' LIMIT ?'
+    args.append(limit + 1)
+    rows = conn.execute(sql, args).fetchall()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last[k.split('.')[-1]] for k in keys)
@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Target hashing parameters (werkzeug method string). Stored hashes made with
+# anything else are replaced on the user's next successful login.
+DEFAULT_METHOD = 'pbkdf2:sha256:600000'
+
+
+class HasherBusy(Exception):
+    # the hashing pool is saturated; callers should answer "try again later"
+    pass
+
+
+class PasswordHasher:
+    # Runs the KDF on a small fixed pool instead of the request thread. At most
+    # `max_pending` jobs may be queued or running; beyond that calls fail fast
+    # with HasherBusy, so a login burst holds `workers` cores at most and
+    # cannot starve the rest of the app. hashlib releases the GIL while it
+    # hashes, so the other request threads keep running meanwhile.
+
+    def __init__(self, method=DEFAULT_METHOD, workers=2, max_pending=32, timeout=10.0):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pwhash')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self.stats = {'verified': 0, 'hashed': 0, 'rehashed': 0, 'rejected': 0}
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise HasherBusy()
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # the job still finishes in the background and frees its slot then
+            self._count('rejected')
+            raise HasherBusy()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def hash(self, password):
+        pwhash = self._run(generate_password_hash, password, self.method)
+        self._count('hashed')
+        return pwhash
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        ok = self._run(check_password_hash, pwhash, password)
+        self._count('verified')
+        return ok
+
+    def rehashed(self):
+        self._count('rehashed')
+
+    def needs_rehash(self, pwhash):
+        return bool(pwhash) and pwhash.split('$', 1)[0] != self.method
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def snapshot(self):
+        with self._lock:
+            s = dict(self.stats)
+        s.update(method=self.method, workers=self.workers, max_pending=self.max_pending)
+        return s
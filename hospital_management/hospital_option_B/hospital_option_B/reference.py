@@ -0,0 +1,78 @@
+import threading, time
+
+from versions import version, DOCTORS, BLACKLIST
+
+
+def blacklist_key(username, name, specialization):
+    # a missing specialization is stored/compared as 'General'
+    return (username, name, specialization or 'General')
+
+
+class ReferenceData:
+    # one immutable snapshot of the rarely-changing tables
+    __slots__ = ('stamp', 'doctors', 'by_id', 'specializations', 'blacklist', 'blacklisted')
+
+    def __init__(self, stamp, doctors, blacklist):
+        self.stamp = stamp
+        self.doctors = doctors
+        self.by_id = {d['id']: d for d in doctors}
+        self.specializations = sorted({d['specialization'] or 'General' for d in doctors})
+        self.blacklist = blacklist
+        self.blacklisted = frozenset(blacklist_key(b['username'], b['name'], b['specialization']) for b in blacklist)
+
+    def doctor(self, doctor_id):
+        return self.by_id.get(doctor_id)
+
+    def is_blacklisted(self, username, name, specialization):
+        return blacklist_key(username, name, specialization) in self.blacklisted
+
+
+class ReferenceCache:
+    # Doctor directory, specializations and blacklist held in memory. Writes in
+    # this process call invalidate(); writes from other processes bump the
+    # doctors/blacklist generation counters (triggers, see create_db.py), which
+    # are checked at most every `check_interval` seconds, so most reads do not
+    # touch SQLite at all. (PRAGMA data_version would change on every booking.)
+
+    def __init__(self, check_interval=1.0):
+        self.check_interval = check_interval
+        self._data = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.checks = 0
+        self.loads = 0
+
+    def get(self, conn):
+        data = self._data
+        if data is not None and time.monotonic() - self._checked < self.check_interval:
+            self.hits += 1
+            return data
+        with self._lock:
+            now = time.monotonic()
+            data = self._data
+            if data is not None and now - self._checked < self.check_interval:
+                self.hits += 1
+                return data
+            self.checks += 1
+            stamp = version(conn, 'ref', DOCTORS, BLACKLIST).etag
+            if data is None or data.stamp != stamp:
+                data = self._data = self._load(conn, stamp)
+                self.loads += 1
+            self._checked = now
+            return data
+
+    def _load(self, conn, stamp):
+        doctors = [dict(r) for r in conn.execute('''SELECT id, name, username, specialization, experience
+                                                    FROM users WHERE role='doctor' ORDER BY id''')]
+        blacklist = [dict(r) for r in conn.execute('SELECT name, username, specialization FROM blacklisted_doctors ORDER BY id')]
+        return ReferenceData(stamp, doctors, blacklist)
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+
+    def snapshot(self):
+        data = self._data
+        return {'doctors': len(data.doctors) if data else None, 'blacklist': len(data.blacklist) if data else None,
+                'check_interval': self.check_interval, 'hits': self.hits, 'checks': self.checks, 'loads': self.loads}
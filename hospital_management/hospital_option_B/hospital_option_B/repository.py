@@ -0,0 +1,291 @@
+import json
+
+# Data access for users, appointments, history, doctor-patient relations and
+# appointment slots.
+# Every statement is a fixed string, so each connection's statement cache
+# (sized by DB_STATEMENT_CACHE, see db.py) prepares it once and reuses it;
+# lists of ids go in as one JSON parameter instead of a placeholder per id for
+# the same reason. Queries name the columns their callers use rather than
+# SELECT *, so password hashes and unused columns are not fetched and copied
+# into rows. Methods take a connection or a cursor (writer.py jobs get a
+# cursor); the constants are also used as-is by the async views.
+
+
+def id_list(ids):
+    # the parameter for a `IN (SELECT value FROM json_each(?))` clause
+    return json.dumps(list(ids))
+
+
+class Users:
+    IDENTITY = 'SELECT id, username, role, name FROM users WHERE id=?'
+    LOGIN = 'SELECT id, username, role, name, password FROM users WHERE username=?'
+    PROFILE = 'SELECT id, name, username FROM users WHERE id=?'
+    USERNAME_TAKEN = 'SELECT 1 FROM users WHERE username=? AND id<>?'
+    RECENT_PATIENTS = "SELECT id, name, username FROM users WHERE role='patient' ORDER BY id DESC LIMIT 20"
+    CREATE = 'INSERT INTO users (name, username, password, role, specialization, experience) VALUES (?,?,?,?,?,?)'
+    REHASH = 'UPDATE users SET password=? WHERE id=? AND password=?'
+    UPDATE_PROFILE = 'UPDATE users SET name=?, username=?, password=COALESCE(?, password) WHERE id=?'
+    UPDATE_DOCTOR = 'UPDATE users SET name=?, username=?, specialization=?, experience=? WHERE id=?'
+    DELETE = 'DELETE FROM users WHERE id=?'
+
+    @classmethod
+    def identity(cls, db, user_id):
+        return db.execute(cls.IDENTITY, (user_id,)).fetchone()
+
+    @classmethod
+    def for_login(cls, db, username):
+        return db.execute(cls.LOGIN, (username,)).fetchone()
+
+    @classmethod
+    def profile(cls, db, user_id):
+        return db.execute(cls.PROFILE, (user_id,)).fetchone()
+
+    @classmethod
+    def username_taken(cls, db, username, user_id=0):
+        return db.execute(cls.USERNAME_TAKEN, (username, user_id)).fetchone() is not None
+
+    @classmethod
+    def recent_patients(cls, db):
+        return db.execute(cls.RECENT_PATIENTS).fetchall()
+
+    @classmethod
+    def create(cls, db, name, username, pwhash, role, specialization=None, experience=None):
+        # the new user's id; IntegrityError if the username is taken
+        return db.execute(cls.CREATE, (name, username, pwhash, role, specialization, experience)).lastrowid
+
+    @classmethod
+    def rehash(cls, db, user_id, old_hash, new_hash):
+        db.execute(cls.REHASH, (new_hash, user_id, old_hash))
+
+    @classmethod
+    def update_profile(cls, db, user_id, name, username, pwhash=None):
+        db.execute(cls.UPDATE_PROFILE, (name, username, pwhash, user_id))
+
+    @classmethod
+    def update_doctor(cls, db, user_id, name, username, specialization, experience):
+        db.execute(cls.UPDATE_DOCTOR, (name, username, specialization, experience, user_id))
+
+    @classmethod
+    def delete(cls, db, user_id):
+        db.execute(cls.DELETE, (user_id,))
+
+
+class Appointments:
+    GET = 'SELECT id, doctor_id, patient_id, date, time, status FROM appointments WHERE id=?'
+    OWNED = 'SELECT id, doctor_id, date, time, status FROM appointments WHERE id=? AND patient_id=?'
+    DOCTOR = 'SELECT doctor_id FROM appointments WHERE id=?'
+    # patient dashboard table
+    DASHBOARD = '''SELECT a.id, a.doctor_id, a.date, a.time, a.status, d.name as doctor_name
+                   FROM appointments a
+                   LEFT JOIN users d ON a.doctor_id = d.id
+                   WHERE a.patient_id=?
+                   ORDER BY a.date, a.time'''
+    # /api/patient-appointments
+    PATIENT = '''SELECT a.id, a.date, a.time, a.status,
+                   d.name as doctor_name
+                   FROM appointments a
+                   LEFT JOIN users d ON a.doctor_id = d.id
+                   WHERE a.patient_id=?
+                   ORDER BY a.date DESC, a.time DESC'''
+    PATIENTS = '''SELECT a.id, a.patient_id, a.date, a.time, a.status,
+                   d.name as doctor_name
+                   FROM appointments a
+                   LEFT JOIN users d ON a.doctor_id = d.id
+                   WHERE a.patient_id IN (SELECT value FROM json_each(?))
+                   ORDER BY a.date DESC, a.time DESC'''
+    SCHEDULE = '''SELECT a.id, a.date, a.time, a.status, p.id as patient_id, p.name as patient_name
+                   FROM appointments a
+                   LEFT JOIN users p ON a.patient_id = p.id
+                   WHERE a.doctor_id=?
+                   ORDER BY a.date DESC, a.time DESC'''
+    # only into an open slot (see slots.py); the slot triggers then mark it booked
+    BOOK = '''INSERT INTO appointments (doctor_id, patient_id, date, time, status)
+              SELECT ?,?,?,?,'Booked' WHERE EXISTS (SELECT 1 FROM slots
+                  WHERE doctor_id=? AND date=? AND time=? AND appointment_id IS NULL)'''
+    # only a Booked appointment moves; a cancelled or completed one would claim
+    # the slot through the slot triggers
+    MOVE = '''UPDATE appointments SET date=?, time=? WHERE id=? AND status='Booked' AND EXISTS (SELECT 1 FROM slots
+                  WHERE doctor_id=appointments.doctor_id AND date=? AND time=? AND appointment_id IS NULL)'''
+    CANCEL = "UPDATE appointments SET status='Cancelled' WHERE id=?"
+    COMPLETE = "UPDATE appointments SET status='Completed', diagnosis=?, prescription=? WHERE id=? RETURNING patient_id"
+
+    @classmethod
+    def get(cls, db, appt_id):
+        return db.execute(cls.GET, (appt_id,)).fetchone()
+
+    @classmethod
+    def owned(cls, db, appt_id, patient_id):
+        # the appointment if it belongs to the patient
+        return db.execute(cls.OWNED, (appt_id, patient_id)).fetchone()
+
+    @classmethod
+    def doctor_of(cls, db, appt_id):
+        row = db.execute(cls.DOCTOR, (appt_id,)).fetchone()
+        return row[0] if row else None
+
+    @classmethod
+    def dashboard(cls, db, patient_id):
+        return db.execute(cls.DASHBOARD, (patient_id,)).fetchall()
+
+    @classmethod
+    def for_patient(cls, db, patient_id):
+        # cursor, so callers can stream it
+        return db.execute(cls.PATIENT, (patient_id,))
+
+    @classmethod
+    def for_patients(cls, db, ids):
+        return db.execute(cls.PATIENTS, (id_list(ids),)).fetchall()
+
+    @classmethod
+    def schedule(cls, db, doctor_id):
+        return db.execute(cls.SCHEDULE, (doctor_id,)).fetchall()
+
+    @classmethod
+    def book(cls, db, doctor_id, patient_id, date, time):
+        # the new appointment's id, or None if there is no open slot at that time
+        # (IntegrityError from the partial unique index backs this up)
+        cur = db.execute(cls.BOOK, (doctor_id, patient_id, date, time, doctor_id, date, time))
+        return cur.lastrowid if cur.rowcount else None
+
+    @classmethod
+    def move(cls, db, appt_id, date, time):
+        # False if the appointment is not Booked or the doctor has no open slot at that time
+        return db.execute(cls.MOVE, (date, time, appt_id, date, time)).rowcount > 0
+
+    @classmethod
+    def cancel(cls, db, appt_id):
+        db.execute(cls.CANCEL, (appt_id,))
+
+    @classmethod
+    def complete(cls, db, appt_id, diagnosis, prescription):
+        # the patient's id, or None if there is no such appointment
+        rows = db.execute(cls.COMPLETE, (diagnosis, prescription, appt_id)).fetchall()
+        return rows[0][0] if rows else None
+
+
+class History:
+    BY_APPOINTMENT = '''SELECT id, appointment_id, patient_id, doctor_id, visit_info, prescription, date
+                        FROM patient_history WHERE appointment_id=?'''
+    PATIENT = '''SELECT ph.id, ph.appointment_id, ph.visit_info, ph.prescription, ph.date,
+                   d.name as doctor_name
+                   FROM patient_history ph
+                   LEFT JOIN users d ON ph.doctor_id = d.id
+                   WHERE ph.patient_id=?
+                   ORDER BY ph.date DESC'''
+    PATIENTS = '''SELECT ph.id, ph.patient_id, ph.appointment_id, ph.visit_info, ph.prescription, ph.date,
+                   d.name as doctor_name
+                   FROM patient_history ph
+                   LEFT JOIN users d ON ph.doctor_id = d.id
+                   WHERE ph.patient_id IN (SELECT value FROM json_each(?))
+                   ORDER BY ph.date DESC'''
+    ADD = '''INSERT INTO patient_history (appointment_id, patient_id, doctor_id, visit_info, prescription, date)
+             VALUES (?,?,?,?,?,?)'''
+    UPDATE = 'UPDATE patient_history SET visit_info=?, prescription=?, date=? WHERE id=?'
+
+    @classmethod
+    def by_appointment(cls, db, appt_id):
+        return db.execute(cls.BY_APPOINTMENT, (appt_id,)).fetchone()
+
+    @classmethod
+    def for_patient(cls, db, patient_id):
+        # cursor, so callers can stream it
+        return db.execute(cls.PATIENT, (patient_id,))
+
+    @classmethod
+    def for_patients(cls, db, ids):
+        return db.execute(cls.PATIENTS, (id_list(ids),)).fetchall()
+
+    @classmethod
+    def add(cls, db, appointment_id, patient_id, doctor_id, visit_info, prescription, date):
+        return db.execute(cls.ADD, (appointment_id, patient_id, doctor_id, visit_info, prescription, date)).lastrowid
+
+    @classmethod
+    def update(cls, db, rec_id, visit_info, prescription, date):
+        db.execute(cls.UPDATE, (visit_info, prescription, date, rec_id))
+
+
+class Relations:
+    ADD = 'INSERT OR IGNORE INTO doctor_patient (doctor_id, patient_id) VALUES (?,?)'
+    # a doctor may see a patient they are linked to or have had an appointment with
+    RELATED = '''SELECT EXISTS(SELECT 1 FROM doctor_patient WHERE doctor_id=? AND patient_id=?)
+                 OR EXISTS(SELECT 1 FROM appointments WHERE doctor_id=? AND patient_id=?)'''
+
+    @classmethod
+    def add(cls, db, doctor_id, patient_id):
+        db.execute(cls.ADD, (doctor_id, patient_id))
+
+    @classmethod
+    def related(cls, db, doctor_id, patient_id):
+        return bool(db.execute(cls.RELATED, (doctor_id, patient_id, doctor_id, patient_id)).fetchone()[0])
+
+
+class Slots:
+    # the slot grid of one doctor for the first `days` dates on or after a day
+    # that have any slots (days off drop out)
+    AVAILABILITY = '''SELECT s.date, s.time, s.end_time, s.appointment_id, a.patient_id
+                      FROM slots s
+                      LEFT JOIN appointments a ON a.id = s.appointment_id
+                      WHERE s.doctor_id=? AND s.date IN (SELECT DISTINCT date FROM slots
+                          WHERE doctor_id=? AND date>=? ORDER BY date LIMIT ?)
+                      ORDER BY s.date, s.time'''
+    AVAILABILITY_PATIENTS = '''SELECT s.date, s.time, s.end_time, s.appointment_id, a.patient_id,
+                               p.name as patient_name
+                               FROM slots s
+                               LEFT JOIN appointments a ON a.id = s.appointment_id
+                               LEFT JOIN users p ON a.patient_id = p.id
+                               WHERE s.doctor_id=? AND s.date IN (SELECT DISTINCT date FROM slots
+                                   WHERE doctor_id=? AND date>=? ORDER BY date LIMIT ?)
+                               ORDER BY s.date, s.time'''
+    # a doctor's open slots after a (date, time) key, or from it on (OPEN_FROM).
+    # Without statistics the planner picks the primary key and steps over every
+    # booked slot, so these name the partial index of open slots.
+    OPEN_AFTER = '''SELECT date, time, end_time FROM slots INDEXED BY idx_slots_open
+                    WHERE doctor_id=? AND (date, time) > (?, ?) AND appointment_id IS NULL
+                    ORDER BY date, time LIMIT ?'''
+    OPEN_FROM = '''SELECT date, time, end_time FROM slots INDEXED BY idx_slots_open
+                   WHERE doctor_id=? AND (date, time) >= (?, ?) AND appointment_id IS NULL
+                   ORDER BY date, time LIMIT ?'''
+    # the first open slot on or after (date, time) of each doctor in a JSON list,
+    # as a JSON [date, time, end_time] (NULL if there is none): one seek per doctor
+    FIRST_OPEN = '''SELECT d.value, (SELECT json_array(date, time, end_time) FROM slots INDEXED BY idx_slots_open
+                        WHERE doctor_id=d.value AND (date, time) >= (?, ?) AND appointment_id IS NULL
+                        ORDER BY date, time LIMIT 1)
+                    FROM json_each(?) d'''
+    TEMPLATE = '''SELECT weekday, start_time, end_time, slot_minutes FROM slot_templates
+                  WHERE doctor_id=? ORDER BY weekday, start_time'''
+    EXCEPTIONS = '''SELECT date, start_time, end_time, slot_minutes FROM slot_exceptions
+                    WHERE doctor_id=? ORDER BY date, start_time'''
+    CLEAR_TEMPLATE = 'DELETE FROM slot_templates WHERE doctor_id=?'
+    ADD_TEMPLATE = 'INSERT OR REPLACE INTO slot_templates (doctor_id, weekday, start_time, end_time, slot_minutes) VALUES (?,?,?,?,?)'
+    CLEAR_EXCEPTIONS = 'DELETE FROM slot_exceptions WHERE doctor_id=?'
+    ADD_EXCEPTION = 'INSERT INTO slot_exceptions (doctor_id, date, start_time, end_time, slot_minutes) VALUES (?,?,?,?,?)'
+
+    @classmethod
+    def availability(cls, db, doctor_id, start, days, with_patients=False):
+        sql = cls.AVAILABILITY_PATIENTS if with_patients else cls.AVAILABILITY
+        return db.execute(sql, (doctor_id, doctor_id, start, days)).fetchall()
+
+    @classmethod
+    def open_after(cls, db, doctor_id, date, time, limit, inclusive=False):
+        return db.execute(cls.OPEN_FROM if inclusive else cls.OPEN_AFTER, (doctor_id, date, time, limit)).fetchall()
+
+    @classmethod
+    def first_open(cls, db, doctor_ids, date, time):
+        # [(doctor_id, (date, time, end_time))] for the doctors that have an open slot
+        rows = db.execute(cls.FIRST_OPEN, (date, time, id_list(doctor_ids))).fetchall()
+        return [(row[0], tuple(json.loads(row[1]))) for row in rows if row[1] is not None]
+
+    @classmethod
+    def template(cls, db, doctor_id):
+        # (weekly rows, exception rows); a doctor without weekly rows uses doctor 0's
+        return db.execute(cls.TEMPLATE, (doctor_id,)).fetchall(), db.execute(cls.EXCEPTIONS, (doctor_id,)).fetchall()
+
+    @classmethod
+    def replace_template(cls, db, doctor_id, weekly=None, exceptions=None):
+        # None leaves that part as it is; an empty weekly list reverts to the default
+        if weekly is not None:
+            db.execute(cls.CLEAR_TEMPLATE, (doctor_id,))
+            db.executemany(cls.ADD_TEMPLATE, [(doctor_id,) + row for row in weekly])
+        if exceptions is not None:
+            db.execute(cls.CLEAR_EXCEPTIONS, (doctor_id,))
+            db.executemany(cls.ADD_EXCEPTION, [(doctor_id,) + row for row in exceptions])
@@ -0,0 +1,108 @@
+import re
+from markupsafe import escape
+
+# snippet() wraps matches in these control characters; they are swapped for
+# <mark> only after the note text itself has been HTML-escaped
+_OPEN, _CLOSE = '\x02', '\x03'
+
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+# Unscoped (admin) searches rank only the most recent SEARCH_CANDIDATES matches.
+# bm25 ordering over every hit of a common term is what makes a search slow on a
+# large table; a window of recent matches keeps it bounded and recent notes are
+# the ones usually looked for.
+SEARCH_CANDIDATES = 2000
+
+# doctors related to more patients than this are filtered by join instead of
+# by an FTS column filter
+MAX_SCOPE_PATIENTS = 200
+
+_COLUMNS = '''SELECT ph.id, ph.appointment_id, ph.patient_id, p.name as patient_name,
+              ph.doctor_id, d.name as doctor_name, ph.date, m.visit_snippet, m.prescription_snippet, m.score'''
+
+# bm25 weights: the patient_id column only exists for scoping, it never ranks
+_MATCH = '''SELECT patient_history_fts.rowid as rowid,
+            snippet(patient_history_fts, 0, '%(o)s', '%(c)s', '…', 16) as visit_snippet,
+            snippet(patient_history_fts, 1, '%(o)s', '%(c)s', '…', 16) as prescription_snippet,
+            bm25(patient_history_fts, 1.0, 1.0, 0.0) as score
+            FROM patient_history_fts''' % {'o': _OPEN, 'c': _CLOSE}
+
+_JOINS = '''JOIN patient_history ph ON ph.id = m.rowid
+            LEFT JOIN users p ON ph.patient_id = p.id
+            LEFT JOIN users d ON ph.doctor_id = d.id'''
+
+
+def fts_query(text):
+    # Turn free text into an FTS5 MATCH expression: every word must appear,
+    # the last one as a prefix (so "metf" finds metformin). Quoting each token
+    # keeps user input from being parsed as FTS5 syntax; the column filter
+    # keeps a bare number from matching the patient_id column.
+    tokens = re.findall(r'\w+', text or '')
+    if not tokens:
+        return None
+    terms = ['"%s"' % t for t in tokens]
+    terms[-1] += '*'
+    return '{visit_info prescription} : (%s)' % ' '.join(terms)
+
+
+def scoped_query(match, patient_ids):
+    # restrict a MATCH expression to the given patients through the indexed
+    # patient_id column, so FTS5 intersects posting lists instead of the
+    # caller filtering every hit
+    ids = ' OR '.join('"%d"' % int(pid) for pid in patient_ids)
+    return 'patient_id : (%s) AND (%s)' % (ids, match)
+
+
+def highlight(snippet):
+    if snippet is None:
+        return ''
+    return str(escape(snippet)).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+def _ranked(conn, match, limit):
+    return conn.execute(_COLUMNS + ' FROM (' + _MATCH + ''' WHERE patient_history_fts MATCH ?
+                        ORDER BY rank LIMIT ?) m ''' + _JOINS + ' ORDER BY m.score',
+                        (match, limit)).fetchall()
+
+
+def _windowed(conn, match, limit, where='', params=()):
+    return conn.execute(_COLUMNS + ' FROM (' + _MATCH + ''' WHERE patient_history_fts MATCH ?
+                        ORDER BY patient_history_fts.rowid DESC LIMIT ?) m ''' + _JOINS + where +
+                        ' ORDER BY m.score LIMIT ?',
+                        (match, SEARCH_CANDIDATES) + tuple(params) + (limit,)).fetchall()
+
+
+def search_history(conn, text, role, user_id, limit=SEARCH_LIMIT):
+    # Ranked matches over visit notes and prescriptions, scoped like
+    # /api/patient-history: admins see everything, doctors the patients they
+    # are related to (relation or appointment), patients only their own records.
+    match = fts_query(text)
+    if match is None:
+        return []
+    if role == 'patient':
+        rows = _ranked(conn, scoped_query(match, [user_id]), limit)
+    elif role == 'doctor':
+        patients = [r[0] for r in conn.execute('''SELECT patient_id FROM doctor_patient WHERE doctor_id=?
+                                                  UNION SELECT patient_id FROM appointments WHERE doctor_id=?''',
+                                               (user_id, user_id))]
+        if not patients:
+            return []
+        if len(patients) <= MAX_SCOPE_PATIENTS:
+            rows = _ranked(conn, scoped_query(match, patients), limit)
+        else:
+            rows = _windowed(conn, match, limit, ''' WHERE ph.patient_id IN (
+                             SELECT patient_id FROM doctor_patient WHERE doctor_id=?
+                             UNION SELECT patient_id FROM appointments WHERE doctor_id=?)''', (user_id, user_id))
+    elif role == 'admin':
+        rows = _windowed(conn, match, limit)
+    else:
+        return []
+    results = []
+    for row in rows:
+        item = {k: row[k] for k in ('id', 'appointment_id', 'patient_id', 'patient_name', 'doctor_id', 'doctor_name', 'date')}
+        item['visit_info_html'] = highlight(row['visit_snippet'])
+        item['prescription_html'] = highlight(row['prescription_snippet'])
+        item['score'] = round(row['score'], 4)
+        results.append(item)
+    return results
@@ -0,0 +1,215 @@
+import threading, time
+from functools import lru_cache
+from datetime import date, datetime, timedelta
+from availability import DATE_FMT
+from db import immediate
+from repository import id_list
+
+# Materialized appointment slots. Each doctor's weekly template (slot_templates:
+# working hours per weekday cut into slot_minutes slots, weekdays without rows
+# are days off) and dated exceptions (slot_exceptions) are expanded into one
+# `slots` row per bookable slot for the next `horizon` days; doctors without a
+# template of their own get the clinic default (doctor_id 0). Triggers on
+# appointments keep slots.appointment_id set while a slot is booked (see
+# create_db.py), so reading availability is a range read on the slots primary
+# key and a booking only flips that column on a row that already exists.
+
+DEFAULT_HORIZON = 120
+MAX_SLOT_MINUTES = 24 * 60
+
+TEMPLATES_SQL = 'SELECT doctor_id, weekday, start_time, end_time, slot_minutes FROM slot_templates'
+DOCTOR_TEMPLATES_SQL = '''SELECT doctor_id, weekday, start_time, end_time, slot_minutes FROM slot_templates
+                          WHERE doctor_id=0 OR doctor_id IN (SELECT value FROM json_each(?))'''
+EXCEPTIONS_SQL = 'SELECT doctor_id, date, start_time, end_time, slot_minutes FROM slot_exceptions WHERE date BETWEEN ? AND ?'
+DOCTOR_EXCEPTIONS_SQL = '''SELECT doctor_id, date, start_time, end_time, slot_minutes FROM slot_exceptions
+                           WHERE doctor_id IN (SELECT value FROM json_each(?)) AND date BETWEEN ? AND ?'''
+ALL_DOCTORS_SQL = "SELECT id FROM users WHERE role='doctor'"
+DOCTORS_SQL = "SELECT id FROM users WHERE role='doctor' AND id IN (SELECT value FROM json_each(?))"
+# one row per doctor and day with its open slots spelled out ('08:00-12:00 ...')
+# and the times of its booked ones, in time order (the subquery orders the rows
+# group_concat sees). Booked slots stay whatever the template says, so they are
+# left out of the comparison.
+DAYS_SQL = '''SELECT doctor_id, date,
+                  group_concat(CASE WHEN appointment_id IS NULL THEN time || '-' || end_time END, ' '),
+                  group_concat(CASE WHEN appointment_id IS NOT NULL THEN time END, ' ')
+              FROM (SELECT doctor_id, date, time, end_time, appointment_id FROM slots
+                    WHERE date BETWEEN ? AND ? ORDER BY doctor_id, date, time)
+              GROUP BY doctor_id, date'''
+DOCTOR_DAYS_SQL = '''SELECT doctor_id, date,
+                         group_concat(CASE WHEN appointment_id IS NULL THEN time || '-' || end_time END, ' '),
+                         group_concat(CASE WHEN appointment_id IS NOT NULL THEN time END, ' ')
+                     FROM (SELECT doctor_id, date, time, end_time, appointment_id FROM slots
+                           WHERE doctor_id IN (SELECT value FROM json_each(?)) AND date BETWEEN ? AND ?
+                           ORDER BY doctor_id, date, time)
+                     GROUP BY doctor_id, date'''
+# a day whose slots changed is cleared (booked slots stay) and filled again; a
+# new slot picks up an appointment already booked into it (seeded or imported rows)
+CLEAR_DAY_SQL = 'DELETE FROM slots WHERE doctor_id=? AND date=? AND appointment_id IS NULL'
+INSERT_SQL = '''INSERT INTO slots (doctor_id, date, time, end_time, appointment_id)
+                VALUES (?1, ?2, ?3, ?4, (SELECT id FROM appointments
+                    WHERE doctor_id=?1 AND date=?2 AND time=?3 AND status='Booked'))
+                ON CONFLICT(doctor_id, date, time) DO UPDATE SET end_time=excluded.end_time'''
+PAST_SQL = 'DELETE FROM slots WHERE date < ?'
+
+def minutes(hhmm):
+    h, m = hhmm.split(':')
+    return int(h) * 60 + int(m)
+
+
+@lru_cache(maxsize=1024)
+def slot_times(start, end, length):
+    # (time, end_time) of each `length`-minute slot that fits between start and
+    # end; cached, as most doctors share a handful of working hours
+    first, last = minutes(start), minutes(end)
+    return tuple([('%02d:%02d' % divmod(t, 60), '%02d:%02d' % divmod(t + length, 60))
+            for t in range(first, last - length + 1, length)])
+
+
+def day_slots(hours):
+    # the slots of one day in time order, overlapping hours giving a slot once,
+    # and the same spelled-out form DAYS_SQL reads back
+    slots = sorted(dict(hours).items())
+    return slots, ' '.join('%s-%s' % slot for slot in slots)
+
+
+NO_SLOTS = day_slots([])
+
+
+def materialize(cur, start, days, doctor_ids=None):
+    # Bring the slots of `doctor_ids` (default: every doctor, and past slots are
+    # dropped) in line with their templates for `days` days from `start`, in one
+    # batched pass. Each doctor's days are compared with the open slots there
+    # as one string per day, so only the days that changed are written. Returns the
+    # number of slots written; runs in the caller's transaction.
+    first, last = start.strftime(DATE_FMT), (start + timedelta(days=days - 1)).strftime(DATE_FMT)
+    if doctor_ids is None:
+        doctors = [r[0] for r in cur.execute(ALL_DOCTORS_SQL)]
+        existing = cur.execute(DAYS_SQL, (first, last)).fetchall()
+        templates = cur.execute(TEMPLATES_SQL).fetchall()
+        dated = cur.execute(EXCEPTIONS_SQL, (first, last)).fetchall()
+    else:
+        ids = id_list(doctor_ids)
+        doctors = [r[0] for r in cur.execute(DOCTORS_SQL, (ids,))]
+        existing = cur.execute(DOCTOR_DAYS_SQL, (ids, first, last)).fetchall()
+        templates = cur.execute(DOCTOR_TEMPLATES_SQL, (ids,)).fetchall()
+        dated = cur.execute(DOCTOR_EXCEPTIONS_SQL, (ids, first, last)).fetchall()
+    existing = {(doctor_id, day): (spelled or '', booked) for doctor_id, day, spelled, booked in existing}
+    weekly = {}
+    for doctor_id, weekday, start_time, end_time, length in templates:
+        weekly.setdefault(doctor_id, {}).setdefault(weekday, []).extend(slot_times(start_time, end_time, length))
+    weekly = {doctor_id: {weekday: day_slots(hours) for weekday, hours in week.items()}
+              for doctor_id, week in weekly.items()}
+    exceptions = {}
+    for doctor_id, day, start_time, end_time, length in dated:
+        hours = exceptions.setdefault((doctor_id, day), [])
+        if start_time is not None:
+            hours.extend(slot_times(start_time, end_time, length))
+    exceptions = {key: day_slots(hours) for key, hours in exceptions.items()}
+    dates = [(d.strftime(DATE_FMT), d.weekday()) for d in (start + timedelta(days=i) for i in range(days))]
+    changed, rows = [], []
+    for doctor_id in doctors:
+        week = weekly.get(doctor_id) or weekly.get(0, {})
+        for day, weekday in dates:
+            slots, spelled = exceptions.get((doctor_id, day)) or week.get(weekday, NO_SLOTS)
+            have, booked = existing.pop((doctor_id, day), ('', None))
+            if booked:
+                booked = set(booked.split(' '))
+                slots, spelled = day_slots(slot for slot in slots if slot[0] not in booked)
+            if have != spelled:
+                changed.append((doctor_id, day))
+                rows.extend((doctor_id, day, t, end_time) for t, end_time in slots)
+
+    if doctor_ids is None:
+        cur.execute(PAST_SQL, (first,))
+    # what is left in `existing` belongs to users that are no longer doctors
+    cur.executemany(CLEAR_DAY_SQL, changed + list(existing))
+    cur.executemany(INSERT_SQL, rows)
+    return len(rows)
+
+def parse_template(data):
+    # (weekly, exceptions) rows from a /slot-template request body, or ValueError
+    def hours(item):
+        start_time, end_time = item.get('start'), item.get('end')
+        length = item.get('slot_minutes')
+        try:
+            first, last = minutes(start_time), minutes(end_time)
+            length = int(length)
+        except (AttributeError, TypeError, ValueError):
+            raise ValueError('start, end (HH:MM) and slot_minutes required')
+        if not 0 <= first < last <= MAX_SLOT_MINUTES or not 0 < length <= last - first:
+            raise ValueError('invalid hours %s-%s / %s minutes' % (start_time, end_time, length))
+        return '%02d:%02d' % divmod(first, 60), '%02d:%02d' % divmod(last, 60), length
+
+    weekly = None
+    if data.get('weekly') is not None:
+        weekly = []
+        for item in data['weekly']:
+            if item.get('weekday') not in range(7):
+                raise ValueError('weekday must be 0 (Monday) to 6')
+            weekly.append((item['weekday'],) + hours(item))
+    exceptions = None
+    if data.get('exceptions') is not None:
+        exceptions = []
+        for item in data['exceptions']:
+            try:
+                day = datetime.strptime(item.get('date') or '', DATE_FMT).strftime(DATE_FMT)
+            except ValueError:
+                raise ValueError('exception dates must be YYYY-MM-DD')
+            exceptions.append((day,) + (hours(item) if item.get('start') else (None, None, None)))
+    return weekly, exceptions
+
+
+class SlotGenerator:
+    # Keeps `slots` filled for the next `horizon` days: a full pass when started,
+    # then again whenever the date rolls over (checked every `interval` seconds
+    # on a background thread). Template changes regenerate their one doctor in
+    # the request that makes them (materialize(..., [doctor_id])).
+
+    def __init__(self, connect, horizon=DEFAULT_HORIZON, interval=300):
+        self.connect = connect
+        self.horizon = horizon
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._day = None
+        self.stats = {'passes': 0, 'slots': 0, 'last_ms': 0.0, 'errors': 0}
+
+    def ensure_started(self):
+        # first full pass on the calling thread, so slots exist before it returns
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self.run_once()
+                    self._thread = threading.Thread(target=self._loop, name='slot-generator', daemon=True)
+                    self._thread.start()
+
+    def run_once(self):
+        today = date.today()
+        conn = self.connect()
+        try:
+            started = time.perf_counter()
+            count = immediate(conn, lambda cur: materialize(cur, today, self.horizon))
+        finally:
+            conn.close()
+        self._day = today
+        self.stats.update(passes=self.stats['passes'] + 1, slots=count,
+                          last_ms=round((time.perf_counter() - started) * 1000, 1))
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            if date.today() != self._day:
+                try:
+                    self.run_once()
+                except Exception:
+                    # locked or failing database: retried on the next check
+                    self.stats['errors'] += 1
+
+    def shutdown(self):
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def snapshot(self):
+        return dict(self.stats, horizon=self.horizon, day=self._day.strftime(DATE_FMT) if self._day else None)
@@ -0,0 +1,74 @@
+import csv, io, json
+from functools import wraps
+from flask import Response, make_response, request, stream_with_context
+
+NDJSON = 'application/x-ndjson'
+CSV = 'text/csv'
+
+# rows pulled from the cursor per chunk written to the client
+BATCH = 500
+
+
+def stream_format():
+    # 'ndjson' or 'csv' when the client asked for a streamed body (?format= wins
+    # over Accept), None for the default JSON array
+    fmt = (request.args.get('format') or '').lower()
+    if fmt in ('ndjson', 'csv'):
+        return fmt
+    if fmt:
+        return None
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON, CSV])
+    return {NDJSON: 'ndjson', CSV: 'csv'}.get(best)
+
+
+def negotiated(view):
+    # for views whose body depends on the Accept header: every response they
+    # give (JSON, streamed, 304 or error) says so, or a shared or browser cache
+    # could serve one format to a client that asked for another
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        response.vary.add('Accept')
+        return response
+    return wrapped
+
+
+def _batches(cursor):
+    while True:
+        rows = cursor.fetchmany(BATCH)
+        if not rows:
+            return
+        yield rows
+
+
+def _ndjson(cursor, columns):
+    for rows in _batches(cursor):
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+
+def _csv(cursor, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for rows in _batches(cursor):
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def stream_rows(cursor, fmt, filename=None):
+    # Response that writes an executed cursor out batch by batch: the first
+    # bytes leave after one batch and memory does not grow with the row count.
+    # The request context (and with it the pooled connection) lives until the
+    # generator is done.
+    columns = [c[0] for c in cursor.description]
+    if fmt == 'csv':
+        resp = Response(stream_with_context(_csv(cursor, columns)), mimetype=CSV)
+        if filename:
+            resp.headers['Content-Disposition'] = 'attachment; filename="%s.csv"' % filename
+    else:
+        resp = Response(stream_with_context(_ndjson(cursor, columns)), mimetype=NDJSON)
+    return resp
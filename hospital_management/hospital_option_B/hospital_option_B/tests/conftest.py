@@ -0,0 +1,38 @@
+# Shared fixtures: the app on a fresh, migrated database per test.
+import os, sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from database import create_db
+
+
+@pytest.fixture
+def appmod(tmp_path):
+    # the app module, configured (caches, pool, writer) for a new database;
+    # config changes a test makes are undone afterwards
+    db_path = str(tmp_path / 'hms.db')
+    create_db.init_db(db_path)
+    import app as appmod
+    saved = dict(appmod.app.config)
+    appmod.create_app({'DB_PATH': db_path, 'TESTING': True})
+    yield appmod
+    appmod.shutdown_app()
+    appmod.app.config.clear()
+    appmod.app.config.update(saved)
+
+
+def add_user(conn, role, username):
+    return conn.execute('INSERT INTO users (name, username, password, role) VALUES (?,?,?,?)',
+                        (username.title(), username, 'x', role)).lastrowid
+
+
+def client_for(appmod, user_id):
+    # test client logged in as user_id, without the password check
+    client = appmod.app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+    return client
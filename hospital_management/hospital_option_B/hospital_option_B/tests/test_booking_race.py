@@ -0,0 +1,53 @@
+# Concurrent bookings of one slot: exactly one wins, every other request is
+# told the slot is gone (the EXISTS check on an open slot, backed by the
+# partial unique index), with and without the group-commit writer.
+import sqlite3, threading
+from datetime import date, timedelta
+
+import pytest
+
+from conftest import add_user, client_for
+
+THREADS = 24
+
+
+@pytest.mark.parametrize('group_commit', [True, False])
+def test_exactly_one_concurrent_booking_wins(appmod, group_commit):
+    from slots import materialize
+    appmod.app.config['GROUP_COMMIT'] = group_commit
+    conn = sqlite3.connect(appmod.app.config['DB_PATH'])
+    doctor_id = add_user(conn, 'doctor', 'racedoc')
+    patients = [add_user(conn, 'patient', 'racepat%d' % i) for i in range(THREADS)]
+    conn.commit()
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    materialize(cur, date.today(), 14, [doctor_id])
+    conn.commit()
+    tomorrow = (date.today() + timedelta(days=1)).strftime('%Y-%m-%d')
+    day, slot = conn.execute('''SELECT date, time FROM slots WHERE doctor_id=? AND date>=? AND appointment_id IS NULL
+                                ORDER BY date, time LIMIT 1''', (doctor_id, tomorrow)).fetchone()
+
+    clients = [client_for(appmod, p) for p in patients]
+    barrier = threading.Barrier(THREADS)
+    results = [None] * THREADS
+
+    def book(i):
+        barrier.wait()
+        r = clients[i].post('/book/%d' % doctor_id, data={'date': day, 'time': slot}, follow_redirects=True)
+        results[i] = (r.request.path, r.get_data(as_text=True))
+
+    threads = [threading.Thread(target=book, args=(i,)) for i in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    booked = conn.execute("""SELECT COUNT(*) FROM appointments WHERE doctor_id=? AND date=? AND time=? AND status='Booked'""",
+                          (doctor_id, day, slot)).fetchone()[0]
+    conn.close()
+    winners = [body for path, body in results if path == '/patient']
+    losers = [body for path, body in results if path != '/patient']
+    assert booked == 1
+    assert len(winners) == 1 and 'Appointment booked successfully!' in winners[0]
+    assert len(losers) == THREADS - 1
+    assert all('Slot not available' in body for body in losers)
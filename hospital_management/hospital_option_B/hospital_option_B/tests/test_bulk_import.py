@@ -0,0 +1,52 @@
+# History imports keep an appointment_id only when it names an appointment of
+# the same patient and doctor in the target database: ids from another
+# clinic's export would otherwise attach visit notes to unrelated appointments.
+import json, sqlite3
+
+from conftest import add_user
+from database import bulk
+
+
+def setup(appmod):
+    # a doctor with one appointment for each of two patients
+    conn = sqlite3.connect(appmod.app.config['DB_PATH'])
+    doctor = add_user(conn, 'doctor', 'bulkdoc')
+    patient = add_user(conn, 'patient', 'bulkpat')
+    other = add_user(conn, 'patient', 'otherpat')
+    appts = [conn.execute('''INSERT INTO appointments (doctor_id, patient_id, date, time, status)
+                             VALUES (?,?,?,'08:00','Completed')''', (doctor, p, '2024-03-0%d' % (i + 1))).lastrowid
+             for i, p in enumerate((patient, other))]
+    conn.commit()
+    return conn, appts
+
+
+def import_history(appmod, tmp_path, **rows):
+    # imports one bulkpat/bulkdoc record per keyword (visit_info=appointment_id);
+    # returns the importer and {visit_info: stored appointment_id}
+    path = tmp_path / 'history.ndjson'
+    path.write_text(''.join(json.dumps({'patient': 'bulkpat', 'doctor': 'bulkdoc', 'date': '2024-03-01',
+                                        'visit_info': note, 'prescription': '', 'appointment_id': appt_id}) + '\n'
+                            for note, appt_id in rows.items()))
+    db_path = appmod.app.config['DB_PATH']
+    importer, seen, _ = bulk.import_file(db_path, 'history', str(path), log=lambda msg: None)
+    assert seen == importer.inserted == len(rows) and importer.rejected == 0
+    conn = sqlite3.connect(db_path)
+    links = dict(conn.execute('SELECT visit_info, appointment_id FROM patient_history'))
+    conn.close()
+    return importer, links
+
+
+def test_dangling_appointment_id_is_dropped(appmod, tmp_path):
+    conn, (own, _) = setup(appmod)
+    conn.close()
+    importer, links = import_history(appmod, tmp_path, linked=own, dangling=own + 1000)
+    assert links == {'linked': own, 'dangling': None}
+    assert importer.unlinked == 1
+
+
+def test_appointment_of_another_patient_is_not_linked(appmod, tmp_path):
+    conn, (own, others) = setup(appmod)
+    conn.close()
+    importer, links = import_history(appmod, tmp_path, linked=own, wrong_patient=others)
+    assert links == {'linked': own, 'wrong_patient': None}
+    assert importer.unlinked == 1
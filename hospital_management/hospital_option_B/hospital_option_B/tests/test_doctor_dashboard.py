@@ -0,0 +1,33 @@
+# The doctor dashboard pages through appointments on a (date, time, id)
+# keyset, so each appointment must come back as exactly one row even when it
+# has several history records.
+import sqlite3
+
+from conftest import add_user, client_for
+
+
+def test_paging_across_an_appointment_with_two_history_records(appmod):
+    conn = sqlite3.connect(appmod.app.config['DB_PATH'])
+    doctor_id = add_user(conn, 'doctor', 'pagedoc')
+    patient_id = add_user(conn, 'patient', 'pagepat')
+    appts = [conn.execute('''INSERT INTO appointments (doctor_id, patient_id, date, time, status)
+                             VALUES (?,?,?,?,'Completed')''', (doctor_id, patient_id, '2024-05-0%d' % day, '08:00')).lastrowid
+             for day in (1, 2, 3)]
+    history = [conn.execute('''INSERT INTO patient_history (appointment_id, patient_id, doctor_id, visit_info, prescription, date)
+                               VALUES (?,?,?,?,?,?)''', (appts[1], patient_id, doctor_id, note, '', '2024-05-02')).lastrowid
+               for note in ('first visit note', 'follow-up note')]
+    conn.commit()
+    conn.close()
+
+    client = client_for(appmod, doctor_id)
+    seen, cursor = [], None
+    for _ in range(10):
+        r = client.get('/api/doctor/appointments', query_string={'limit': 1, **({'cursor': cursor} if cursor else {})})
+        assert r.status_code == 200
+        seen.extend((item['id'], item['history_id']) for item in r.json['items'])
+        cursor = r.json['next_cursor']
+        if cursor is None:
+            break
+
+    # one row per appointment, in order, with the latest history record
+    assert seen == [(appts[0], None), (appts[1], history[1]), (appts[2], None)]
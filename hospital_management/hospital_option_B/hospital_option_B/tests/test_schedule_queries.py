@@ -0,0 +1,57 @@
+# The doctor schedule page reads the slot grid and its patients' names in one
+# query (Slots.AVAILABILITY_PATIENTS), so the statements it runs must not grow
+# with the number of booked slots.
+import sqlite3
+from datetime import date, timedelta
+
+from conftest import add_user, client_for
+
+
+def book(conn, doctor_id, patient_ids):
+    # one appointment per patient in the doctor's first open slots from tomorrow
+    tomorrow = (date.today() + timedelta(days=1)).strftime('%Y-%m-%d')
+    slots = conn.execute('''SELECT date, time FROM slots WHERE doctor_id=? AND date>=? AND appointment_id IS NULL
+                            ORDER BY date, time LIMIT ?''', (doctor_id, tomorrow, len(patient_ids))).fetchall()
+    assert len(slots) == len(patient_ids)
+    conn.executemany("INSERT INTO appointments (doctor_id, patient_id, date, time, status) VALUES (?,?,?,?,'Booked')",
+                     [(doctor_id, p) + tuple(slot) for p, slot in zip(patient_ids, slots)])
+    conn.commit()
+
+
+def schedule_statements(appmod, client, monkeypatch):
+    # statements run by one /doctor/schedule request on freshly traced connections
+    statements = []
+    connect = appmod.db.connect
+
+    def traced(pooled=True):
+        conn = connect(pooled)
+        conn.set_trace_callback(lambda sql: sql.startswith('--') or statements.append(sql))
+        return conn
+    monkeypatch.setattr(appmod.db, 'connect', traced)
+    appmod.db.close_all()
+    r = client.get('/doctor/schedule')
+    assert r.status_code == 200
+    return statements, r.get_data(as_text=True)
+
+
+def test_schedule_query_count_does_not_grow_with_bookings(appmod, monkeypatch):
+    from slots import materialize
+    conn = sqlite3.connect(appmod.app.config['DB_PATH'])
+    doctor_id = add_user(conn, 'doctor', 'schedoc')
+    patients = [add_user(conn, 'patient', 'schedpat%d' % i) for i in range(6)]
+    conn.commit()
+    cur = conn.cursor()
+    cur.execute('BEGIN IMMEDIATE')
+    materialize(cur, date.today(), 30, [doctor_id])
+    conn.commit()
+
+    client = client_for(appmod, doctor_id)
+    client.get('/doctor/schedule')  # identity and reference caches warm
+    empty, page = schedule_statements(appmod, client, monkeypatch)
+    assert 'Schedpat0' not in page
+    book(conn, doctor_id, patients)
+    booked, page = schedule_statements(appmod, client, monkeypatch)
+    conn.close()
+
+    assert all('Schedpat%d' % i in page for i in range(len(patients)))
+    assert len(booked) == len(empty) == 2, (empty, booked)
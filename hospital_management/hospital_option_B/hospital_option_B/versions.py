@@ -0,0 +1,82 @@
+import json
+from datetime import datetime, timezone
+from flask import Response, request
+
+# generation keys maintained by triggers (see GENERATION_TRIGGERS in create_db.py)
+DOCTORS = ('doctors', 0)
+BLACKLIST = ('blacklist', 0)
+
+
+def patient(patient_id):
+    return ('patient', patient_id)
+
+
+def appointment(appointment_id):
+    return ('appointment', appointment_id)
+
+
+class Version:
+    # ETag / Last-Modified for one response, derived from generation counters
+    __slots__ = ('etag', 'modified')
+
+    def __init__(self, etag, modified):
+        self.etag = etag
+        self.modified = modified
+
+    def fresh(self):
+        # whether the client's copy is current; If-None-Match wins over If-Modified-Since
+        if request.if_none_match:
+            return request.if_none_match.contains(self.etag)
+        since = request.if_modified_since
+        return since is not None and self.modified is not None and self.modified <= since
+
+    def apply(self, response):
+        response.set_etag(self.etag)
+        if self.modified is not None:
+            response.last_modified = self.modified
+        # let the browser keep the body but always revalidate it
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def not_modified(self):
+        return self.apply(Response(status=304))
+
+
+# more keys than this (the patient summary) go in as one JSON parameter, so
+# every list length shares a single prepared statement
+MAX_INLINE_KEYS = 4
+KEYS_SQL = '''SELECT g.scope, g.key, g.gen, g.modified FROM json_each(?) k
+              JOIN generations g ON g.scope = json_extract(k.value, '$[0]') AND g.key = json_extract(k.value, '$[1]')'''
+
+
+def _query(keys):
+    if len(keys) > MAX_INLINE_KEYS:
+        return KEYS_SQL, (json.dumps([('epoch', 0)] + [list(key) for key in keys]),)
+    where = ["(scope='epoch' AND key=0)"] + ['(scope=? AND key=?)'] * len(keys)
+    return 'SELECT scope, key, gen, modified FROM generations WHERE ' + ' OR '.join(where), [v for key in keys for v in key]
+
+
+def _version(name, keys, rows):
+    found = {(r[0], r[1]): (r[2], r[3]) for r in rows}
+    epoch, modified = found.get(('epoch', 0), (0, 0))
+    gens = []
+    for key in keys:
+        gen, changed = found.get(tuple(key), (0, 0))
+        gens.append(str(gen))
+        modified = max(modified, changed)
+    return Version('%s-%s-%s' % (epoch, name, '.'.join(gens)),
+                   datetime.fromtimestamp(modified, timezone.utc) if modified else None)
+
+
+def version(conn, name, *keys):
+    # One primary-key lookup per key, no matter how large the resource is.
+    # `name` identifies the resource (and variant) so tags of different
+    # resources never collide; keys without a row yet count as generation 0.
+    sql, params = _query(keys)
+    return _version(name, keys, conn.execute(sql, params).fetchall())
+
+
+async def version_async(conn, name, *keys):
+    # version() on an aiosqlite connection (see aioreads.py)
+    sql, params = _query(keys)
+    return _version(name, keys, await conn.execute_fetchall(sql, params))